@@ -0,0 +1,224 @@
+# account_pool.py
+"""
+Pre-provisioned account pool.
+
+Accounts are signed up in the background (parallel browser contexts sharing one
+browser) until a site has `target_size` available accounts, stored in
+auth.credentials with status='available', and leased to callers with a TTL:
+
+    from account_pool import lease, release
+    acct = lease("demoblaze", holder="my-task")      # None if the pool is empty
+    ...
+    release(acct)                                    # or release(acct, retire=True)
+
+Sites opt in with an "account_pool" block next to their "signup" block:
+    "account_pool": {"target_size": 10, "concurrency": 4, "lease_ttl_s": 900}
+"""
+import os
+import uuid
+import asyncio
+import logging
+import secrets
+
+from playwright.async_api import async_playwright, TimeoutError as PWTimeout
+
+from celery_app import app
+from redis_conn import get_redis
+from rate_limit import guard_context, site_hosts
+import asset_cache
+from captcha_pipeline import CaptchaPipeline
+from sites import load, all_sites
+from db import (
+    insert_pool_account, count_available_accounts,
+    lease_account, renew_lease, release_account,
+)
+
+DEFAULT_TARGET = int(os.getenv("ACCOUNT_POOL_TARGET", "5"))
+DEFAULT_CONCURRENCY = int(os.getenv("ACCOUNT_POOL_CONCURRENCY", "4"))
+DEFAULT_LEASE_TTL_S = int(os.getenv("ACCOUNT_POOL_LEASE_TTL_S", "900"))
+BACKOFF_BASE_S = int(os.getenv("ACCOUNT_POOL_BACKOFF_BASE_S", "60"))     # doubles per failed refill
+BACKOFF_MAX_S = int(os.getenv("ACCOUNT_POOL_BACKOFF_MAX_S", "3600"))
+
+log = logging.getLogger(__name__)
+
+# ---------- helpers ----------
+
+def _arun(coro):
+    try:
+        return asyncio.run(coro)
+    except RuntimeError:
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(coro)
+
+def pool_conf(conf: dict) -> dict:
+    pc = conf.get("account_pool") or {}
+    return {
+        "target_size": int(pc.get("target_size", DEFAULT_TARGET)),
+        "concurrency": int(pc.get("concurrency", DEFAULT_CONCURRENCY)),
+        "lease_ttl_s": int(pc.get("lease_ttl_s", DEFAULT_LEASE_TTL_S)),
+    }
+
+def unique_creds(prefix: str = "llmuser") -> dict:
+    """Random-suffixed credentials; unlike int(time.time()) these don't collide across parallel signups."""
+    suffix = secrets.token_hex(5)
+    return {
+        "username": f"{prefix}{suffix}",
+        "email": f"llm{suffix}@mailinator.com",
+        "password": secrets.token_urlsafe(12),
+    }
+
+# ---------- provisioning ----------
+
+async def _signup_one(browser, site_id: str, conf: dict, creds: dict) -> bool:
+    """Run the config-driven signup flow (same schema as tasks.signup_only) in its own context."""
+    sconf = conf["signup"]
+    ctx = await browser.new_context()
+    captchas = CaptchaPipeline(site_id, conf)
+    try:
+        await guard_context(ctx, site_hosts(conf))
+        await asset_cache.attach(ctx)
+        await captchas.attach(ctx)
+        page = await ctx.new_page()
+        await page.goto(sconf.get("url") or conf["start_url"], wait_until="domcontentloaded")
+        await captchas.scan(page)
+
+        op = sconf.get("open") or {}
+        if op.get("click"):
+            await page.click(op["click"])
+        if op.get("wait_for"):
+            await page.wait_for_selector(op["wait_for"], timeout=15000)
+            await captchas.scan(page)
+
+        f = sconf.get("fields", {})
+        for key in ("username", "email", "password"):
+            if f.get(key):
+                await page.fill(f[key], creds[key])
+        await captchas.before_submit(page)
+
+        success = sconf.get("success") or {}
+        if success.get("type") == "dialog_contains":
+            async with page.expect_event("dialog", timeout=15000) as di:
+                await page.click(sconf["submit"])
+            dlg = await di.value
+            msg = (dlg.message or "").lower()
+            try:
+                await dlg.accept()
+            except Exception:
+                pass
+            # "already exists" is a collision here, not a usable account
+            return success.get("value", "").lower() in msg
+
+        await page.click(sconf["submit"])
+        if success.get("type") == "url_contains":
+            await page.wait_for_url(f"**{success['value']}**", timeout=15000)
+        elif success.get("type") == "dom_exists":
+            await page.wait_for_selector(success["value"], timeout=15000)
+        return True
+    except PWTimeout as e:
+        log.warning("pool signup for %s timed out: %s", site_id, e)
+        return False
+    except Exception:
+        log.exception("pool signup for %s failed", site_id)
+        return False
+    finally:
+        captchas.close()
+        await ctx.close()
+
+async def _provision(site_id: str, conf: dict, count: int, concurrency: int):
+    """(created account ids, number of failed signups)."""
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=True)
+
+        async def one():
+            creds = unique_creds()
+            async with sem:
+                ok = await _signup_one(browser, site_id, conf, creds)
+            if not ok:
+                return None
+            return await insert_pool_account(site_id, creds["username"], creds["password"], creds["email"])
+
+        try:
+            results = await asyncio.gather(*(one() for _ in range(count)), return_exceptions=True)
+        finally:
+            await browser.close()
+    for r in results:
+        if isinstance(r, BaseException):
+            log.warning("pool account for %s not stored: %r", site_id, r)
+    created = [r for r in results if isinstance(r, int)]
+    return created, len(results) - len(created)
+
+def _backoff(site_id: str, created: int, failed: int):
+    """Refills that create nothing back off exponentially; any success resets the counter."""
+    r = get_redis()
+    if created:
+        r.delete(f"account_pool:failures:{site_id}")
+    elif failed:
+        n = r.incr(f"account_pool:failures:{site_id}")
+        r.set(f"account_pool:backoff:{site_id}", n, ex=min(BACKOFF_MAX_S, BACKOFF_BASE_S * 2 ** (n - 1)))
+
+def refill(site_id: str) -> dict:
+    """
+    Top the pool up to target_size. A Redis lock keeps two workers from
+    provisioning the same site at once (they would overshoot the target).
+    """
+    conf = load(site_id)
+    if "signup" not in conf:
+        raise ValueError(f"Site '{site_id}' has no signup config; cannot provision accounts")
+    pc = pool_conf(conf)
+
+    ttl = get_redis().ttl(f"account_pool:backoff:{site_id}")
+    if ttl and ttl > 0:
+        return {"site_id": site_id, "skipped": f"backing off after failed signups ({ttl}s left)"}
+
+    lock = get_redis().lock(f"account_pool:refill:{site_id}", timeout=900)
+    if not lock.acquire(blocking=False):
+        return {"site_id": site_id, "skipped": "refill already running"}
+    try:
+        available = _arun(count_available_accounts(site_id))
+        missing = pc["target_size"] - available
+        created, failed = _arun(_provision(site_id, conf, missing, pc["concurrency"])) if missing > 0 else ([], 0)
+        _backoff(site_id, len(created), failed)
+        return {"site_id": site_id, "available": available + len(created),
+                "requested": max(missing, 0), "created": len(created), "failed": failed}
+    finally:
+        try:
+            lock.release()
+        except Exception:
+            pass
+
+def pooled_sites() -> list:
+    return [sid for sid, conf in all_sites().items() if "account_pool" in conf and "signup" in conf]
+
+# ---------- leasing ----------
+
+def _request_refill(site_id: str):
+    # send_task by name: no import cycle with tasks_pool, and leasing never waits on provisioning
+    app.send_task("tasks.refill_account_pool", args=[site_id])
+
+async def alease(site_id: str, holder: str = "", ttl_s: int | None = None):
+    try:
+        conf = load(site_id)
+    except FileNotFoundError:
+        conf = {}
+    pc = pool_conf(conf)
+    acct = await lease_account(site_id, holder, uuid.uuid4().hex, ttl_s or pc["lease_ttl_s"])
+    if "account_pool" in conf:
+        remaining = await count_available_accounts(site_id)
+        if remaining < pc["target_size"]:
+            _request_refill(site_id)
+    if acct:
+        acct["site_id"] = site_id
+    return acct
+
+def lease(site_id: str, holder: str = "", ttl_s: int | None = None):
+    """Lease a ready account (dict with id/username/password/email/lease_token) or None if the pool is empty."""
+    return _arun(alease(site_id, holder, ttl_s))
+
+def renew(acct: dict, ttl_s: int | None = None) -> bool:
+    return _arun(renew_lease(acct["id"], acct["lease_token"], ttl_s or DEFAULT_LEASE_TTL_S))
+
+def release(acct: dict, retire: bool = False) -> bool:
+    """Return the account to the pool. False means the lease expired and was reclaimed by someone else."""
+    return _arun(release_account(acct["id"], acct["lease_token"], retire))
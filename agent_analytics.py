@@ -0,0 +1,149 @@
+# agent_analytics.py
+"""
+Step analytics and adaptive budgets for browser-use login runs.
+
+Each run's AgentHistoryList is flattened into one row per step (actions, URL,
+duration, errors, whether it repeats the previous step) and joined with the
+LLM calls the routed chat model logged during that step (latency, tokens).
+Rows go to auth.agent_runs / auth.agent_steps.
+
+The step budget and timeout for the next run come from the site's recent
+successful runs (p95 with headroom, clamped), so a looping agent is cut off
+well before the global 30-step ceiling. A run that was cut off adds no success,
+so after AGENT_ESCALATE_AFTER cut-offs in a row the next run gets the ceilings
+again; otherwise a site whose login got longer would never recover:
+
+    max_steps, timeout_s = await budget("saucedemo")
+    python agent_analytics.py [site_id] [days]       # per-site report
+"""
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import logging
+
+from db import record_agent_run, agent_run_percentiles, agent_report
+
+log = logging.getLogger(__name__)
+
+MIN_STEPS = int(os.getenv("AGENT_MIN_STEPS", "6"))
+MAX_STEPS = int(os.getenv("AGENT_MAX_STEPS", "30"))
+MIN_TIMEOUT_S = float(os.getenv("AGENT_MIN_TIMEOUT_S", "60"))
+MAX_TIMEOUT_S = float(os.getenv("AGENT_MAX_TIMEOUT_S", "600"))
+HEADROOM = float(os.getenv("AGENT_BUDGET_HEADROOM", "1.5"))     # budget = p95 * headroom (+ slack)
+MIN_RUNS = int(os.getenv("AGENT_BUDGET_MIN_RUNS", "5"))         # fewer successful runs -> ceilings
+WINDOW = int(os.getenv("AGENT_BUDGET_WINDOW", "50"))
+ESCALATE_AFTER = int(os.getenv("AGENT_ESCALATE_AFTER", "1"))     # cut-offs since the last success -> ceilings
+
+# ---------- LLM call log ----------
+
+class CallLog:
+    """LLM calls made during one run: (wall start, latency ms, input tokens, output tokens, provider)."""
+    def __init__(self):
+        self.calls = []
+
+    def add(self, started: float, latency_ms: float, result, provider: str = None):
+        usage = getattr(result, "usage", None)
+        inp = getattr(usage, "prompt_tokens", None) if usage is not None else None
+        out = getattr(usage, "completion_tokens", None) if usage is not None else None
+        self.calls.append((started, latency_ms, inp, out, provider))
+
+    def between(self, start, end):
+        return [c for c in self.calls if start is not None and end is not None and start <= c[0] <= end]
+
+def _sum(xs):
+    xs = [x for x in xs if x is not None]
+    return sum(xs) if xs else None
+
+# ---------- history -> rows ----------
+
+def _actions(h):
+    out = getattr(h, "model_output", None)
+    names = []
+    for a in (getattr(out, "action", None) or []):
+        try:
+            d = a.model_dump(exclude_unset=True)
+        except Exception:
+            d = {}
+        names.extend(k for k, v in d.items() if v is not None)
+    return names
+
+def summarize(history, calls: CallLog, site_id: str, max_steps: int, timeout_s: float,
+              started: float, outcome: str = None, error: str = None):
+    """(run row, step rows) from an AgentHistoryList (or None when the run died early)."""
+    steps, prev = [], None
+    for i, h in enumerate(getattr(history, "history", None) or []):
+        meta = getattr(h, "metadata", None)
+        t0, t1 = getattr(meta, "step_start_time", None), getattr(meta, "step_end_time", None)
+        mine = calls.between(t0, t1)
+        actions = _actions(h)
+        url = getattr(getattr(h, "state", None), "url", None)
+        errs = [r.error for r in (getattr(h, "result", None) or []) if getattr(r, "error", None)]
+        steps.append({
+            "step": getattr(meta, "step_number", None) or i + 1,
+            "actions": actions,
+            "url": url,
+            "duration_ms": (t1 - t0) * 1000.0 if t0 is not None and t1 is not None else None,
+            "llm_calls": len(mine),
+            "llm_ms": _sum(c[1] for c in mine),
+            "input_tokens": _sum(c[2] for c in mine) or getattr(meta, "input_tokens", None),
+            "output_tokens": _sum(c[3] for c in mine),
+            "repeated": bool(actions) and prev == (actions, url),
+            "error": "; ".join(errs)[:500] or None,
+        })
+        prev = (actions, url)
+
+    if outcome is None:
+        ok = history is not None and history.is_done() and history.is_successful() is not False
+        outcome = "success" if ok else "max_steps" if len(steps) >= max_steps else "failed"
+    run = {
+        "site_id": site_id,
+        "outcome": outcome,
+        "steps": len(steps),
+        "max_steps": max_steps,
+        "timeout_s": timeout_s,
+        "duration_ms": (time.time() - started) * 1000.0,
+        "llm_calls": len(calls.calls),
+        "llm_ms": _sum(c[1] for c in calls.calls),
+        "input_tokens": _sum(c[2] for c in calls.calls) or _sum(s["input_tokens"] for s in steps),
+        "output_tokens": _sum(c[3] for c in calls.calls),
+        "error": (error or "")[:500] or None,
+    }
+    return run, steps
+
+async def record(run: dict, steps: list):
+    """Store a run; analytics must never fail a login."""
+    try:
+        return await record_agent_run(run, steps)
+    except Exception as e:
+        log.warning("agent run not recorded for %s: %r", run.get("site_id"), e)
+
+# ---------- adaptive budget ----------
+
+async def budget(site_id: str):
+    """(max_steps, timeout_s) from the p95 of recent successful runs, clamped to the env limits."""
+    try:
+        n, steps_p95, dur_p95, cut_off = await agent_run_percentiles(site_id, WINDOW)
+    except Exception as e:
+        log.warning("agent budget lookup failed for %s: %r", site_id, e)
+        n, cut_off = 0, 0
+    if not n or n < MIN_RUNS or cut_off >= ESCALATE_AFTER:
+        return MAX_STEPS, MAX_TIMEOUT_S
+    max_steps = min(MAX_STEPS, max(MIN_STEPS, math.ceil(steps_p95 * HEADROOM) + 2))
+    timeout_s = min(MAX_TIMEOUT_S, max(MIN_TIMEOUT_S, dur_p95 / 1000.0 * HEADROOM + 30))
+    return max_steps, timeout_s
+
+# ---------- report ----------
+
+async def report(site_id: str = None, days: int = 7):
+    rows = await agent_report(site_id, days)
+    for r in rows:
+        r["budget_max_steps"], r["budget_timeout_s"] = await budget(r["site_id"])
+    return rows
+
+if __name__ == "__main__":
+    site = sys.argv[1] if len(sys.argv) > 1 else None
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 7
+    print(json.dumps(asyncio.run(report(site, days)), indent=2, default=float))
@@ -0,0 +1,381 @@
+# asset_cache.py
+"""
+Shared static-asset cache for Playwright contexts.
+
+Every login starts from a fresh context, so without this each run re-downloads
+the target's JS bundles, CSS and fonts. attach()/attach_sync() install a route
+handler that serves cacheable GET responses (scripts, stylesheets, fonts,
+images) from a content-addressed store on disk, shared by every worker process
+on the host:
+
+    <ASSET_CACHE_DIR>/blobs/ab/abcdef...   body, named by sha256
+    <ASSET_CACHE_DIR>/index.db             sqlite (WAL): url -> blob, headers, validators, freshness
+
+Cache-Control/Expires decide freshness; stale entries with an ETag or
+Last-Modified are revalidated with a conditional request. Responses that are
+no-store/private, carry Set-Cookie, vary on more than Accept-Encoding, or were
+requested with an Authorization header are never stored, and cookies/storage
+stay in each login's own context. Total blob size is kept under
+ASSET_CACHE_MAX_BYTES by evicting least-recently-used URLs.
+
+The async handler does its sqlite/blob I/O through asyncio.to_thread, so a
+locked index never stalls the event loop. Hit/miss counters and last-access
+times are kept in memory and written in one transaction every
+ASSET_CACHE_FLUSH_S seconds, so a cache hit costs no write.
+"""
+import os
+import re
+import json
+import time
+import atexit
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+from email.utils import parsedate_to_datetime
+
+CACHE_DIR = Path(os.getenv("ASSET_CACHE_DIR", "/app/storage/asset_cache"))
+MAX_BYTES = int(os.getenv("ASSET_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+MAX_OBJECT_BYTES = int(os.getenv("ASSET_CACHE_MAX_OBJECT_BYTES", str(20 * 1024 * 1024)))
+# No explicit lifetime but a Last-Modified: trust it for 10% of its age, capped (RFC 9111 heuristic)
+HEURISTIC_MAX_S = 86400
+FLUSH_S = float(os.getenv("ASSET_CACHE_FLUSH_S", "5"))
+
+CACHED_TYPES = {"script", "stylesheet", "font", "image"}
+# Only these URLs are routed through Python; documents, XHR and the login POSTs never leave the browser.
+# ASSET_CACHE_HOSTS adds CDN hosts whose assets have no file extension (e.g. fonts.googleapis.com).
+_ASSET_EXT = r"\.(?:js|mjs|css|woff2?|ttf|otf|eot|png|jpe?g|gif|webp|avif|svg|ico)(?:[?#].*)?$"
+_ASSET_HOSTS = [h.strip() for h in os.getenv("ASSET_CACHE_HOSTS", "fonts.googleapis.com").split(",") if h.strip()]
+ASSET_URL = re.compile(
+    r"^https?://(?:[^/?#]+/[^?#]*" + _ASSET_EXT
+    + (r"|(?:" + "|".join(map(re.escape, _ASSET_HOSTS)) + r")(?::\d+)?/.*" if _ASSET_HOSTS else "") + r")",
+    re.I)
+# hop-by-hop / encoding headers that no longer describe the decoded body we replay
+_DROP_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection", "keep-alive", "set-cookie"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+  url TEXT PRIMARY KEY,
+  digest TEXT NOT NULL,
+  status INT NOT NULL,
+  headers TEXT NOT NULL,
+  etag TEXT,
+  last_modified TEXT,
+  expires_at REAL NOT NULL,
+  must_revalidate INT NOT NULL DEFAULT 0,
+  last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_lru ON entries(last_access);
+CREATE INDEX IF NOT EXISTS entries_digest ON entries(digest);
+CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INT NOT NULL);
+CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INT NOT NULL DEFAULT 0);
+"""
+
+def _cache_control(headers: dict) -> dict:
+    out = {}
+    for part in (headers.get("cache-control") or "").lower().split(","):
+        k, _, v = part.strip().partition("=")
+        if k:
+            out[k] = v.strip('"')
+    return out
+
+def _http_time(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def freshness(headers: dict, now: float):
+    """(storable, expires_at, must_revalidate) from response headers (lower-cased keys)."""
+    cc = _cache_control(headers)
+    if "no-store" in cc or "private" in cc or "set-cookie" in headers:
+        return False, 0.0, False
+    vary = {v.strip().lower() for v in (headers.get("vary") or "").split(",") if v.strip()}
+    if vary - {"accept-encoding"}:
+        return False, 0.0, False
+    has_validator = bool(headers.get("etag") or headers.get("last-modified"))
+    must_revalidate = "no-cache" in cc
+    for k in ("s-maxage", "max-age"):
+        if re.fullmatch(r"\d+", cc.get(k, "")):
+            age = float(headers.get("age") or 0) if re.fullmatch(r"\d+", headers.get("age") or "") else 0.0
+            return True, now + max(0.0, int(cc[k]) - age), must_revalidate
+    exp = _http_time(headers.get("expires"))
+    if exp is not None:
+        return True, exp, must_revalidate
+    lm = _http_time(headers.get("last-modified"))
+    if lm is not None:
+        date = _http_time(headers.get("date")) or now
+        return True, now + min(HEURISTIC_MAX_S, max(0.0, (date - lm) * 0.1)), must_revalidate
+    # no lifetime info: keep it only if we can revalidate
+    return has_validator, now, True
+
+class AssetCache:
+    def __init__(self, root: Path = CACHE_DIR, max_bytes: int = MAX_BYTES):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        (self.root / "blobs").mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.root / "index.db"), timeout=10, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._counters = {}                  # stats not yet written
+        self._touched = {}                   # url -> last access not yet written
+        self._flushed_at = time.monotonic()
+
+    # ---------- blobs ----------
+
+    def _blob_path(self, digest: str) -> Path:
+        return self.root / "blobs" / digest[:2] / digest
+
+    def _write_blob(self, body: bytes) -> str:
+        digest = hashlib.sha256(body).hexdigest()
+        p = self._blob_path(digest)
+        if not p.exists():
+            p.parent.mkdir(parents=True, exist_ok=True)
+            tmp = p.with_name(f"{digest}.{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp.write_bytes(body)
+            os.replace(tmp, p)                  # atomic: readers never see half a file
+        return digest
+
+    def _read_blob(self, digest: str):
+        try:
+            return self._blob_path(digest).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    # ---------- index ----------
+
+    def bump(self, **counters):
+        with self._lock:
+            for name, n in counters.items():
+                self._counters[name] = self._counters.get(name, 0) + int(n)
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if time.monotonic() - self._flushed_at >= FLUSH_S:
+            self.flush()
+
+    def flush(self):
+        """Write batched counters and last-access times."""
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            touched, self._touched = self._touched, {}
+            self._flushed_at = time.monotonic()
+            if not counters and not touched:
+                return
+            try:
+                self._db.execute("BEGIN IMMEDIATE")
+                self._db.executemany(
+                    "INSERT INTO stats(name,value) VALUES (?,?) ON CONFLICT(name) DO UPDATE SET value=value+excluded.value",
+                    counters.items())
+                self._db.executemany("UPDATE entries SET last_access=? WHERE url=?",
+                                     [(ts, url) for url, ts in touched.items()])
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                try:
+                    self._db.execute("ROLLBACK")
+                except sqlite3.Error:
+                    pass
+                # keep them for the next flush
+                for name, n in counters.items():
+                    self._counters[name] = self._counters.get(name, 0) + n
+                for url, ts in touched.items():
+                    self._touched.setdefault(url, ts)
+
+    def lookup(self, url: str):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT digest,status,headers,etag,last_modified,expires_at,must_revalidate FROM entries WHERE url=?",
+                (url,)).fetchone()
+        if not row:
+            return None
+        digest, status, headers, etag, lm, expires_at, must_revalidate = row
+        return {"url": url, "digest": digest, "status": status, "headers": json.loads(headers),
+                "etag": etag, "last_modified": lm,
+                "fresh": not must_revalidate and expires_at > time.time()}
+
+    def read(self, entry: dict):
+        body = self._read_blob(entry["digest"])
+        if body is None:                        # evicted by another process between lookup and read
+            return None
+        with self._lock:
+            self._touched[entry["url"]] = time.time()
+        return body
+
+    def store(self, url: str, status: int, headers: dict, body: bytes) -> bool:
+        now = time.time()
+        storable, expires_at, must_revalidate = freshness(headers, now)
+        if not storable or status != 200 or len(body) > MAX_OBJECT_BYTES:
+            return False
+        digest = self._write_blob(body)
+        kept = {k: v for k, v in headers.items() if k not in _DROP_HEADERS}
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute("INSERT OR IGNORE INTO blobs(digest,size) VALUES (?,?)", (digest, len(body)))
+                self._db.execute(
+                    "INSERT OR REPLACE INTO entries(url,digest,status,headers,etag,last_modified,expires_at,"
+                    "must_revalidate,last_access) VALUES (?,?,?,?,?,?,?,?,?)",
+                    (url, digest, status, json.dumps(kept), headers.get("etag"), headers.get("last-modified"),
+                     expires_at, int(must_revalidate), now))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        self.evict()
+        return True
+
+    def revalidated(self, entry: dict, headers: dict):
+        """A 304 came back: extend freshness using the new headers merged over the stored ones."""
+        merged = {**entry["headers"], **{k: v for k, v in headers.items() if k not in _DROP_HEADERS}}
+        _, expires_at, must_revalidate = freshness(merged, time.time())
+        with self._lock:
+            self._db.execute("UPDATE entries SET headers=?,expires_at=?,must_revalidate=?,last_access=? WHERE url=?",
+                             (json.dumps(merged), expires_at, int(must_revalidate), time.time(), entry["url"]))
+        entry["headers"] = merged
+
+    def evict(self):
+        with self._lock:
+            total = self._db.execute("SELECT COALESCE(SUM(size),0) FROM blobs").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                doomed = []
+                for url, digest in self._db.execute("SELECT url,digest FROM entries ORDER BY last_access").fetchall():
+                    if total <= self.max_bytes * 0.9:        # evict a little extra so we don't thrash
+                        break
+                    self._db.execute("DELETE FROM entries WHERE url=?", (url,))
+                    if not self._db.execute("SELECT 1 FROM entries WHERE digest=? LIMIT 1", (digest,)).fetchone():
+                        size = self._db.execute("SELECT size FROM blobs WHERE digest=?", (digest,)).fetchone()
+                        self._db.execute("DELETE FROM blobs WHERE digest=?", (digest,))
+                        total -= size[0] if size else 0
+                        doomed.append(digest)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        for digest in doomed:
+            try:
+                self._blob_path(digest).unlink()
+            except FileNotFoundError:
+                pass
+        self.bump(evictions=len(doomed))
+
+    # ---------- route-handler steps (one call per thread hop) ----------
+
+    def fresh_body(self, url: str):
+        """(entry, body): body only for a fresh hit, which is counted."""
+        entry = self.lookup(url)
+        if entry and entry["fresh"]:
+            body = self.read(entry)
+            if body is not None:
+                self.bump(hits=1, bytes_saved=len(body))
+                return entry, body
+        return entry, None
+
+    def revalidated_body(self, entry: dict, headers: dict):
+        """Body for a 304 on `entry` (None if its blob is gone), with freshness extended."""
+        body = self.read(entry)
+        if body is not None:
+            self.revalidated(entry, headers)
+            self.bump(revalidated=1, bytes_saved=len(body))
+        return body
+
+    def fetched(self, url: str, status: int, headers: dict, body: bytes):
+        self.bump(misses=1, bytes_fetched=len(body))
+        self.store(url, status, headers, body)
+
+    def stats(self) -> dict:
+        self.flush()
+        with self._lock:
+            out = dict(self._db.execute("SELECT name,value FROM stats").fetchall())
+            out["objects"], out["bytes_stored"] = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size),0) FROM blobs").fetchone()
+        served = out.get("hits", 0) + out.get("revalidated", 0)
+        total = served + out.get("misses", 0)
+        out["hit_rate"] = round(served / total, 3) if total else 0.0
+        return out
+
+_cache = None
+
+def get_cache() -> AssetCache:
+    global _cache
+    if _cache is None:
+        _cache = AssetCache()
+        atexit.register(_cache.flush)
+    return _cache
+
+# ---------- Playwright glue ----------
+
+def _wanted(request) -> bool:
+    return (request.method == "GET" and request.resource_type in CACHED_TYPES
+            and "authorization" not in request.headers and request.url.startswith(("http://", "https://")))
+
+def _conditional(entry) -> dict:
+    h = {}
+    if entry and entry["etag"]:
+        h["if-none-match"] = entry["etag"]
+    if entry and entry["last_modified"]:
+        h["if-modified-since"] = entry["last_modified"]
+    return h
+
+async def attach(context, cache: AssetCache | None = None):
+    """Serve static assets for an async Playwright context from the shared cache."""
+    cache = cache or get_cache()
+
+    async def _handler(route, request):
+        if not _wanted(request):
+            return await route.fallback()
+        # sqlite and blob files off the event loop: a locked index must not stall every page
+        entry, body = await asyncio.to_thread(cache.fresh_body, request.url)
+        if body is not None:
+            return await route.fulfill(status=entry["status"], headers=entry["headers"], body=body)
+        cond = _conditional(entry)
+        try:
+            resp = await route.fetch(headers={**request.headers, **cond})
+        except Exception:
+            return await route.fallback()
+        if resp.status == 304 and entry:
+            body = await asyncio.to_thread(cache.revalidated_body, entry, resp.headers)
+            if body is not None:
+                return await route.fulfill(status=entry["status"], headers=entry["headers"], body=body)
+            resp = await route.fetch()                # blob vanished: unconditional refetch
+        body = await resp.body()
+        await asyncio.to_thread(cache.fetched, request.url, resp.status, resp.headers, body)
+        await route.fulfill(response=resp, body=body)
+
+    await context.route(ASSET_URL, _handler)
+
+def attach_sync(context, cache: AssetCache | None = None):
+    """attach() for the sync Playwright API."""
+    cache = cache or get_cache()
+
+    def _handler(route, request):
+        if not _wanted(request):
+            return route.fallback()
+        entry, body = cache.fresh_body(request.url)
+        if body is not None:
+            return route.fulfill(status=entry["status"], headers=entry["headers"], body=body)
+        cond = _conditional(entry)
+        try:
+            resp = route.fetch(headers={**request.headers, **cond})
+        except Exception:
+            return route.fallback()
+        if resp.status == 304 and entry:
+            body = cache.revalidated_body(entry, resp.headers)
+            if body is not None:
+                return route.fulfill(status=entry["status"], headers=entry["headers"], body=body)
+            resp = route.fetch()
+        body = resp.body()
+        cache.fetched(request.url, resp.status, resp.headers, body)
+        route.fulfill(response=resp, body=body)
+
+    context.route(ASSET_URL, _handler)
+
+def stats() -> dict:
+    """hits / revalidated / misses / hit_rate / bytes_saved / bytes_fetched / evictions, shared by all workers."""
+    return get_cache().stats()
@@ -0,0 +1,124 @@
+# bench_form_detector.py
+"""
+Benchmark the local login-form detector against saved pages.
+
+    python bench_form_detector.py --save https://www.saucedemo.com/ https://practicetestautomation.com/practice-test-login/
+    python bench_form_detector.py                # detector only: confidence, LLM-skip rate, latency
+    python bench_form_detector.py --llm          # also time login_plan_from_html on every page
+
+Pages are snapshots of page.content() after domcontentloaded, stored in
+bench_pages/<host>.html and replayed with page.set_content (no network).
+bench_pages/labels.json marks each page as a login form or not, with the
+selectors of its identifier/password/submit elements; labeled pages are scored
+for precision (confident detections that found the right elements) and recall
+(login pages handled without the LLM).
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from urllib.parse import urlparse
+
+from playwright.sync_api import sync_playwright
+from form_detector import detect_login_form_sync, confident, MIN_CONFIDENCE
+
+PAGES_DIR = os.getenv("BENCH_PAGES_DIR", "bench_pages")
+
+def _pct(xs, q):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(q * len(xs)))] if xs else 0.0
+
+def save(urls):
+    os.makedirs(PAGES_DIR, exist_ok=True)
+    with sync_playwright() as p:
+        browser = p.chromium.launch(headless=True)
+        for url in urls:
+            page = browser.new_page()
+            page.goto(url, wait_until="domcontentloaded")
+            path = os.path.join(PAGES_DIR, (urlparse(url).hostname or "page") + ".html")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(page.content())
+            print("saved", path, "-- add it to labels.json to score it")
+            page.close()
+        browser.close()
+
+# same element for the detector's selector and the labeled one
+_SAME_JS = "([a, b]) => { const x = document.querySelector(a); return !!x && x === document.querySelector(b); }"
+
+def _correct(page, det, label) -> bool:
+    sels = det.get("selectors") or {}
+    got = {"identifier": sels.get("username") or sels.get("email"),
+           "password": sels.get("password"), "submit": sels.get("submit")}
+    return all(got[k] and page.evaluate(_SAME_JS, [got[k], label[k]]) for k in got)
+
+def _labels() -> dict:
+    path = os.path.join(PAGES_DIR, "labels.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def run(with_llm: bool, threshold: float):
+    files = sorted(f for f in os.listdir(PAGES_DIR) if f.endswith(".html")) if os.path.isdir(PAGES_DIR) else []
+    if not files:
+        sys.exit(f"no pages in {PAGES_DIR}/ -- run with --save URL... first")
+    if with_llm:
+        from llm_agent import login_plan_from_html
+
+    labels = _labels()
+    tp = fp = positives = 0
+    det_ms, llm_ms, skips = [], [], []
+    with sync_playwright() as p:
+        browser = p.chromium.launch(headless=True)
+        page = browser.new_page()
+        for name in files:
+            with open(os.path.join(PAGES_DIR, name), encoding="utf-8") as f:
+                html = f.read()
+            page.set_content(html, wait_until="domcontentloaded")
+            t0 = time.perf_counter()
+            det = detect_login_form_sync(page)
+            det_ms.append((time.perf_counter() - t0) * 1000.0)
+            ok = confident(det, threshold)
+            skips.append(ok)
+            verdict = ""
+            label = labels.get(name)
+            if label is not None:
+                right = bool(label.get("login")) and ok and _correct(page, det, label)
+                positives += bool(label.get("login"))
+                tp += right
+                fp += ok and not right
+                verdict = " ok   " if right or not (ok or label.get("login")) else " WRONG" if ok else " miss "
+            line = f"{name:40s} conf={det['confidence']:.3f} {'skip-llm' if ok else 'llm     '}{verdict} {det['selectors']}"
+            if with_llm:
+                t0 = time.perf_counter()
+                plan = login_plan_from_html(html, {"goal": "login"})
+                llm_ms.append((time.perf_counter() - t0) * 1000.0)
+                line += f"\n{'':40s} llm={plan.get('selectors')}"
+            print(line)
+        browser.close()
+
+    n, skipped = len(files), sum(skips)
+    print(f"\n{n} pages, threshold {threshold}: LLM skipped on {skipped}/{n} ({100.0 * skipped / n:.0f}%)")
+    if labels:
+        precision = tp / (tp + fp) if tp + fp else 0.0
+        recall = tp / positives if positives else 0.0
+        print(f"labeled: precision {precision:.2f} ({tp}/{tp + fp} confident detections right), "
+              f"recall {recall:.2f} ({tp}/{positives} login pages without the LLM)")
+    print(f"detector  p50={_pct(det_ms, 0.5):.1f}ms p95={_pct(det_ms, 0.95):.1f}ms")
+    if llm_ms:
+        # planning latency with the detector in front: detector always, LLM only when not confident
+        mixed = [d + (0.0 if ok else l) for d, l, ok in zip(det_ms, llm_ms, skips)]
+        print(f"llm       p50={_pct(llm_ms, 0.5):.1f}ms p95={_pct(llm_ms, 0.95):.1f}ms")
+        print(f"combined  p50={_pct(mixed, 0.5):.1f}ms p95={_pct(mixed, 0.95):.1f}ms")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--save", nargs="+", metavar="URL", help="snapshot these pages into bench_pages/")
+    ap.add_argument("--llm", action="store_true", help="also run the LLM planner for comparison")
+    ap.add_argument("--threshold", type=float, default=MIN_CONFIDENCE)
+    a = ap.parse_args()
+    if a.save:
+        save(a.save)
+    else:
+        run(a.llm, a.threshold)
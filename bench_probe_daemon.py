@@ -0,0 +1,125 @@
+# bench_probe_daemon.py
+"""
+Throughput of probe_daemon against a local keep-alive HTTP server.
+
+    python bench_probe_daemon.py [--domains 4] [--endpoints 40] [--interval 1] [--seconds 20]
+                                 [--inflight 20] [--hot-rate 10] [--server-ms 5]
+
+Every domain is its own loopback address (127.0.0.1, 127.0.0.2, ...). The first
+one is "hot": it is rate limited to --hot-rate/s, the others to far more than
+they are asked for. The run is done twice:
+
+  dispatch   rate-limit wait before the probe takes an inflight slot (current)
+  slot       the wait happens while holding a slot (how probes used to be admitted)
+
+and reports probes/s overall and for the unthrottled domains, plus latency.
+Raise --endpoints to find the single-process ceiling: once cold/s stops
+following the target, the event loop is CPU-bound.
+Nothing is written to the database and no Redis is needed.
+"""
+import time
+import asyncio
+import argparse
+
+import httpx
+
+import probe_daemon
+from probe_daemon import ProbeDaemon, Endpoint
+from probe_timing import TimedAsyncTransport, atimed_request
+
+async def _serve(reader, writer, delay_s):
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            if not head:
+                break
+            if delay_s:
+                await asyncio.sleep(delay_s)
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: 2\r\n\r\n{}")
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+class _Anonymous:
+    def auth_for(self, url, mode):
+        return {}, {}
+
+class SlotPaced(ProbeDaemon):
+    """The old placement: the rate-limit wait is taken while holding an inflight slot."""
+    async def _run_probe(self, ep, delay_s=0.0):
+        try:
+            async with self.inflight:
+                await asyncio.sleep(delay_s)
+                t0 = time.perf_counter()
+                try:
+                    r, _ = await atimed_request(self.client, ep.method, ep.url, timeout=ep.timeout_s)
+                    status = r.status_code
+                except httpx.HTTPError:
+                    status = 0
+                ms = (time.perf_counter() - t0) * 1000.0
+            self.counts["ok" if 200 <= status < 400 else "failed" if status else "errors"] += 1
+            self.results.append((ep.site_id, ep.url, status, ms))
+        finally:
+            ep.running = False
+
+def _pct(xs, q):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(q * len(xs)))] if xs else 0.0
+
+async def run(cls, a, port):
+    d = cls()
+    d.inflight = asyncio.Semaphore(a.inflight)
+    for i in range(a.domains):
+        host = f"127.0.0.{i + 1}"
+        rate = a.hot_rate if i == 0 else 1e6
+        d.pacer.limits[f"domain:{host}"] = (1.0 / rate, 0.0)
+        d.sessions[f"site-{i}"] = _Anonymous()
+        for n in range(a.endpoints):
+            ep = Endpoint(f"site-{i}", {"url": f"http://{host}:{port}/probe/{n}", "interval_s": a.interval})
+            d.endpoints[ep.key] = ep
+            d.wheel.schedule(ep, n * a.interval / a.endpoints)
+    limits = httpx.Limits(max_connections=a.inflight, max_keepalive_connections=a.inflight)
+    async with httpx.AsyncClient(transport=TimedAsyncTransport(limits=limits)) as client:
+        d.client = client
+        ticker = asyncio.create_task(d.ticker())
+        await asyncio.sleep(a.seconds)
+        ticker.cancel()
+        for t in list(d.tasks):
+            t.cancel()
+        await asyncio.gather(ticker, *d.tasks, return_exceptions=True)
+    cold = [r for r in d.results if r[0] != "site-0"]
+    return {
+        "probes_s": len(d.results) / a.seconds,
+        "cold_probes_s": len(cold) / a.seconds,
+        "cold_target_s": (a.domains - 1) * a.endpoints / a.interval,
+        "p50_ms": _pct([r[3] for r in cold], 0.5),
+        "p95_ms": _pct([r[3] for r in cold], 0.95),
+        "skipped": d.counts["skipped_overlap"],
+    }
+
+async def main(a):
+    server = await asyncio.start_server(lambda r, w: _serve(r, w, a.server_ms / 1000.0), "0.0.0.0", 0)
+    port = server.sockets[0].getsockname()[1]
+    print(f"{a.domains} domains x {a.endpoints} endpoints every {a.interval}s, {a.inflight} slots, "
+          f"hot domain limited to {a.hot_rate}/s, {a.seconds}s per run")
+    print(f"{'admission':10s} {'probes/s':>9s} {'cold/s':>8s} {'target':>7s} {'p50 ms':>7s} {'p95 ms':>7s} {'skipped':>8s}")
+    async with server:
+        for label, cls in (("dispatch", ProbeDaemon), ("slot", SlotPaced)):
+            m = await run(cls, a, port)
+            print(f"{label:10s} {m['probes_s']:9.1f} {m['cold_probes_s']:8.1f} {m['cold_target_s']:7.0f} "
+                  f"{m['p50_ms']:7.1f} {m['p95_ms']:7.1f} {m['skipped']:8d}")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--domains", type=int, default=4)
+    ap.add_argument("--endpoints", type=int, default=40, help="per domain")
+    ap.add_argument("--interval", type=float, default=1.0)
+    ap.add_argument("--seconds", type=float, default=20.0)
+    ap.add_argument("--inflight", type=int, default=20)
+    ap.add_argument("--hot-rate", type=float, default=10.0)
+    ap.add_argument("--server-ms", type=float, default=5.0)
+    a = ap.parse_args()
+    probe_daemon.RESPECT_RATE_LIMITS = True
+    asyncio.run(main(a))
@@ -0,0 +1,161 @@
+# bench_routing.py
+"""
+Simulate site-affinity routing against today's single shared "auth" queue.
+
+    python bench_routing.py [--nodes 4] [--slots 4] [--sites 200] [--tasks 20000] [--load 0.7]
+
+Sites have Zipf-distributed popularity; every node keeps an LRU of the sites it
+is warm for (browser/asset cache/plans/sessions). A warm task takes --warm-s, a
+cold one --cold-s. Reports warm-hit rate, latency, per-node imbalance, spill
+rate, how many nodes each site ends up warm on, and how many sites move when
+a node joins or leaves (ring vs plain modulo hashing).
+"""
+import heapq
+import random
+import argparse
+from collections import OrderedDict, deque
+
+from routing import HashRing, VNODES, SPILL_PER_SLOT, SPILL_CANDIDATES, _h
+
+class Node:
+    def __init__(self, name, slots, warm_size):
+        self.name, self.free = name, slots
+        self.queue = deque()
+        self.warm = OrderedDict()
+        self.warm_size = warm_size
+        self.busy_s = 0.0
+        self.sites = set()
+
+    def touch(self, site) -> bool:
+        hit = site in self.warm
+        self.warm[site] = True
+        self.warm.move_to_end(site)
+        if len(self.warm) > self.warm_size:
+            self.warm.popitem(last=False)
+        self.sites.add(site)
+        return hit
+
+def _pct(xs, q):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(q * len(xs)))] if xs else 0.0
+
+def simulate(policy, a, seed=1):
+    rnd = random.Random(seed)
+    names = [f"node-{i}" for i in range(a.nodes)]
+    nodes = {n: Node(n, a.slots, a.warm) for n in names}
+    ring = HashRing(names, VNODES)
+    shared = deque()
+
+    weights = [1.0 / (k + 1) ** a.zipf for k in range(a.sites)]
+    mean_service = a.warm_s * 0.5 + a.cold_s * 0.5
+    rate = a.load * a.nodes * a.slots / mean_service          # arrivals per second
+
+    events, t, seq = [], 0.0, 0
+    for _ in range(a.tasks):
+        t += rnd.expovariate(rate)
+        site = f"site-{rnd.choices(range(a.sites), weights)[0]}"
+        heapq.heappush(events, (t, seq, "arrive", site, None)); seq += 1
+
+    lat, hits, spills, done = [], 0, 0, 0
+
+    def start(node, now, task):
+        nonlocal seq, hits
+        arrived, site = task
+        warm = node.touch(site)
+        hits += warm
+        svc = (a.warm_s if warm else a.cold_s) * rnd.uniform(0.8, 1.2)
+        node.free -= 1
+        node.busy_s += svc
+        heapq.heappush(events, (now + svc, seq, "finish", arrived, node.name)); seq += 1
+
+    def idle_nodes():
+        return [n for n in nodes.values() if n.free > 0]
+
+    while events:
+        now, _, kind, x, y = heapq.heappop(events)
+        if kind == "arrive":
+            task = (now, x)
+            if policy == "shared":
+                free = idle_nodes()
+                if free:
+                    start(rnd.choice(free), now, task)
+                else:
+                    shared.append(task)
+                continue
+            target = None
+            for name in ring.candidates(x, 1 + SPILL_CANDIDATES):
+                n = nodes[name]
+                if len(n.queue) < SPILL_PER_SLOT * a.slots:
+                    target = n
+                    break
+            if target is None:
+                spills += 1
+                free = idle_nodes()
+                if free:
+                    start(rnd.choice(free), now, task)
+                else:
+                    shared.append(task)
+            else:
+                spills += target.name != ring.node_for(x)
+                if target.free > 0 and not target.queue:
+                    start(target, now, task)
+                else:
+                    target.queue.append(task)
+        else:
+            node = nodes[y]
+            node.free += 1
+            lat.append(now - x)
+            done += 1
+            nxt = node.queue.popleft() if node.queue else shared.popleft() if shared else None
+            if nxt:
+                start(node, now, nxt)
+
+    busy = [n.busy_s for n in nodes.values()]
+    per_site = {}
+    for n in nodes.values():
+        for s in n.sites:
+            per_site[s] = per_site.get(s, 0) + 1
+    return {
+        "warm_hit": hits / done,
+        "lat_p50_s": _pct(lat, 0.5),
+        "lat_p95_s": _pct(lat, 0.95),
+        "imbalance": max(busy) / (sum(busy) / len(busy)),
+        "spill": spills / done,
+        "nodes_per_site": sum(per_site.values()) / len(per_site),
+    }
+
+def movement(a):
+    sites = [f"site-{k}" for k in range(a.sites)]
+    names = [f"node-{i}" for i in range(a.nodes)]
+    out = {}
+    for label, after in (("join", names + [f"node-{a.nodes}"]), ("leave", names[:-1])):
+        r0, r1 = HashRing(names, VNODES), HashRing(after, VNODES)
+        ring = sum(r0.node_for(s) != r1.node_for(s) for s in sites) / len(sites)
+        mod = sum(hash_mod(s, names) != hash_mod(s, after) for s in sites) / len(sites)
+        out[label] = (ring, mod)
+    return out
+
+def hash_mod(site, names):
+    return names[_h(site) % len(names)]
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--nodes", type=int, default=4)
+    ap.add_argument("--slots", type=int, default=4)
+    ap.add_argument("--sites", type=int, default=200)
+    ap.add_argument("--tasks", type=int, default=20000)
+    ap.add_argument("--load", type=float, default=0.7, help="target utilisation")
+    ap.add_argument("--zipf", type=float, default=1.1)
+    ap.add_argument("--warm", type=int, default=20, help="sites a node stays warm for")
+    ap.add_argument("--warm-s", type=float, default=4.0)
+    ap.add_argument("--cold-s", type=float, default=12.0)
+    a = ap.parse_args()
+
+    print(f"{a.nodes} nodes x {a.slots} slots, {a.sites} sites, {a.tasks} tasks, load {a.load}")
+    print(f"{'policy':10s} {'warm-hit':>9s} {'p50 s':>7s} {'p95 s':>7s} {'imbalance':>10s} {'spill':>6s} {'nodes/site':>11s}")
+    for policy in ("shared", "affinity"):
+        m = simulate(policy, a)
+        print(f"{policy:10s} {m['warm_hit']:9.1%} {m['lat_p50_s']:7.1f} {m['lat_p95_s']:7.1f} "
+              f"{m['imbalance']:10.2f} {m['spill']:6.1%} {m['nodes_per_site']:11.2f}")
+    for label, (ring, mod) in movement(a).items():
+        print(f"sites moved on node {label}: ring {ring:.1%} vs modulo {mod:.1%}")
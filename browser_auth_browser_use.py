@@ -1,5 +1,5 @@
 # /app/browser_auth_browser_use.py
-import os, json, asyncio
+import os, json, time, asyncio
 from pathlib import Path
 from urllib.parse import urlparse
 
@@ -9,20 +9,22 @@ from browser_use.llm import (
     ChatOpenAI, ChatAnthropic, ChatGoogle, ChatGroq,
     ChatAWSBedrock, ChatAzureOpenAI
 )
+from rate_limit import alimit_llm, guard_context
+import asset_cache
+from llm_router import Router, Provider
+import agent_analytics
 
-def _make_llm():
-    provider = (os.getenv("LLM_PROVIDER", "openai") or "openai").lower()
-    # Sensible defaults per provider
-    default_models = {
-        "openai":    "gpt-4.1",                     # best perf (docs’ recommendation)
-        "google":    "gemini-2.0-flash-exp",        # low cost + fast
-        "anthropic": "claude-3-5-sonnet-20240620",
-        "groq":      "meta-llama/llama-4-maverick-17b-128e-instruct",
-        "azure":     "gpt-4.1",
-        "bedrock":   "anthropic.claude-3-5-sonnet-20240620-v1:0",
-    }
-    model = os.getenv("LLM_MODEL", default_models.get(provider, "gpt-4.1"))
+# Sensible defaults per provider
+DEFAULT_MODELS = {
+    "openai":    "gpt-4.1",                     # best perf (docs’ recommendation)
+    "google":    "gemini-2.0-flash-exp",        # low cost + fast
+    "anthropic": "claude-3-5-sonnet-20240620",
+    "groq":      "meta-llama/llama-4-maverick-17b-128e-instruct",
+    "azure":     "gpt-4.1",
+    "bedrock":   "anthropic.claude-3-5-sonnet-20240620-v1:0",
+}
 
+def _chat_model(provider: str, model: str):
     if provider == "google":
         return ChatGoogle(model=model)              # needs GOOGLE_API_KEY
     if provider == "groq":
@@ -35,6 +37,67 @@ def _make_llm():
         return ChatAWSBedrock(model=model, aws_region=os.getenv("AWS_DEFAULT_REGION","us-east-1"))
     return ChatOpenAI(model=model)                  # needs OPENAI_API_KEY
 
+def _candidates():
+    """
+    LLM_PROVIDERS="openai:gpt-4.1,google,anthropic" lists routable options (model optional).
+    Without it, the single LLM_PROVIDER/LLM_MODEL pair is used as before.
+    """
+    spec = os.getenv("LLM_PROVIDERS", "")
+    if not spec:
+        provider = (os.getenv("LLM_PROVIDER", "openai") or "openai").lower()
+        return [(provider, os.getenv("LLM_MODEL", DEFAULT_MODELS.get(provider, "gpt-4.1")))]
+    out = []
+    for item in (i.strip() for i in spec.split(",") if i.strip()):
+        provider, _, model = item.partition(":")
+        provider = provider.lower()
+        out.append((provider, model or DEFAULT_MODELS.get(provider, "gpt-4.1")))
+    return out
+
+_router = None
+
+def _get_router() -> Router:
+    # one per process so EWMA latency/error stats carry over between logins
+    global _router
+    if _router is None:
+        _router = Router([Provider(prov, model, _chat_model(prov, model)) for prov, model in _candidates()])
+    return _router
+
+class _RoutedLLM:
+    """
+    Chat model facade for browser-use: every ainvoke goes to the fastest healthy
+    provider (falling back on errors) after taking a token from its rate-limit bucket.
+    Other attributes (provider, model, name, ...) come from the provider that answered
+    the last call (the current first choice before any call), so a hedge or fallback
+    is reported under the model that actually produced the output.
+    Each successful call's latency and token usage lands in `calls` for step analytics.
+    """
+    def __init__(self, router: Router, calls: agent_analytics.CallLog = None):
+        self._router = router
+        self.calls = calls if calls is not None else agent_analytics.CallLog()
+        self.answered = None                 # Provider behind the last successful ainvoke
+
+    def __getattr__(self, name):
+        p = self.__dict__.get("answered") or self._router.ranked()[0]
+        return getattr(p.client, name)
+
+    async def ainvoke(self, *args, **kwargs):
+        async def _call(p):
+            await alimit_llm(p.name, p.model)
+            started, t0 = time.time(), time.perf_counter()
+            out = await p.client.ainvoke(*args, **kwargs)
+            self.calls.add(started, (time.perf_counter() - t0) * 1000.0, out, p.key)
+            return p, out
+        # the winner comes back with its output: two hedged calls can both finish, only one is returned
+        self.answered, out = await self._router.acall(_call)
+        return out
+
+def _make_llm(calls: agent_analytics.CallLog = None):
+    return _RoutedLLM(_get_router(), calls)
+
+def _history(agent):
+    # AgentHistoryList lives on the agent (newer browser-use) or its state (older)
+    return getattr(agent, "history", None) or getattr(getattr(agent, "state", None), "history", None)
+
 async def _login_with_browser_use(start_url: str, username: str, password: str, site_id: str):
     # Save signed-in cookies/localStorage to a file the moment the context is created
     storage_dir = Path("/app/storage")
@@ -61,8 +124,32 @@ async def _login_with_browser_use(start_url: str, username: str, password: str,
         "Do not change the password, do not sign up, then stop."
     )
 
-    agent = Agent(task=task, llm=_make_llm(), browser_session=session)
-    result = await agent.run(max_steps=30)          # keep it bounded
+    # Start the session ourselves so the rate-limit guard and shared asset cache sit on its
+    # context before the agent's first navigation (Agent.run reuses a started session)
+    await session.start()
+    if getattr(session, "browser_context", None) is not None:
+        await guard_context(session.browser_context, [parsed.hostname] if parsed.hostname else None)
+        await asset_cache.attach(session.browser_context)
+
+    # Step budget/timeout from this site's recent runs; the whole run is recorded either way
+    max_steps, timeout_s = await agent_analytics.budget(site_id)
+    calls = agent_analytics.CallLog()
+    agent = Agent(task=task, llm=_make_llm(calls), browser_session=session)
+    started = time.time()
+    try:
+        result = await asyncio.wait_for(agent.run(max_steps=max_steps), timeout_s)
+    except asyncio.TimeoutError:
+        run, steps = agent_analytics.summarize(_history(agent), calls, site_id, max_steps, timeout_s, started,
+                                               outcome="timeout", error=f"agent exceeded {timeout_s:.0f}s")
+        await agent_analytics.record(run, steps)
+        raise TimeoutError(f"browser-use login for {site_id} exceeded {timeout_s:.0f}s ({run['steps']} steps)")
+    except Exception as e:
+        run, steps = agent_analytics.summarize(_history(agent), calls, site_id, max_steps, timeout_s, started,
+                                               outcome="error", error=repr(e))
+        await agent_analytics.record(run, steps)
+        raise
+    run, steps = agent_analytics.summarize(result, calls, site_id, max_steps, timeout_s, started)
+    await agent_analytics.record(run, steps)
 
     # Ensure storage_state exists and return small summary
     if not storage_path.exists():
@@ -73,7 +160,11 @@ async def _login_with_browser_use(start_url: str, username: str, password: str,
         "ok": True,
         "storage_state_path": str(storage_path),
         "cookies": len(cookies),
-        "notes": str(result)[:500],
+        "outcome": run["outcome"],
+        "steps": run["steps"],
+        "max_steps": max_steps,
+        "llm_calls": run["llm_calls"],
+        "notes": str(getattr(result, "final_result", lambda: None)() or result)[:500],
     }
 
 def login_with_browser_use(start_url: str, username: str, password: str, site_id: str):
@@ -1,51 +1,104 @@
 from typing import Dict
+from urllib.parse import urlparse
 from playwright.async_api import async_playwright
 from llm_agent import login_plan_from_html
+from form_detector import detect_login_form, confident
+from rate_limit import guard_context
+from token_harvester import TokenHarvester
+from session_adapter import extract_token
+import asset_cache
+from captcha_pipeline import CaptchaPipeline
 import asyncio
 
-async def login_with_llm(start_url: str, credentials: Dict[str, str]) -> dict:
+async def _wait_for_signal(page, sig: dict):
+    if sig.get("type") == "url_contains" and sig.get("value"):
+        await page.wait_for_url(f"**{sig['value']}**", timeout=20000)
+    elif sig.get("type") == "dom_gone" and sig.get("value"):
+        await page.wait_for_selector(sig["value"], state="hidden", timeout=20000)
+    else:
+        await page.wait_for_load_state("networkidle")
+
+async def login_with_llm(start_url: str, credentials: Dict[str, str], site_id: str = None) -> dict:
     async with async_playwright() as p:
         browser = await p.chromium.launch(headless=True)
         context = await browser.new_context()
+        await guard_context(context, [urlparse(start_url).hostname])
+        await asset_cache.attach(context)
+        harvester = await TokenHarvester().attach(context)
+        captchas = await CaptchaPipeline(site_id or urlparse(start_url).hostname).attach(context)
         page = await context.new_page()
 
-        # 1) Open page and let LLM plan the form interaction
+        # 1) Open page and find the form: the local detector handles ordinary login
+        #    pages; otherwise the LLM plan streams in a worker thread and we start
+        #    filling as soon as its selectors have arrived.
         await page.goto(start_url, wait_until="domcontentloaded")
-        html = await page.content()
-        plan = login_plan_from_html(html, {"goal": "login", "start_url": start_url})
-        sels = plan.get("selectors", {}) or {}
-
-        # Known-good defaults for SauceDemo (demo site)
-        if "saucedemo" in start_url:
-            sels.setdefault("username", "#user-name")
-            sels.setdefault("password", "#password")
-            sels.setdefault("submit", "#login-button")
-            plan.setdefault("success_signal", {"type": "url_contains", "value": "inventory"})
-
-        # 2) Fill + submit
-        if sels.get("username") and credentials.get("username"):
-            await page.fill(sels["username"], credentials["username"])
-        if sels.get("email") and credentials.get("email"):
-            await page.fill(sels["email"], credentials["email"])
+        await captchas.scan(page)
+        det = await detect_login_form(page)
+        if confident(det):
+            sels = dict(det["selectors"])
+            # no LLM success hint: the password field going away means we got past the form
+            local = {"use": det["use"], "selectors": sels,
+                     "success_signal": {"type": "dom_gone", "value": sels["password"]}}
+            plan_task = asyncio.ensure_future(asyncio.sleep(0, local))
+        else:
+            html = await page.content()
+            loop = asyncio.get_running_loop()
+            early = loop.create_future()
+
+            def _on_selectors(s):
+                loop.call_soon_threadsafe(lambda: early.done() or early.set_result(s))
+
+            hints = {"goal": "login", "start_url": start_url, "detector": det}
+            plan_task = asyncio.ensure_future(asyncio.to_thread(login_plan_from_html, html, hints, _on_selectors))
+            await asyncio.wait({early, plan_task}, return_when=asyncio.FIRST_COMPLETED)
+            if early.done():
+                sels = dict(early.result())
+            else:
+                sels = dict(plan_task.result().get("selectors") or {})
+
+        # 2) Fill + submit (overlaps with the rest of the plan streaming in).
+        #    The field may be labeled "email" while the site only has a username configured (or vice versa).
+        for label, other in (("username", "email"), ("email", "username")):
+            value = credentials.get(label) or credentials.get(other)
+            if sels.get(label) and value:
+                await page.fill(sels[label], value)
         if sels.get("password") and credentials.get("password"):
             await page.fill(sels["password"], credentials["password"])
+
+        await captchas.before_submit(page)
+        harvester.mark()                              # tokens from page load aren't this login's
         if sels.get("submit"):
             await page.click(sels["submit"])
 
-        await page.wait_for_load_state("networkidle")
+        # success_signal/token_sources are generated after the selectors; usually landed by now
+        plan = await plan_task
+        sources = [str(x) for x in plan.get("token_sources") or []]
+        harvester.cookie_names.update(x.split(":", 1)[1] for x in sources if x.startswith("cookie:"))
 
-        # 3) Wait for "success"
-        sig = plan.get("success_signal", {})
-        if sig.get("type") == "url_contains" and sig.get("value"):
-            await page.wait_for_url(f"**{sig['value']}**", timeout=20000)
+        # 3) Wait for "success": a captured token proves the login, else the plan's signal
+        signal = asyncio.ensure_future(_wait_for_signal(page, plan.get("success_signal") or {}))
+        captured = asyncio.ensure_future(harvester.wait(20))
+        await asyncio.wait({signal, captured}, return_when=asyncio.FIRST_COMPLETED)
+        hit = captured.result() if captured.done() else harvester.first()
+        if hit:
+            signal.cancel()
+            if signal.done() and not signal.cancelled():
+                signal.exception()                    # token beats a timed-out signal; don't log it
+        else:
+            captured.cancel()
+            await signal                              # raises if the signal timed out too
 
-        # 4) Harvest cookies + (optional) localStorage tokens
+        # 4) Cookies + token. Without a capture, read localStorage once: the hooked TOKEN_KEYS
+        #    (set before the hook existed, e.g. restored state) plus keys only the plan names
         cookies = {c["name"]: c.get("value") for c in await context.cookies()}
-        ls = await page.evaluate(
-            "Object.assign({}, ...['access_token','id_token','token'].map(k=>({[k]:localStorage.getItem(k)})))"
-        )
-        token = ls.get("access_token") or ls.get("id_token") or ls.get("token") or ""
+        token = hit["token"] if hit else None
+        if not token:
+            extra = [x.split(":", 1)[1] for x in sources if x.startswith("localStorage:")]
+            keys = list(harvester.ls_keys) + [k for k in extra if k not in harvester.ls_keys]
+            ls = await page.evaluate("keys => keys.map(k => localStorage.getItem(k))", keys)
+            token = next((t for t in map(extract_token, ls) if t), None)
         kind = "bearer" if token and ('.' in token or len(token) > 20) else "cookie"
 
+        captchas.close()
         await context.close(); await browser.close()
         return {"kind": kind, "token": token or None, "cookies": cookies or {}}
@@ -0,0 +1,215 @@
+# captcha_pipeline.py
+"""
+Overlap captcha solving with form filling.
+
+A CaptchaPipeline watches a context for reCAPTCHA v2 / hCaptcha widgets: their
+network requests (recaptcha anchor ?k=<sitekey>, hcaptcha checksiteconfig
+?sitekey=<sitekey>) and, via scan(), the page's data-sitekey markup. reCAPTCHA v3
+and Enterprise load the same anchor (always size=invisible) but only score the
+visitor, so an invisible anchor alone starts nothing; invisible v2 is picked up
+from its .g-recaptcha markup, or from the network when the site config says
+"captcha": {"recaptcha": "v2"}. A 2captcha
+job is submitted on a worker thread the moment a sitekey shows up, so the
+20-120 s solve runs while the flow fills the form. before_submit() then only
+waits for whatever is left of the solve and injects the token:
+
+    captchas = await CaptchaPipeline(site_id, conf).attach(context)   # attach_sync() for the sync API
+    await page.goto(url); await captchas.scan(page)
+    ... fill ...
+    await captchas.before_submit(page)                          # no-op when no captcha was seen
+    await page.click(submit)
+    captchas.close()
+
+Without TWOCAPTCHA_API_KEY no job is created and before_submit() is a no-op, so
+flows submit as they did before the pipeline existed. A failed or late solve is
+logged and recorded, and the flow still submits.
+
+Every job lands in auth.captcha_events (solve time, time still spent blocking
+at submit); tasks.captcha_stats summarises it per site.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import captcha_solver
+from db import record_captcha_event
+
+log = logging.getLogger(__name__)
+
+WAIT_TIMEOUT_S = float(os.getenv("CAPTCHA_WAIT_TIMEOUT_S", "150"))
+
+_solvers = ThreadPoolExecutor(max_workers=int(os.getenv("CAPTCHA_WORKERS", "8")), thread_name_prefix="captcha")
+_recorder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="captcha-record")
+
+def _record(event: dict):
+    def _run():
+        try:
+            asyncio.run(record_captcha_event(**event))
+        except Exception as e:
+            log.warning("captcha event not recorded for %s: %r", event.get("site_id"), e)
+    _recorder.submit(_run)
+
+def _from_request(url: str, invisible_v2: bool = False):
+    """(kind, sitekey, invisible) from a v2 / hCaptcha widget request URL, else None."""
+    u = urlparse(url)
+    if "recaptcha" in u.path and u.path.endswith("/anchor"):
+        q = parse_qs(u.query)
+        invisible = q.get("size", [""])[0] == "invisible"
+        # v3 and Enterprise score keys look like this too: only a checkbox proves v2
+        if not q.get("k") or "/enterprise/" in u.path or (invisible and not invisible_v2):
+            return None
+        return "recaptcha", q["k"][0], invisible
+    elif "hcaptcha.com" in (u.hostname or "") and u.path.endswith("/checksiteconfig"):
+        q = parse_qs(u.query)
+        if q.get("sitekey"):
+            return "hcaptcha", q["sitekey"][0], False
+    return None
+
+class _Job:
+    def __init__(self, site_id, kind, sitekey, pageurl, invisible):
+        self.site_id, self.kind, self.sitekey, self.pageurl = site_id, kind, sitekey, pageurl
+        self.solve_ms = None
+        self.recorded = False
+        self._t0 = time.perf_counter()
+        self.future = _solvers.submit(self._run, invisible)
+
+    def _run(self, invisible):
+        try:
+            return captcha_solver.solve(self.kind, self.sitekey, self.pageurl, invisible)
+        finally:
+            self.solve_ms = (time.perf_counter() - self._t0) * 1000.0
+
+    def record(self, wait_ms=None):
+        if self.recorded:
+            return
+        self.recorded = True
+        if not self.future.done():
+            err = "not solved by submit time"
+        else:
+            err = None if self.future.exception() is None else repr(self.future.exception())
+        _record({"site_id": self.site_id, "kind": self.kind, "sitekey": self.sitekey, "pageurl": self.pageurl,
+                 "ok": err is None, "solve_ms": self.solve_ms,
+                 "wait_ms": wait_ms, "error": err and err[:500]})
+
+class CaptchaPipeline:
+    def __init__(self, site_id: str, conf: dict = None):
+        self.site_id = site_id
+        # invisible reCAPTCHA anchors are only v2 when the site config says so
+        self.invisible_v2 = ((conf or {}).get("captcha") or {}).get("recaptcha") == "v2"
+        self.jobs = {}                       # (kind, sitekey) -> _Job not yet used, newest last
+        self._lock = threading.Lock()
+
+    def submit(self, kind: str, sitekey: str, pageurl: str, invisible: bool = False):
+        """Start solving without waiting; a kind/sitekey already being solved for the next submit is reused."""
+        if not sitekey or not captcha_solver.configured():
+            return None
+        with self._lock:
+            job = self.jobs.get((kind, sitekey))
+            if job is None:
+                job = self.jobs[(kind, sitekey)] = _Job(self.site_id, kind, sitekey, pageurl, invisible)
+                log.info("captcha %s on %s: solving in background", kind, self.site_id)
+        return job
+
+    def _on_request(self, request):
+        hit = _from_request(request.url, self.invisible_v2)
+        if not hit:
+            return
+        try:
+            # the widget iframe's parent is the page the token is for
+            frame = request.frame
+            pageurl = (frame.parent_frame or frame).url
+        except Exception:
+            pageurl = request.headers.get("referer") or request.url
+        self.submit(hit[0], hit[1], pageurl, hit[2])
+
+    def _take(self):
+        # a token is good for one submit: the job leaves self.jobs so the next form
+        # with the same sitekey gets a fresh solve
+        with self._lock:
+            if not self.jobs:
+                return None
+            return self.jobs.pop(next(reversed(self.jobs)))
+
+    # ---------- async API ----------
+
+    async def attach(self, context):
+        context.on("request", self._on_request)
+        return self
+
+    async def scan(self, page):
+        """Look for widget markup now (call right after goto / opening a modal)."""
+        det = await captcha_solver.detect(page)
+        if det:
+            self.submit(det["kind"], det["sitekey"], page.url, det.get("invisible"))
+        return det
+
+    def _failed(self, job, e):
+        # the submit still goes ahead: the site may not enforce the widget, and the flow's
+        # own success check reports the failure better than an exception from here
+        log.warning("captcha %s on %s not solved, submitting without it: %r", job.kind, self.site_id, e)
+
+    async def before_submit(self, page, timeout_s: float = WAIT_TIMEOUT_S):
+        """
+        Wait out the rest of the solve and inject the token. Returns the token, or None
+        without a captcha (or when the solve failed or timed out).
+        """
+        job = self._take()
+        if job is None:
+            return None
+        t0 = time.perf_counter()
+        try:
+            token = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(job.future)), timeout_s)
+        except Exception as e:
+            self._failed(job, e)
+            return None
+        finally:
+            job.record((time.perf_counter() - t0) * 1000.0)
+        await captcha_solver.inject(page, job.kind, token)
+        return token
+
+    # ---------- sync API ----------
+
+    def attach_sync(self, context):
+        context.on("request", self._on_request)
+        return self
+
+    def scan_sync(self, page):
+        det = captcha_solver.detect_sync(page)
+        if det:
+            self.submit(det["kind"], det["sitekey"], page.url, det.get("invisible"))
+        return det
+
+    def before_submit_sync(self, page, timeout_s: float = WAIT_TIMEOUT_S):
+        job = self._take()
+        if job is None:
+            return None
+        t0 = time.perf_counter()
+        try:
+            # pump Playwright events while the solver thread works
+            deadline = time.monotonic() + timeout_s
+            while not job.future.done() and time.monotonic() < deadline:
+                page.wait_for_timeout(250)
+            token = job.future.result(timeout=0)
+        except FutureTimeout:
+            self._failed(job, TimeoutError(f"not ready after {timeout_s:.0f}s"))
+            return None
+        except Exception as e:
+            self._failed(job, e)
+            return None
+        finally:
+            job.record((time.perf_counter() - t0) * 1000.0)
+        captcha_solver.inject_sync(page, job.kind, token)
+        return token
+
+    # ---------- teardown ----------
+
+    def close(self):
+        """Record jobs the flow never waited for (once they finish)."""
+        with self._lock:
+            jobs, self.jobs = list(self.jobs.values()), {}
+        for job in jobs:
+            job.future.add_done_callback(lambda f, j=job: j.record())
@@ -1,8 +1,22 @@
 # /app/captcha_solver.py
+"""
+2captcha-backed reCAPTCHA v2 / hCaptcha / Cloudflare Turnstile solving, split into pieces so the
+solve can run while the form is being filled (see captcha_pipeline.py):
+
+    det = detect_sync(page)                    # {"kind": "recaptcha"|"hcaptcha"|"turnstile", "sitekey", "invisible"} | None
+    token = solve(det["kind"], det["sitekey"], page.url)   # blocking, 20-120 s
+    inject_sync(page, det["kind"], token)
+
+solve_recaptcha_v2 / solve_hcaptcha keep the old all-in-one behaviour.
+"""
 import os, time, requests
 
 TWO_CAPTCHA_KEY = os.getenv("TWOCAPTCHA_API_KEY")
 
+def configured() -> bool:
+    """True when a 2captcha key is set; without one nothing should be submitted."""
+    return bool(TWO_CAPTCHA_KEY)
+
 def _poll_2captcha(req_id: str):
     for _ in range(24):  # ~2 minutes
         time.sleep(5)
@@ -26,43 +40,111 @@ def _start_job(data: dict):
         raise RuntimeError(f"2captcha in error: {r}")
     return r["request"]
 
+# ---------- detect ----------
+
+# Widget markup first (present before the widget script runs), then the widget iframes.
+# Turnstile is reported as its own kind, and markup of unknown origin is not guessed at.
+# Only reCAPTCHA v2 is reported: v3 and Enterprise keys are score-based (a v3 button carries
+# data-action, its anchor iframe is always size=invisible), and a v2 token doesn't help there.
+DETECT_JS = r"""() => {
+    const t = document.querySelector('.cf-turnstile[data-sitekey]');
+    if (t) return {kind: 'turnstile', sitekey: t.getAttribute('data-sitekey'), invisible: false};
+    const h = document.querySelector('.h-captcha[data-sitekey], [data-hcaptcha-widget-id][data-sitekey]');
+    if (h) return {kind: 'hcaptcha', sitekey: h.getAttribute('data-sitekey'), invisible: h.getAttribute('data-size') === 'invisible'};
+    const enterprise = !!document.querySelector('script[src*="recaptcha/enterprise"]');
+    const g = document.querySelector('.g-recaptcha[data-sitekey]:not([data-action])');
+    if (g && !enterprise) return {kind: 'recaptcha', sitekey: g.getAttribute('data-sitekey'), invisible: g.getAttribute('data-size') === 'invisible'};
+    for (const f of document.querySelectorAll('iframe[src*="recaptcha"], iframe[src*="hcaptcha"]')) {
+        try {
+            const u = new URL(f.src);
+            if (f.src.includes('hcaptcha')) {
+                const k = new URLSearchParams(u.hash.slice(1)).get('sitekey') || u.searchParams.get('sitekey');
+                if (k) return {kind: 'hcaptcha', sitekey: k, invisible: false};
+            } else if (u.searchParams.get('k') && u.searchParams.get('size') !== 'invisible' && !u.pathname.includes('/enterprise/')) {
+                return {kind: 'recaptcha', sitekey: u.searchParams.get('k'), invisible: false};
+            }
+        } catch (e) {}
+    }
+    // other [data-sitekey] markup: only trust it when the page loads exactly one widget script
+    const any = document.querySelector('[data-sitekey]');
+    if (any) {
+        const src = s => !!document.querySelector(`script[src*="${s}"]`);
+        const kinds = [];
+        if (src('challenges.cloudflare.com/turnstile')) kinds.push('turnstile');
+        if (src('hcaptcha.com')) kinds.push('hcaptcha');
+        // api.js?render=<sitekey> is v3; render=explicit is v2 rendered from script
+        const v3 = Array.from(document.scripts).some(s => /recaptcha\/api\.js\?.*render=(?!explicit\b)/.test(s.src));
+        if (src('recaptcha/api.js') && !v3 && !enterprise && !any.hasAttribute('data-action')) kinds.push('recaptcha');
+        if (kinds.length === 1)
+            return {kind: kinds[0], sitekey: any.getAttribute('data-sitekey'), invisible: any.getAttribute('data-size') === 'invisible'};
+    }
+    return null;
+}"""
+
+def detect_sync(page):
+    return page.evaluate(DETECT_JS)
+
+async def detect(page):
+    return await page.evaluate(DETECT_JS)
+
+# ---------- solve ----------
+
+def solve(kind: str, sitekey: str, pageurl: str, invisible: bool = False) -> str:
+    """Submit to 2captcha and block until the token is ready."""
+    if kind == "hcaptcha":
+        data = {"method": "hcaptcha", "sitekey": sitekey, "pageurl": pageurl}
+    elif kind == "turnstile":
+        data = {"method": "turnstile", "sitekey": sitekey, "pageurl": pageurl}
+    else:
+        data = {"method": "userrecaptcha", "googlekey": sitekey, "pageurl": pageurl}
+        if invisible:
+            data["invisible"] = 1
+    return _poll_2captcha(_start_job(data))
+
+# ---------- inject ----------
+
+# Fill the response field(s) and fire the widget's data-callback, if any
+INJECT_JS = """([kind, tok]) => {
+    const name = {hcaptcha: 'h-captcha-response', turnstile: 'cf-turnstile-response'}[kind] || 'g-recaptcha-response';
+    const widget = {hcaptcha: '.h-captcha', turnstile: '.cf-turnstile'}[kind] || '.g-recaptcha';
+    let areas = Array.from(document.querySelectorAll(`textarea[name="${name}"], input[name="${name}"], #${name}`));
+    if (!areas.length) {
+        const ta = document.createElement(kind === 'turnstile' ? 'input' : 'textarea');
+        if (kind === 'turnstile') ta.type = 'hidden';
+        ta.id = name; ta.name = name; ta.style.display = 'none';
+        (document.querySelector('form') || document.body).appendChild(ta);
+        areas = [ta];
+    }
+    for (const ta of areas) {
+        ta.value = tok;
+        ta.dispatchEvent(new Event('input', {bubbles: true}));
+        ta.dispatchEvent(new Event('change', {bubbles: true}));
+    }
+    const w = document.querySelector(`${widget}[data-callback]`);
+    const cb = w && window[w.getAttribute('data-callback')];
+    if (typeof cb === 'function') { try { cb(tok); } catch (e) {} }
+}"""
+
+def inject_sync(page, kind: str, token: str):
+    page.evaluate(INJECT_JS, [kind, token])
+
+async def inject(page, kind: str, token: str):
+    await page.evaluate(INJECT_JS, [kind, token])
+
+# ---------- all-in-one (detect, wait for the solve, inject) ----------
+
 def solve_recaptcha_v2(page, pageurl: str):
-    # Try get sitekey from DOM or iframe URL
-    sitekey = page.eval_on_selector('div.g-recaptcha', 'e => e?.getAttribute("data-sitekey")') \
-          or page.eval_on_selector('iframe[src*="recaptcha"]', 'e => new URL(e.src).searchParams.get("k")')
-    if not sitekey:
+    det = detect_sync(page)
+    if not det or det["kind"] != "recaptcha":
         return False, None
-    req_id = _start_job({"method": "userrecaptcha", "googlekey": sitekey, "pageurl": pageurl})
-    token = _poll_2captcha(req_id)
-    page.evaluate("""(tok) => {
-        let ta = document.getElementById('g-recaptcha-response');
-        if(!ta){
-          ta = document.createElement('textarea');
-        ta.id = 'g-recaptcha-response';
-        ta.name = 'g-recaptcha-response';
-        ta.style.display = 'none';
-        document.body.appendChild(ta);
-        }
-        ta.value = tok;
-        ta.dispatchEvent(new Event('input', {bubbles:true}));
-        ta.dispatchEvent(new Event('change', {bubbles:true}));
-    }""", token)
+    token = solve("recaptcha", det["sitekey"], pageurl, det.get("invisible"))
+    inject_sync(page, "recaptcha", token)
     return True, token
 
 def solve_hcaptcha(page, pageurl: str):
-    sitekey = page.eval_on_selector('[data-sitekey]', 'e => e?.getAttribute("data-sitekey")')
-    if not sitekey:
+    det = detect_sync(page)
+    if not det or det["kind"] != "hcaptcha":
         return False, None
-    req_id = _start_job({"method": "hcaptcha", "sitekey": sitekey, "pageurl": pageurl})
-    token = _poll_2captcha(req_id)
-    page.evaluate("""(tok) => {
-        let ta = document.querySelector('textarea[name="h-captcha-response"]');
-        if(!ta){
-          ta = document.createElement('textarea');
-          ta.name = 'h-captcha-response';
-          ta.style.display = 'none';
-          document.body.appendChild(ta);
-        }
-        ta.value = tok;
-    }""", token)
+    token = solve("hcaptcha", det["sitekey"], pageurl)
+    inject_sync(page, "hcaptcha", token)
     return True, token
@@ -1,10 +1,21 @@
 import os
 from celery import Celery
+import routing
 
 app = Celery(
     "llm_auth_agent",
     broker=os.getenv("CELERY_BROKER_URL", "redis://redis:6379/0"),
     backend=os.getenv("CELERY_RESULT_BACKEND", "redis://redis:6379/1"),
 )
-app.conf.task_routes = {"tasks.*": {"queue": "auth"}}
-app.conf.imports = ("tasks_signup_minimal",)
\ No newline at end of file
+# Site-scoped tasks go to the owning node's auth.node.<id> queue (see routing.py); the rest to "auth"
+app.conf.task_routes = (routing.route_task, {"tasks.*": {"queue": "auth"}})
+app.conf.imports = ("tasks_signup_minimal", "tasks_pool")
+
+# Periodic upkeep (needs `celery -A tasks beat`): account pools (leases also trigger refills when
+# low) and http_api tokens (cached in Redis and shared by every worker process, so only near-expiry
+# sites actually log in, whichever prefork child picks the task up).
+app.conf.beat_schedule = {
+    "refill-account-pools": {"task": "tasks.refill_all_account_pools", "schedule": 300.0},
+    "refresh-http-api-tokens": {"task": "tasks.refresh_http_api_tokens", "schedule": 60.0},
+    "rebalance-routing": {"task": "tasks.rebalance_routing", "schedule": 60.0},
+}
\ No newline at end of file
@@ -8,10 +8,83 @@ async def get_conn():
 async def upsert_credentials(site_id, username, password):
     async with await get_conn() as con:
         await con.execute(
-            "INSERT INTO auth.credentials(site_id,username,password) VALUES (%s,%s,%s)",
+            "INSERT INTO auth.credentials(site_id,username,password) VALUES (%s,%s,%s) "
+            "ON CONFLICT (site_id, username) WHERE duplicate_of IS NULL DO UPDATE SET password=EXCLUDED.password",
             (site_id, username, password)
         )
 
+# ---------- account pool ----------
+
+async def insert_pool_account(site_id, username, password, email=None):
+    """Add a freshly provisioned account as 'available'. Returns its id, or None on a duplicate username."""
+    async with await get_conn() as con:
+        cur = await con.execute(
+            "INSERT INTO auth.credentials(site_id,username,password,email,status) "
+            "VALUES (%s,%s,%s,%s,'available') ON CONFLICT (site_id, username) WHERE duplicate_of IS NULL DO NOTHING RETURNING id",
+            (site_id, username, password, email)
+        )
+        row = await cur.fetchone()
+        return row[0] if row else None
+
+async def count_available_accounts(site_id):
+    """Accounts that can be leased right now (available, or leased with an expired lease)."""
+    async with await get_conn() as con:
+        cur = await con.execute(
+            "SELECT count(*) FROM auth.credentials WHERE site_id=%s AND (status='available' "
+            "OR (status='leased' AND lease_expires_at < now()))",
+            (site_id,)
+        )
+        return (await cur.fetchone())[0]
+
+async def lease_account(site_id, holder, lease_token, ttl_s):
+    """
+    Atomically lease one account. Expired leases are reclaimed; SKIP LOCKED keeps
+    concurrent leasers from blocking on (or double-leasing) the same row.
+    """
+    async with await get_conn() as con:
+        cur = await con.execute(
+            """
+            UPDATE auth.credentials
+               SET status='leased', leased_by=%s, lease_token=%s,
+                   lease_expires_at=now() + make_interval(secs => %s),
+                   lease_count=lease_count + 1
+             WHERE id = (
+                   SELECT id FROM auth.credentials
+                    WHERE site_id=%s AND (status='available'
+                          OR (status='leased' AND lease_expires_at < now()))
+                    ORDER BY lease_count, id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED)
+            RETURNING id, username, password, email, lease_expires_at
+            """,
+            (holder, lease_token, float(ttl_s), site_id)
+        )
+        row = await cur.fetchone()
+        if not row:
+            return None
+        acc_id, username, password, email, expires_at = row
+        return {"id": acc_id, "username": username, "password": password, "email": email,
+                "lease_token": lease_token, "lease_expires_at": expires_at}
+
+async def renew_lease(account_id, lease_token, ttl_s):
+    async with await get_conn() as con:
+        cur = await con.execute(
+            "UPDATE auth.credentials SET lease_expires_at=now() + make_interval(secs => %s) "
+            "WHERE id=%s AND lease_token=%s AND status='leased'",
+            (float(ttl_s), account_id, lease_token)
+        )
+        return cur.rowcount == 1
+
+async def release_account(account_id, lease_token, retire=False):
+    """Return a leased account to the pool (or retire it, e.g. when it got locked out)."""
+    async with await get_conn() as con:
+        cur = await con.execute(
+            "UPDATE auth.credentials SET status=%s, leased_by=NULL, lease_token=NULL, lease_expires_at=NULL "
+            "WHERE id=%s AND lease_token=%s",
+            ("retired" if retire else "available", account_id, lease_token)
+        )
+        return cur.rowcount == 1
+
 async def insert_token(site_id, kind, token, cookies, expires_at):
     async with await get_conn() as con:
         await con.execute(
@@ -19,21 +92,211 @@ async def insert_token(site_id, kind, token, cookies, expires_at):
             (site_id, kind, token, json.dumps(cookies or {}), expires_at)
         )
 
+async def insert_token_if_changed(site_id, kind, token, cookies, expires_at):
+    """Insert a token row unless the site's newest row already holds this token; True if a row was written."""
+    async with await get_conn() as con:
+        cur = await con.execute(
+            """
+            INSERT INTO auth.tokens(site_id,kind,token,cookies,expires_at)
+            SELECT %s,%s,%s,%s::jsonb,%s
+            WHERE NOT EXISTS (
+              SELECT 1 FROM (SELECT kind, token FROM auth.tokens WHERE site_id=%s ORDER BY id DESC LIMIT 1) t
+              WHERE t.kind=%s AND t.token IS NOT DISTINCT FROM %s
+            )
+            """,
+            (site_id, kind, token, json.dumps(cookies or {}), expires_at, site_id, kind, token)
+        )
+        return cur.rowcount == 1
+
 async def latest_token(site_id):
     async with await get_conn() as con:
         cur = await con.execute(
-            "SELECT kind, token, cookies FROM auth.tokens WHERE site_id=%s ORDER BY id DESC LIMIT 1",
+            "SELECT id, kind, token, cookies FROM auth.tokens WHERE site_id=%s ORDER BY id DESC LIMIT 1",
             (site_id,)
         )
         row = await cur.fetchone()
         if not row:
             return None
-        kind, token, cookies = row
-        return {"kind": kind, "token": token, "cookies": cookies}
+        token_id, kind, token, cookies = row
+        return {"id": token_id, "kind": kind, "token": token, "cookies": cookies}
 
-async def record_telemetry(site_id, endpoint, status, latency_ms):
+async def latest_token_version(site_id):
+    """id of the newest token row (None if none) -- lets callers skip re-fetching large storage_state bodies."""
+    async with await get_conn() as con:
+        cur = await con.execute(
+            "SELECT id FROM auth.tokens WHERE site_id=%s ORDER BY id DESC LIMIT 1",
+            (site_id,)
+        )
+        row = await cur.fetchone()
+        return row[0] if row else None
+
+async def token_by_id(token_id):
+    async with await get_conn() as con:
+        cur = await con.execute(
+            "SELECT id, kind, token, cookies FROM auth.tokens WHERE id=%s",
+            (token_id,)
+        )
+        row = await cur.fetchone()
+        if not row:
+            return None
+        token_id, kind, token, cookies = row
+        return {"id": token_id, "kind": kind, "token": token, "cookies": cookies}
+
+_TELEMETRY_COLS = "site_id,endpoint,status,latency_ms,dns_ms,connect_ms,tls_ms,ttfb_ms,transfer_ms,reused,bytes"
+_PHASES = ("dns_ms", "connect_ms", "tls_ms", "ttfb_ms", "transfer_ms", "reused", "bytes")
+
+async def record_telemetry(site_id, endpoint, status, latency_ms, phases=None):
+    phases = phases or {}
+    async with await get_conn() as con:
+        await con.execute(
+            f"INSERT INTO auth.telemetry({_TELEMETRY_COLS}) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)",
+            (site_id, endpoint, status, latency_ms, *(phases.get(k) for k in _PHASES))
+        )
+
+async def record_telemetry_many(rows):
+    """
+    Bulk insert in one pipelined round-trip. Rows are (site_id, endpoint, status, latency_ms)
+    optionally followed by the phase columns in _PHASES order.
+    """
+    if not rows:
+        return
+    width = 4 + len(_PHASES)
+    async with await get_conn() as con:
+        async with con.cursor() as cur:
+            await cur.executemany(
+                f"INSERT INTO auth.telemetry({_TELEMETRY_COLS}) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)",
+                [tuple(r) + (None,) * (width - len(r)) for r in rows]
+            )
+
+# Same columns as the auth.telemetry_rollup view; the window goes on raw created_at so
+# telemetry_site_time_idx (or the BRIN index, for all sites) bounds the scan.
+_ROLLUP_SQL = (
+    "SELECT site_id, endpoint, date_trunc('hour', created_at) AS hour, count(*) AS probes, "
+    "count(*) FILTER (WHERE status = 0 OR status >= 400) AS failures, "
+    "percentile_cont(0.5) WITHIN GROUP (ORDER BY latency_ms) AS latency_p50_ms, "
+    "percentile_cont(0.95) WITHIN GROUP (ORDER BY latency_ms) AS latency_p95_ms, "
+    "percentile_cont(0.5) WITHIN GROUP (ORDER BY ttfb_ms) AS ttfb_p50_ms, "
+    "percentile_cont(0.95) WITHIN GROUP (ORDER BY ttfb_ms) AS ttfb_p95_ms, "
+    "avg(transfer_ms) AS transfer_avg_ms, avg(dns_ms) AS dns_avg_ms, avg(connect_ms) AS connect_avg_ms, "
+    "avg(tls_ms) AS tls_avg_ms, "
+    "avg(CASE WHEN reused THEN 1.0 ELSE 0.0 END) FILTER (WHERE reused IS NOT NULL) AS reuse_ratio, "
+    "avg(bytes) AS bytes_avg "
+    "FROM auth.telemetry WHERE created_at >= date_trunc('hour', now() - make_interval(hours => %s)) {site} "
+    "GROUP BY site_id, endpoint, date_trunc('hour', created_at) ORDER BY hour DESC, site_id, endpoint"
+)
+
+async def telemetry_rollup(site_id=None, hours=24):
+    """Hourly telemetry_rollup rows for the last `hours` (whole hours), newest first."""
+    async with await get_conn() as con:
+        if site_id is None:
+            cur = await con.execute(_ROLLUP_SQL.format(site=""), (int(hours),))
+        else:
+            cur = await con.execute(_ROLLUP_SQL.format(site="AND site_id = %s"), (int(hours), site_id))
+        names = [d.name for d in cur.description]
+        return [dict(zip(names, row)) for row in await cur.fetchall()]
+
+# ---------- browser-use agent runs ----------
+
+_RUN_COLS = ("site_id", "outcome", "steps", "max_steps", "timeout_s", "duration_ms",
+             "llm_calls", "llm_ms", "input_tokens", "output_tokens", "error")
+_STEP_COLS = ("step", "actions", "url", "duration_ms", "llm_calls", "llm_ms",
+              "input_tokens", "output_tokens", "repeated", "error")
+
+async def record_agent_run(run: dict, steps: list):
+    """Insert one agent run and its steps in a single transaction. Returns the run id."""
+    async with await get_conn() as con:
+        async with con.transaction():
+            cur = await con.execute(
+                f"INSERT INTO auth.agent_runs({','.join(_RUN_COLS)}) "
+                f"VALUES ({','.join(['%s'] * len(_RUN_COLS))}) RETURNING id",
+                tuple(run.get(k) for k in _RUN_COLS)
+            )
+            run_id = (await cur.fetchone())[0]
+            if steps:
+                async with con.cursor() as c:
+                    await c.executemany(
+                        f"INSERT INTO auth.agent_steps(run_id,{','.join(_STEP_COLS)}) "
+                        f"VALUES (%s,{','.join(['%s'] * len(_STEP_COLS))})",
+                        [(run_id, *(s.get(k) for k in _STEP_COLS)) for s in steps]
+                    )
+            return run_id
+
+async def agent_run_percentiles(site_id, last_n=50, q=0.95):
+    """(runs, steps_pq, duration_ms_pq, cut_off) over the site's last successful runs;
+    cut_off counts max_steps/timeout runs since the latest success."""
+    async with await get_conn() as con:
+        cur = await con.execute(
+            "SELECT count(*), percentile_cont(%s) WITHIN GROUP (ORDER BY steps), "
+            "percentile_cont(%s) WITHIN GROUP (ORDER BY duration_ms), "
+            "(SELECT count(*) FROM auth.agent_runs c WHERE c.site_id=%s AND c.outcome IN ('max_steps','timeout') "
+            "   AND c.created_at > coalesce((SELECT max(created_at) FROM auth.agent_runs "
+            "                                WHERE site_id=%s AND outcome='success'), '-infinity')) "
+            "FROM ("
+            "  SELECT steps, duration_ms FROM auth.agent_runs WHERE site_id=%s AND outcome='success' "
+            "  ORDER BY created_at DESC LIMIT %s) r",
+            (q, q, site_id, site_id, site_id, int(last_n))
+        )
+        return await cur.fetchone()
+
+async def agent_report(site_id=None, days=7):
+    """Per-site run summary plus the most expensive actions, over the last `days`."""
+    async with await get_conn() as con:
+        cur = await con.execute(
+            "SELECT site_id, count(*) AS runs, "
+            "avg(CASE WHEN outcome='success' THEN 1.0 ELSE 0.0 END) AS success_rate, "
+            "count(*) FILTER (WHERE outcome IN ('max_steps','timeout')) AS cut_off, "
+            "percentile_cont(0.5) WITHIN GROUP (ORDER BY steps) AS steps_p50, "
+            "percentile_cont(0.95) WITHIN GROUP (ORDER BY steps) AS steps_p95, "
+            "percentile_cont(0.5) WITHIN GROUP (ORDER BY duration_ms) AS duration_p50_ms, "
+            "percentile_cont(0.95) WITHIN GROUP (ORDER BY duration_ms) AS duration_p95_ms, "
+            "avg(llm_calls) AS llm_calls_avg, avg(llm_ms / NULLIF(duration_ms, 0)) AS llm_time_share, "
+            "avg(input_tokens) AS input_tokens_avg, avg(output_tokens) AS output_tokens_avg "
+            "FROM auth.agent_runs WHERE created_at >= now() - make_interval(days => %s) "
+            "AND (%s::text IS NULL OR site_id = %s) GROUP BY site_id ORDER BY site_id",
+            (int(days), site_id, site_id)
+        )
+        names = [d.name for d in cur.description]
+        sites = {r[0]: dict(zip(names, r)) for r in await cur.fetchall()}
+
+        cur = await con.execute(
+            "SELECT r.site_id, a.action, count(*) AS steps, avg(s.duration_ms) AS duration_avg_ms, "
+            "avg(s.llm_ms) AS llm_avg_ms, count(*) FILTER (WHERE s.repeated) AS repeated, "
+            "count(*) FILTER (WHERE s.error IS NOT NULL) AS errors "
+            "FROM auth.agent_steps s JOIN auth.agent_runs r ON r.id = s.run_id "
+            "CROSS JOIN LATERAL unnest(coalesce(s.actions, '{}')) AS a(action) "
+            "WHERE r.created_at >= now() - make_interval(days => %s) "
+            "AND (%s::text IS NULL OR r.site_id = %s) "
+            "GROUP BY r.site_id, a.action ORDER BY r.site_id, sum(s.duration_ms) DESC",
+            (int(days), site_id, site_id)
+        )
+        names = [d.name for d in cur.description]
+        for r in await cur.fetchall():
+            row = dict(zip(names, r))
+            sites.get(row.pop("site_id"), {}).setdefault("actions", []).append(row)
+        return list(sites.values())
+
+# ---------- captchas ----------
+
+async def record_captcha_event(site_id, kind, sitekey, pageurl, ok, solve_ms, wait_ms=None, error=None):
     async with await get_conn() as con:
         await con.execute(
-            "INSERT INTO auth.telemetry(site_id,endpoint,status,latency_ms) VALUES (%s,%s,%s,%s)",
-            (site_id, endpoint, status, latency_ms)
+            "INSERT INTO auth.captcha_events(site_id,kind,sitekey,pageurl,ok,solve_ms,wait_ms,error) "
+            "VALUES (%s,%s,%s,%s,%s,%s,%s,%s)",
+            (site_id, kind, sitekey, pageurl, ok, solve_ms, wait_ms, error)
+        )
+
+async def captcha_stats(site_id=None, days=7):
+    """Per site/kind: occurrences, solve rate, p50/p95 solve time and how long flows still blocked."""
+    async with await get_conn() as con:
+        cur = await con.execute(
+            "SELECT site_id, kind, count(*) AS occurrences, "
+            "avg(CASE WHEN ok THEN 1.0 ELSE 0.0 END) AS solve_rate, "
+            "percentile_cont(0.5) WITHIN GROUP (ORDER BY solve_ms) AS solve_p50_ms, "
+            "percentile_cont(0.95) WITHIN GROUP (ORDER BY solve_ms) AS solve_p95_ms, "
+            "avg(wait_ms) AS wait_avg_ms, avg(solve_ms - wait_ms) AS overlapped_avg_ms "
+            "FROM auth.captcha_events WHERE created_at >= now() - make_interval(days => %s) "
+            "AND (%s::text IS NULL OR site_id = %s) GROUP BY site_id, kind ORDER BY site_id, kind",
+            (int(days), site_id, site_id)
         )
+        names = [d.name for d in cur.description]
+        return [dict(zip(names, row)) for row in await cur.fetchall()]
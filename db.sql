@@ -8,6 +8,29 @@ CREATE TABLE IF NOT EXISTS auth.credentials (
   created_at TIMESTAMPTZ DEFAULT now()
 );
 
+-- Account pool: pre-provisioned accounts leased to consumers with a TTL.
+-- status: 'static' (from site config) | 'available' | 'leased' | 'retired'
+ALTER TABLE auth.credentials ADD COLUMN IF NOT EXISTS email TEXT;
+ALTER TABLE auth.credentials ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'static';
+ALTER TABLE auth.credentials ADD COLUMN IF NOT EXISTS leased_by TEXT;
+ALTER TABLE auth.credentials ADD COLUMN IF NOT EXISTS lease_token TEXT;
+ALTER TABLE auth.credentials ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ;
+ALTER TABLE auth.credentials ADD COLUMN IF NOT EXISTS lease_count INT NOT NULL DEFAULT 0;
+
+-- Older rows sharing (site_id, username) with a newer one are marked, not deleted: they
+-- point at the row that supersedes them and are retired, so nothing leases them. Review
+-- them with `SELECT * FROM auth.credentials WHERE duplicate_of IS NOT NULL`.
+ALTER TABLE auth.credentials ADD COLUMN IF NOT EXISTS duplicate_of BIGINT;
+UPDATE auth.credentials a
+   SET duplicate_of = b.id, status = 'retired'
+  FROM (SELECT site_id, username, max(id) AS id FROM auth.credentials
+         WHERE duplicate_of IS NULL GROUP BY site_id, username HAVING count(*) > 1) b
+ WHERE a.site_id = b.site_id AND a.username = b.username AND a.id < b.id AND a.duplicate_of IS NULL;
+CREATE UNIQUE INDEX IF NOT EXISTS credentials_site_username_uq
+  ON auth.credentials(site_id, username) WHERE duplicate_of IS NULL;
+CREATE INDEX IF NOT EXISTS credentials_pool_idx
+  ON auth.credentials(site_id, status, lease_expires_at);
+
 CREATE TABLE IF NOT EXISTS auth.tokens (
   id BIGSERIAL PRIMARY KEY,
   site_id TEXT NOT NULL,
@@ -18,6 +41,9 @@ CREATE TABLE IF NOT EXISTS auth.tokens (
   created_at TIMESTAMPTZ DEFAULT now()
 );
 
+-- newest-token lookups (probes check the version on every call)
+CREATE INDEX IF NOT EXISTS tokens_site_id_idx ON auth.tokens(site_id, id DESC);
+
 CREATE TABLE IF NOT EXISTS auth.telemetry (
   id BIGSERIAL PRIMARY KEY,
   site_id TEXT NOT NULL,
@@ -26,3 +52,91 @@ CREATE TABLE IF NOT EXISTS auth.telemetry (
   latency_ms DOUBLE PRECISION,
   created_at TIMESTAMPTZ DEFAULT now()
 );
+
+-- Connection-phase breakdown per probe (NULL dns/connect/tls = pooled connection reused)
+ALTER TABLE auth.telemetry ADD COLUMN IF NOT EXISTS dns_ms DOUBLE PRECISION;
+ALTER TABLE auth.telemetry ADD COLUMN IF NOT EXISTS connect_ms DOUBLE PRECISION;
+ALTER TABLE auth.telemetry ADD COLUMN IF NOT EXISTS tls_ms DOUBLE PRECISION;
+ALTER TABLE auth.telemetry ADD COLUMN IF NOT EXISTS ttfb_ms DOUBLE PRECISION;
+ALTER TABLE auth.telemetry ADD COLUMN IF NOT EXISTS transfer_ms DOUBLE PRECISION;
+ALTER TABLE auth.telemetry ADD COLUMN IF NOT EXISTS reused BOOLEAN;
+ALTER TABLE auth.telemetry ADD COLUMN IF NOT EXISTS bytes BIGINT;
+
+CREATE INDEX IF NOT EXISTS telemetry_site_time_idx ON auth.telemetry(site_id, created_at);
+-- all-sites time windows; rows arrive in created_at order, so a BRIN index stays tiny
+CREATE INDEX IF NOT EXISTS telemetry_time_brin ON auth.telemetry USING brin(created_at);
+
+-- Hourly rollup: ttfb is the target site, dns/connect/tls are our connection overhead.
+-- For ad-hoc use: a filter on `hour` can't use the indexes, so db.telemetry_rollup
+-- runs the same query with the window on raw created_at.
+CREATE OR REPLACE VIEW auth.telemetry_rollup AS
+SELECT
+  site_id,
+  endpoint,
+  date_trunc('hour', created_at) AS hour,
+  count(*) AS probes,
+  count(*) FILTER (WHERE status = 0 OR status >= 400) AS failures,
+  percentile_cont(0.5) WITHIN GROUP (ORDER BY latency_ms) AS latency_p50_ms,
+  percentile_cont(0.95) WITHIN GROUP (ORDER BY latency_ms) AS latency_p95_ms,
+  percentile_cont(0.5) WITHIN GROUP (ORDER BY ttfb_ms) AS ttfb_p50_ms,
+  percentile_cont(0.95) WITHIN GROUP (ORDER BY ttfb_ms) AS ttfb_p95_ms,
+  avg(transfer_ms) AS transfer_avg_ms,
+  avg(dns_ms) AS dns_avg_ms,
+  avg(connect_ms) AS connect_avg_ms,
+  avg(tls_ms) AS tls_avg_ms,
+  avg(CASE WHEN reused THEN 1.0 ELSE 0.0 END) FILTER (WHERE reused IS NOT NULL) AS reuse_ratio,
+  avg(bytes) AS bytes_avg
+FROM auth.telemetry
+GROUP BY site_id, endpoint, date_trunc('hour', created_at);
+
+-- browser-use agent runs and their steps (one row per AgentHistory item)
+CREATE TABLE IF NOT EXISTS auth.agent_runs (
+  id BIGSERIAL PRIMARY KEY,
+  site_id TEXT NOT NULL,
+  outcome TEXT NOT NULL,     -- 'success' | 'failed' | 'max_steps' | 'timeout' | 'error'
+  steps INT NOT NULL,
+  max_steps INT,
+  timeout_s DOUBLE PRECISION,
+  duration_ms DOUBLE PRECISION,
+  llm_calls INT,
+  llm_ms DOUBLE PRECISION,
+  input_tokens BIGINT,
+  output_tokens BIGINT,
+  error TEXT,
+  created_at TIMESTAMPTZ DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS agent_runs_site_time_idx ON auth.agent_runs(site_id, created_at DESC);
+
+CREATE TABLE IF NOT EXISTS auth.agent_steps (
+  id BIGSERIAL PRIMARY KEY,
+  run_id BIGINT NOT NULL REFERENCES auth.agent_runs(id) ON DELETE CASCADE,
+  step INT NOT NULL,
+  actions TEXT[],            -- action names, e.g. {input_text,input_text,click_element_by_index}
+  url TEXT,
+  duration_ms DOUBLE PRECISION,
+  llm_calls INT,
+  llm_ms DOUBLE PRECISION,
+  input_tokens BIGINT,
+  output_tokens BIGINT,
+  repeated BOOLEAN,          -- same actions on the same URL as the previous step (looping)
+  error TEXT
+);
+
+CREATE INDEX IF NOT EXISTS agent_steps_run_idx ON auth.agent_steps(run_id, step);
+
+-- captchas met during browser flows: one row per solve job
+CREATE TABLE IF NOT EXISTS auth.captcha_events (
+  id BIGSERIAL PRIMARY KEY,
+  site_id TEXT NOT NULL,
+  kind TEXT NOT NULL,        -- 'recaptcha' | 'hcaptcha'
+  sitekey TEXT,
+  pageurl TEXT,
+  ok BOOLEAN NOT NULL,
+  solve_ms DOUBLE PRECISION, -- job submitted -> token ready
+  wait_ms DOUBLE PRECISION,  -- time the flow still blocked at submit (NULL: never needed)
+  error TEXT,
+  created_at TIMESTAMPTZ DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS captcha_events_site_time_idx ON auth.captcha_events(site_id, created_at DESC);
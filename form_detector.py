@@ -0,0 +1,141 @@
+# form_detector.py
+"""
+Local, scoring-based login form detection -- lets login_with_llm skip the LLM
+on ordinary login pages.
+
+One page.evaluate() call ranks every visible input/button:
+  - password: type=password, autocomplete=current-password (new-password is a signup form)
+  - identifier: autocomplete username/email, type=email, and name/id/placeholder/
+    aria-label/<label> text matching user|login|email|account; bonus for sharing
+    a form with the password field and sitting right before it in DOM order
+  - submit: submit buttons whose text reads log in/sign in/continue, in the same
+    form and after the password field; "sign up"/"register" is penalised
+and returns unique CSS selectors plus a 0..1 confidence:
+
+    det = await detect_login_form(page)
+    # {"selectors": {"username"|"email", "password", "submit"}, "use": ..., "confidence": 0.93, "scores": {...}}
+"""
+import os
+
+MIN_CONFIDENCE = float(os.getenv("FORM_DETECT_MIN_CONFIDENCE", "0.75"))
+
+_JS = r"""
+() => {
+  const RX_ID = /user(name)?|login|e-?mail|account|phone|ident/i;
+  const RX_EMAIL = /e-?mail/i;
+  const RX_BAD = /search|newsletter|subscribe|captcha|coupon|promo|otp|code/i;
+  const RX_SUBMIT = /^\s*(log\s*-?in|sign\s*-?in|continue|submit|next|enter)\b/i;
+  const RX_SIGNUP = /sign\s*-?up|register|create|join|forgot/i;
+
+  const visible = el => {
+    const r = el.getBoundingClientRect();
+    const cs = getComputedStyle(el);
+    return r.width > 0 && r.height > 0 && cs.visibility !== 'hidden' && cs.display !== 'none' && !el.disabled;
+  };
+  const labelText = el => {
+    const parts = [el.name, el.id, el.placeholder, el.getAttribute('aria-label'), el.getAttribute('autocomplete')];
+    if (el.id) document.querySelectorAll(`label[for="${CSS.escape(el.id)}"]`).forEach(l => parts.push(l.textContent));
+    const wrap = el.closest('label'); if (wrap) parts.push(wrap.textContent);
+    const lb = el.getAttribute('aria-labelledby');
+    if (lb) lb.split(/\s+/).forEach(id => { const n = document.getElementById(id); if (n) parts.push(n.textContent); });
+    return parts.filter(Boolean).join(' ');
+  };
+  const unique = sel => { try { return document.querySelectorAll(sel).length === 1; } catch (e) { return false; } };
+  const selectorFor = el => {
+    const tag = el.tagName.toLowerCase();
+    if (el.id && unique('#' + CSS.escape(el.id))) return '#' + CSS.escape(el.id);
+    for (const a of ['data-testid', 'data-test', 'data-qa', 'name']) {
+      const v = el.getAttribute(a);
+      if (v) { const s = `${tag}[${a}="${CSS.escape(v)}"]`; if (unique(s)) return s; }
+    }
+    if (el.type) { const s = `${tag}[type="${el.type}"]`; if (unique(s)) return s; }
+    const path = [];
+    for (let n = el; n && n.nodeType === 1 && n !== document.documentElement; n = n.parentElement) {
+      if (n.id && unique('#' + CSS.escape(n.id))) { path.unshift('#' + CSS.escape(n.id)); break; }
+      let i = 1; for (let s = n.previousElementSibling; s; s = s.previousElementSibling) if (s.tagName === n.tagName) i++;
+      path.unshift(`${n.tagName.toLowerCase()}:nth-of-type(${i})`);
+    }
+    return path.join(' > ');
+  };
+
+  const all = Array.from(document.querySelectorAll('input, button, [role="button"], a.btn')).filter(visible);
+  const order = new Map(all.map((el, i) => [el, i]));
+
+  // 1) password
+  const pwds = all.filter(el => el.tagName === 'INPUT' && el.type === 'password').map(el => {
+    const ac = (el.getAttribute('autocomplete') || '').toLowerCase();
+    let s = 3;
+    if (ac.includes('current-password')) s += 3;
+    if (ac.includes('new-password')) s -= 3;
+    if (/confirm|repeat|again|new/i.test(labelText(el))) s -= 2;
+    return {el, s};
+  }).sort((a, b) => b.s - a.s);
+  const pw = pwds[0];
+  const form = pw ? pw.el.form || pw.el.closest('form, [role="form"], .modal, dialog') : null;
+  const pwIdx = pw ? order.get(pw.el) : -1;
+
+  // 2) identifier
+  const ids = all.filter(el => el.tagName === 'INPUT' && ['text', 'email', 'tel'].includes(el.type)).map(el => {
+    const t = labelText(el), ac = (el.getAttribute('autocomplete') || '').toLowerCase();
+    let s = 0;
+    if (ac === 'username' || ac.endsWith(' username')) s += 4;
+    if (ac === 'email' || ac.endsWith(' email')) s += 3;
+    if (el.type === 'email') s += 2;
+    if (RX_ID.test(t)) s += 2;
+    if (RX_BAD.test(t)) s -= 3;
+    if (pw) {
+      if (form && form.contains(el)) s += 3;
+      const d = pwIdx - order.get(el);
+      if (d === 1) s += 2; else if (d > 0 && d <= 3) s += 1; else if (d < 0) s -= 1;
+    }
+    return {el, s, email: el.type === 'email' || ac.includes('email') || (RX_EMAIL.test(t) && !/user/i.test(t))};
+  }).sort((a, b) => b.s - a.s);
+  const id = ids[0];
+
+  // 3) submit
+  const btnText = el => (el.innerText || el.value || el.getAttribute('aria-label') || '').trim();
+  const subs = all.filter(el => el.tagName === 'BUTTON' || (el.tagName === 'INPUT' && ['submit', 'button', 'image'].includes(el.type))
+                                 || el.getAttribute('role') === 'button' || el.tagName === 'A').map(el => {
+    const t = btnText(el);
+    let s = 0;
+    if (el.type === 'submit') s += 2;
+    if (RX_SUBMIT.test(t)) s += 3;
+    if (RX_SIGNUP.test(t)) s -= 3;
+    if (form && form.contains(el)) s += 3;
+    if (pw && order.get(el) > pwIdx) s += 1;
+    return {el, s};
+  }).sort((a, b) => b.s - a.s);
+  const sub = subs[0];
+
+  // confidence: a password field is required; then how clearly each winner beats the runner-up
+  const clamp = x => Math.max(0, Math.min(1, x));
+  const margin = (arr, full) => arr.length ? clamp(arr[0].s / full) * (arr.length > 1 && arr[1].s === arr[0].s ? 0.6 : 1) : 0;
+  let confidence = 0;
+  if (pw) {
+    confidence = 0.35 * clamp(pw.s / 3) + 0.35 * margin(ids, 7) + 0.3 * margin(subs, 8);
+    if (pwds.length > 1 && pwds[1].s >= pw.s) confidence *= 0.5;     // two equal password fields: signup/change form
+  }
+  const selectors = {};
+  if (pw) selectors.password = selectorFor(pw.el);
+  if (id && id.s > 0) selectors[id.email ? 'email' : 'username'] = selectorFor(id.el);
+  if (sub && sub.s > 0) selectors.submit = selectorFor(sub.el);
+  return {
+    selectors,
+    use: id && id.email ? 'email_password' : 'username_password',
+    confidence: Math.round(confidence * 1000) / 1000,
+    scores: {password: pw ? pw.s : null, identifier: id ? id.s : null, submit: sub ? sub.s : null},
+  };
+}
+"""
+
+async def detect_login_form(page) -> dict:
+    """Score the page's inputs/buttons in-page; see module docstring for the result shape."""
+    return await page.evaluate(_JS)
+
+def detect_login_form_sync(page) -> dict:
+    return page.evaluate(_JS)
+
+def confident(det: dict, threshold: float = MIN_CONFIDENCE) -> bool:
+    sels = det.get("selectors") or {}
+    return det.get("confidence", 0) >= threshold and "password" in sels and "submit" in sels \
+        and ("username" in sels or "email" in sels)
@@ -1,28 +1,195 @@
+# http_auth.py
+"""
+HTTP API login for "strategy": "http_api" sites.
+
+- one pooled keep-alive requests.Session per host (no TCP/TLS setup per login)
+- payload templates compiled once per site config (keyed like the token
+  cache); rendering is a walk over prebuilt closures
+- tokens cached until their derived expiry (response expires_in, JWT exp,
+  payload expiresInMins, else HTTP_TOKEN_DEFAULT_TTL_S) minus a refresh margin,
+  in Redis so every worker process shares them, with an in-process copy in front
+- login_many() logs in to many sites concurrently
+
+    from http_auth import login_and_get_token, login_many
+    login_and_get_token(conf)                      # {"kind": "bearer", "token", "expires_at", "cached"}
+    login_many({"dummyjson": conf, ...})           # {site_id: result | {"error": ...}}
+"""
+import os
+import json
+import time
+import base64
+import hashlib
+import threading
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
+from rate_limit import limit_url
+from redis_conn import get_redis
+
+POOL_SIZE = int(os.getenv("HTTP_AUTH_POOL_SIZE", "16"))
+DEFAULT_TTL_S = float(os.getenv("HTTP_TOKEN_DEFAULT_TTL_S", "300"))
+REFRESH_MARGIN = float(os.getenv("HTTP_TOKEN_REFRESH_MARGIN", "0.1"))   # refresh at 90% of lifetime
+BATCH_WORKERS = int(os.getenv("HTTP_AUTH_BATCH_WORKERS", "16"))
+
+_lock = threading.Lock()
+_sessions = {}                     # "scheme://host:port" -> requests.Session
+_templates = {}                    # cache key -> compiled payload renderer
+_tokens = {}                       # cache key -> (result dict, refresh_at epoch); Redis holds the shared copy
+_inflight = {}                     # cache key -> Lock, so concurrent callers share one login
 
 def _ptr(doc, pointer):
     cur = doc
     for p in [p for p in pointer.split("/") if p]:
-        cur = cur[p]
+        cur = cur[int(p)] if isinstance(cur, list) else cur[p]
     return cur
 
+# ---------- payload templates ----------
+
+def _compile(node):
+    """Build a renderer for one payload node; constants are returned as-is (never mutated)."""
+    if isinstance(node, dict):
+        items = [(k, _compile(v)) for k, v in node.items()]
+        return lambda s: {k: f(s) for k, f in items}
+    if isinstance(node, list):
+        parts = [_compile(v) for v in node]
+        return lambda s: [f(s) for f in parts]
+    if isinstance(node, str) and node.startswith("{{") and node.endswith("}}"):
+        key = node[2:-2]
+        return lambda s: s.get(key, node)
+    return lambda s: node
+
+def compile_payload(payload):
+    key = json.dumps(payload, sort_keys=True)
+    fn = _templates.get(key)
+    if fn is None:
+        fn = _templates[key] = _compile(payload)
+    return fn
+
 def _fill(payload, secrets):
     # recursively replace "{{key}}" -> secrets[key]
-    if isinstance(payload, dict):
-        return {k: _fill(v, secrets) for k, v in payload.items()}
-    if isinstance(payload, list):
-        return [_fill(v, secrets) for v in payload]
-    if isinstance(payload, str) and payload.startswith("{{") and payload.endswith("}}"):
-        key = payload[2:-2]
-        return secrets.get(key, payload)
-    return payload
-
-def login_and_get_token(conf):
+    return compile_payload(payload)(secrets)
+
+# ---------- connection pool ----------
+
+def _session_for(url: str) -> requests.Session:
+    u = urlparse(url)
+    key = f"{u.scheme}://{u.netloc}"
+    s = _sessions.get(key)
+    if s is None:
+        with _lock:
+            s = _sessions.get(key)
+            if s is None:
+                s = requests.Session()
+                s.mount(key, HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE))
+                _sessions[key] = s
+    return s
+
+# ---------- expiry ----------
+
+def _jwt_exp(token: str):
+    try:
+        seg = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(seg + "=" * (-len(seg) % 4)))
+        return float(claims["exp"])
+    except Exception:
+        return None
+
+def _lifetime_s(body: dict, token: str, payload: dict, login: dict):
+    """Seconds until the token expires, best source first."""
+    for k in ("expires_in", "expiresIn"):
+        if isinstance(body.get(k), (int, float)):
+            return float(body[k])
+    exp = _jwt_exp(token) if isinstance(token, str) else None
+    if exp:
+        return exp - time.time()
+    if isinstance(payload, dict) and isinstance(payload.get("expiresInMins"), (int, float)):
+        return payload["expiresInMins"] * 60.0
+    return float(login.get("token_ttl_s", DEFAULT_TTL_S))
+
+def _cache_key(conf) -> str:
+    auth = conf["auth"]
+    raw = json.dumps([auth["login"], auth.get("secrets", {})], sort_keys=True)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+# ---------- login ----------
+
+def _renderer(key: str, conf):
+    fn = _templates.get(key)
+    if fn is None:
+        fn = _templates[key] = _compile(conf["auth"]["login"]["payload"])
+    return fn
+
+def _login(conf, render):
     login = conf["auth"]["login"]
-    payload = _fill(login["payload"], conf["auth"].get("secrets", {}))
-    r = requests.request(login.get("method","POST"), login["url"], json=payload, timeout=20)
+    payload = render(conf["auth"].get("secrets", {}))
+    limit_url(login["url"])
+    r = _session_for(login["url"]).request(login.get("method","POST"), login["url"], json=payload, timeout=20)
     if r.status_code >= 400:
         raise requests.HTTPError(f"{r.status_code} {r.reason} body: {r.text[:400]}", response=r)
     body = r.json()
     token = _ptr(body, login.get("token_json_pointer","/accessToken"))
-    return {"kind":"bearer","token": token}
\ No newline at end of file
+    lifetime = max(0.0, _lifetime_s(body, token, payload, login))
+    expires_at = datetime.fromtimestamp(time.time() + lifetime, tz=timezone.utc)
+    return {"kind":"bearer","token": token, "expires_at": expires_at}, lifetime
+
+# ---------- token cache ----------
+
+def _cached(key: str):
+    """Result dict still before its refresh time: this process first, then the shared Redis copy."""
+    hit = _tokens.get(key)
+    if hit and time.time() < hit[1]:
+        return hit[0]
+    try:
+        raw = get_redis().get(f"http_auth:token:{key}")
+    except Exception:
+        return None                            # Redis down: log in rather than fail
+    if not raw:
+        return None
+    d = json.loads(raw)
+    out = {"kind": d["kind"], "token": d["token"], "expires_at": datetime.fromisoformat(d["expires_at"])}
+    _tokens[key] = (out, d["refresh_at"])
+    return out
+
+def _remember(key: str, out: dict, refresh_at: float):
+    _tokens[key] = (out, refresh_at)
+    ttl_ms = int((refresh_at - time.time()) * 1000)
+    if ttl_ms <= 0:
+        return
+    try:
+        get_redis().set(f"http_auth:token:{key}", json.dumps(
+            {**out, "expires_at": out["expires_at"].isoformat(), "refresh_at": refresh_at}), px=ttl_ms)
+    except Exception:
+        pass
+
+def login_and_get_token(conf, force: bool = False):
+    """Bearer token for an http_api site; served from cache until close to expiry unless force=True."""
+    key = _cache_key(conf)
+    hit = None if force else _cached(key)
+    if hit:
+        return {**hit, "cached": True}
+    with _lock:
+        gate = _inflight.setdefault(key, threading.Lock())
+    with gate:
+        hit = None if force else _cached(key)  # someone else may have logged in while we waited
+        if hit:
+            return {**hit, "cached": True}
+        out, lifetime = _login(conf, _renderer(key, conf))
+        _remember(key, out, time.time() + lifetime * (1 - REFRESH_MARGIN))
+        return {**out, "cached": False}
+
+def login_many(confs: dict, force: bool = False, max_workers: int = BATCH_WORKERS) -> dict:
+    """Log in to many http_api sites concurrently: {site_id: result} or {site_id: {"error": ...}}."""
+    def one(item):
+        site_id, conf = item
+        try:
+            return site_id, login_and_get_token(conf, force)
+        except Exception as e:
+            return site_id, {"error": repr(e)}
+
+    if not confs:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(confs))) as ex:
+        return dict(ex.map(one, confs.items()))
@@ -1,37 +1,256 @@
-import os, json
+import os, json, time, threading
 from openai import OpenAI
+from rate_limit import limit_llm
+from llm_router import Router, Provider
+from redis_conn import get_redis
 
-_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-_MODEL = os.getenv("LLM_MODEL", "gpt-4o-mini")
+# OpenAI-compatible endpoints we can plan with: provider -> (base_url, api key env, default model)
+_ENDPOINTS = {
+    "openai": (None, "OPENAI_API_KEY", os.getenv("LLM_MODEL", "gpt-4o-mini")),
+    "groq":   ("https://api.groq.com/openai/v1", "GROQ_API_KEY", "llama-3.3-70b-versatile"),
+    "google": ("https://generativelanguage.googleapis.com/v1beta/openai/", "GOOGLE_API_KEY", "gemini-2.0-flash"),
+}
+# Providers whose endpoint accepts response_format=json_schema; the rest get json_object.
+# LLM_JSON_SCHEMA_PROVIDERS overrides, e.g. "openai,groq" when using a groq model that supports it.
+_JSON_SCHEMA = {n.strip().lower() for n in os.getenv("LLM_JSON_SCHEMA_PROVIDERS", "openai,google").split(",") if n.strip()}
 
-def login_plan_from_html(html: str, hints: dict) -> dict:
+def _providers():
+    """
+    LLM_PROVIDERS="openai:gpt-4o-mini,groq" picks candidates (model optional);
+    default is every endpoint above whose API key is set, falling back to openai.
+    """
+    spec = os.getenv("LLM_PROVIDERS", "")
+    if spec:
+        wanted = [item.strip().split(":", 1) for item in spec.split(",") if item.strip()]
+    else:
+        wanted = [[name] for name, (_, key_env, _) in _ENDPOINTS.items() if os.getenv(key_env)] or [["openai"]]
+    out = []
+    for item in wanted:
+        name = item[0].lower()
+        if name not in _ENDPOINTS:
+            continue                                  # e.g. anthropic/bedrock: browser-use only
+        base_url, key_env, default_model = _ENDPOINTS[name]
+        client = OpenAI(api_key=os.getenv(key_env), base_url=base_url)
+        out.append(Provider(name, item[1] if len(item) > 1 else default_model, client))
+    return out
+
+_router = Router(_providers(), hedge_after_s=float(os.getenv("LLM_HEDGE_AFTER_S", "4")))
+
+def router_stats() -> dict:
+    return _router.snapshot()
+
+_MAX_RETRIES = int(os.getenv("PLAN_MAX_RETRIES", "1"))
+
+_NULLABLE = {"type": ["string", "null"]}
+# Property order matters: models emit keys in schema order, so selectors arrive first
+PLAN_SCHEMA = {
+    "type": "object",
+    "additionalProperties": False,
+    "required": ["selectors", "use", "success_signal", "token_sources"],
+    "properties": {
+        "selectors": {
+            "type": "object",
+            "additionalProperties": False,
+            "required": ["username", "email", "password", "submit"],
+            "properties": {"username": _NULLABLE, "email": _NULLABLE, "password": _NULLABLE, "submit": _NULLABLE},
+        },
+        "use": {"type": "string", "enum": ["username_password", "email_password"]},
+        "success_signal": {
+            "type": "object",
+            "additionalProperties": False,
+            "required": ["type", "value"],
+            "properties": {"type": {"type": "string", "enum": ["url_contains", "dom_exists"]},
+                           "value": {"type": "string"}},
+        },
+        "token_sources": {"type": "array", "items": {"type": "string"}},
+    },
+}
+_RESPONSE_FORMAT = {"type": "json_schema", "json_schema": {"name": "login_plan", "strict": True, "schema": PLAN_SCHEMA}}
+
+_DEFAULT_PLAN = {
+    "selectors": {},
+    "use": "username_password",
+    "success_signal": {"type": "url_contains", "value": "success"},
+    "token_sources": ["cookie:session"],
+}
+
+class PlanParseError(ValueError):
+    pass
+
+class _SelectorsWatcher:
+    """
+    Incremental scan of a streamed JSON object: tracks string/escape state and
+    depth, and fires `callback(selectors)` as soon as the top-level "selectors"
+    object closes -- long before the rest of the plan has been generated.
+    """
+    def __init__(self, callback):
+        self.callback = callback
+        self.buf = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_str = self.escape = False
+        self.str_start = None
+        self.last_str = None
+        self.key = None
+        self.obj_start = None
+        self.fired = False
+
+    def feed(self, chunk: str):
+        if self.fired or not chunk:
+            return
+        self.buf += chunk
+        buf = self.buf
+        for i in range(self.pos, len(buf)):
+            ch = buf[i]
+            if self.in_str:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_str = False
+                    if self.depth == 1:
+                        self.last_str = buf[self.str_start:i]
+            elif ch == '"':
+                self.in_str, self.str_start = True, i + 1
+            elif ch == ":" and self.depth == 1:
+                self.key = self.last_str
+            elif ch in "{[":
+                if ch == "{" and self.depth == 1 and self.key == "selectors":
+                    self.obj_start = i
+                self.depth += 1
+            elif ch in "}]":
+                self.depth -= 1
+                if self.depth == 1 and self.obj_start is not None:
+                    try:
+                        sels = json.loads(buf[self.obj_start:i + 1])
+                    except ValueError:
+                        sels = None
+                    self.obj_start = None
+                    if isinstance(sels, dict):
+                        self.fired = True
+                        self.callback(sels)
+                        return
+        self.pos = len(buf)
+
+def _parse_plan(txt: str) -> dict:
+    """Strict JSON first; then salvage the outermost {...} if the model wrapped it in prose/fences."""
+    try:
+        plan = json.loads(txt)
+    except ValueError:
+        start, end = txt.find("{"), txt.rfind("}")
+        if start < 0 or end <= start:
+            raise PlanParseError("no JSON object in completion")
+        try:
+            plan = json.loads(txt[start:end + 1])
+        except ValueError as e:
+            raise PlanParseError(str(e))
+    if not isinstance(plan, dict) or not isinstance(plan.get("selectors"), dict):
+        raise PlanParseError("plan has no selectors object")
+    plan["selectors"] = {k: v for k, v in plan["selectors"].items() if v}
+    return plan
+
+def _bump(p: Provider, **counters):
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for name, n in counters.items():
+            if isinstance(n, float):
+                pipe.hincrbyfloat("llm:plan:stats", f"{p.key}|{name}", n)
+            else:
+                pipe.hincrby("llm:plan:stats", f"{p.key}|{name}", n)
+        pipe.execute()
+    except Exception:
+        pass
+
+def plan_stats() -> dict:
+    """{provider:model: {calls, parse_failures, retries, fallbacks, ...}} plus derived rates."""
+    out = {}
+    for field, val in get_redis().hgetall("llm:plan:stats").items():
+        key, metric = field.rsplit("|", 1)
+        out.setdefault(key, {})[metric] = float(val)
+    for v in out.values():
+        calls = v.get("calls", 0)
+        v["parse_failure_rate"] = round(v.get("parse_failures", 0) / calls, 3) if calls else 0.0
+        v["retry_rate"] = round(v.get("retries", 0) / calls, 3) if calls else 0.0
+        v["avg_selectors_ms"] = round(v.get("selectors_ms", 0) / v["selectors_seen"], 1) if v.get("selectors_seen") else None
+    return out
+
+def _stream(p: Provider, messages: list, on_selectors) -> dict:
+    """One streamed, schema-constrained completion on provider p; returns the parsed plan."""
+    limit_llm(p.name, p.model)
+    t0 = time.perf_counter()
+    watcher = _SelectorsWatcher(on_selectors)
+    fmt = _RESPONSE_FORMAT if p.name in _JSON_SCHEMA else {"type": "json_object"}
+    stream = p.client.chat.completions.create(model=p.model, temperature=0, messages=messages,
+                                              response_format=fmt, stream=True)
+    parts = []
+    for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            parts.append(delta)
+            if not watcher.fired:
+                watcher.feed(delta)
+                if watcher.fired:
+                    _bump(p, selectors_seen=1, selectors_ms=(time.perf_counter() - t0) * 1000.0)
+    _bump(p, calls=1, total_ms=(time.perf_counter() - t0) * 1000.0)
+    try:
+        return _parse_plan("".join(parts).strip())
+    except PlanParseError:
+        _bump(p, parse_failures=1)
+        raise
+
+def login_plan_from_html(html: str, hints: dict, on_selectors=None) -> dict:
     """
     Ask an LLM to parse a login page and return selectors + a success signal.
-    Returns a small JSON-ish dict. Falls back to sane defaults if parsing fails.
+
+    Output is schema-constrained and streamed: `on_selectors(selectors)` is
+    called (at most once, possibly from a worker thread) as soon as the
+    selectors object has arrived, so callers can start filling the form while
+    the rest of the plan is generated. Parse failures are retried up to
+    PLAN_MAX_RETRIES times before falling back to sane defaults.
     """
     sys = (
         "You analyze a login page HTML and return ONLY compact JSON with:\n"
-        "selectors: {username?, email?, password?, submit}\n"
+        "selectors: {username, email, password, submit} (CSS selectors, null if absent)\n"
         "use: \"username_password\" or \"email_password\"\n"
         "success_signal: {type: url_contains|dom_exists, value: string}\n"
         "token_sources: e.g. ['cookie:session','localStorage:access_token']\n"
         "No prose."
     )
     user = f"HINTS={json.dumps(hints)}\nHTML_START\n{html}\nHTML_END"
+    messages = [{"role":"system","content":sys},{"role":"user","content":user}]
 
-    res = _client.chat.completions.create(
-        model=_MODEL,
-        temperature=0,
-        messages=[{"role":"system","content":sys},{"role":"user","content":user}],
-    )
-    txt = res.choices[0].message.content.strip()
-    try:
-        return json.loads(txt)
-    except Exception:
-        # In case the model responds with non-JSON
-        return {
-            "selectors": {},
-            "use": "username_password",
-            "success_signal": {"type": "url_contains", "value": "success"},
-            "token_sources": ["cookie:session"],
-        }
+    # hedged attempts may both stream selectors; only the first one reaches the caller
+    once = threading.Lock()
+    fired = []
+
+    def _first(sels):
+        with once:
+            if fired:
+                return
+            fired.append(True)
+        if on_selectors:
+            on_selectors({k: v for k, v in sels.items() if v})
+
+    for attempt in range(_MAX_RETRIES + 1):
+        used = []
+        msgs = messages if not attempt else messages + [
+            {"role": "system", "content": "Your previous answer was not valid JSON. Return only the JSON object."}]
+
+        def _call(p):
+            used.append(p)
+            if attempt:
+                _bump(p, retries=1)
+            return _stream(p, msgs, _first)
+
+        try:
+            # fastest healthy provider; hedge to the next one if it is slow, fall back on errors.
+            # An unparseable answer is counted in plan_stats, not against the provider's health.
+            return _router.call(_call, hedge=True, neutral=(PlanParseError,))
+        except Exception as e:
+            if not any(isinstance(err, PlanParseError) for _, err in getattr(e, "errors", [])):
+                raise
+    for p in used[:1]:
+        _bump(p, fallbacks=1)
+    # In case the model keeps responding with non-JSON
+    return json.loads(json.dumps(_DEFAULT_PLAN))
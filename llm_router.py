@@ -0,0 +1,254 @@
+# llm_router.py
+"""
+Latency-aware LLM provider selection with fallback and optional hedging.
+
+A Router holds an ordered list of Provider options (provider + model + client)
+and per-option EWMA latency / error rate. Each call goes to the fastest healthy
+option; on error it falls through to the next one. With hedge=True a second
+option is started if the first hasn't answered after `hedge_after_s`, and the
+first successful answer wins. Exceptions listed in `neutral` still fall
+through to the next option but say nothing about the provider's health (e.g.
+an answer that arrived fine but didn't parse).
+
+    router = Router([Provider("openai", "gpt-4o-mini", client), ...], hedge_after_s=4)
+    text = router.call(lambda p: complete(p, messages), hedge=True)      # sync (threads)
+    out = await router.acall(lambda p: p.client.ainvoke(msgs))           # asyncio
+
+Stats are per process; every worker learns its own view. `python llm_router.py`
+runs a simulation with local stub providers.
+"""
+import time
+import random
+import asyncio
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+log = logging.getLogger(__name__)
+
+# Shared by every sync Router: hedged calls need a second thread, and a losing
+# call keeps running to completion (threads can't be cancelled) so its latency
+# still feeds the EWMA.
+_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix="llm-router")
+
+class AllProvidersFailed(RuntimeError):
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("; ".join(f"{p.key}: {e!r}" for p, e in errors) or "no providers configured")
+
+class Provider:
+    """One routable option. `client` is whatever the call function needs (SDK client, chat model, stub)."""
+    def __init__(self, name: str, model: str, client=None):
+        self.name, self.model, self.client = name, model, client
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}:{self.model}"
+
+    def __repr__(self):
+        return f"Provider({self.key})"
+
+class _Stats:
+    __slots__ = ("latency", "error", "calls", "failures", "streak", "cooldown_until")
+
+    def __init__(self):
+        self.latency = None          # EWMA seconds, None until the first success
+        self.error = 0.0             # EWMA of 0/1 outcomes
+        self.calls = 0
+        self.failures = 0
+        self.streak = 0              # consecutive failures
+        self.cooldown_until = 0.0
+
+class Router:
+    def __init__(self, providers, alpha: float = 0.3, hedge_after_s: float | None = None,
+                 prior_latency_s: float = 3.0, fail_threshold: int = 3, cooldown_s: float = 30.0,
+                 error_weight: float = 4.0):
+        self.providers = list(providers)
+        self.alpha = alpha
+        self.hedge_after_s = hedge_after_s or None
+        self.prior_latency_s = prior_latency_s
+        self.fail_threshold = fail_threshold
+        self.cooldown_s = cooldown_s
+        self.error_weight = error_weight
+        self._stats = {p.key: _Stats() for p in self.providers}
+        self._lock = threading.Lock()
+
+    # ---------- bookkeeping ----------
+
+    def record(self, p: Provider, latency_s: float, ok: bool):
+        with self._lock:
+            s = self._stats[p.key]
+            s.calls += 1
+            s.error = self.alpha * (0.0 if ok else 1.0) + (1 - self.alpha) * s.error
+            if ok:
+                s.streak = 0
+                s.latency = latency_s if s.latency is None else self.alpha * latency_s + (1 - self.alpha) * s.latency
+            else:
+                s.failures += 1
+                s.streak += 1
+                if s.streak >= self.fail_threshold:
+                    s.cooldown_until = time.monotonic() + self.cooldown_s
+
+    def _score(self, p: Provider) -> tuple:
+        s = self._stats[p.key]
+        healthy = time.monotonic() >= s.cooldown_until
+        latency = self.prior_latency_s if s.latency is None else s.latency
+        return (not healthy, latency * (1 + self.error_weight * s.error))
+
+    def ranked(self) -> list:
+        """Healthy options first, fastest (error-penalised EWMA) first; config order breaks ties."""
+        with self._lock:
+            return sorted(self.providers, key=self._score)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            return {
+                k: {"ewma_latency_ms": None if s.latency is None else round(s.latency * 1000, 1),
+                    "error_rate": round(s.error, 3), "calls": s.calls, "failures": s.failures,
+                    "cooling_down": now < s.cooldown_until}
+                for k, s in self._stats.items()
+            }
+
+    # ---------- sync ----------
+
+    def _timed(self, p: Provider, fn, neutral=()):
+        t0 = time.perf_counter()
+        try:
+            out = fn(p)
+        except neutral:
+            raise
+        except Exception:
+            self.record(p, time.perf_counter() - t0, False)
+            raise
+        self.record(p, time.perf_counter() - t0, True)
+        return out
+
+    def call(self, fn, hedge: bool = False, neutral: tuple = ()):
+        """Run fn(provider) on the best option, hedging/falling back as configured."""
+        order = self.ranked()
+        hedge_after = self.hedge_after_s if hedge else None
+        pending, errors, nxt = {}, [], 0
+
+        def launch():
+            nonlocal nxt
+            p = order[nxt]
+            nxt += 1
+            pending[_POOL.submit(self._timed, p, fn, neutral)] = p
+
+        if order:
+            launch()
+        hedged = False
+        while pending:
+            can_hedge = hedge_after and not hedged and nxt < len(order)
+            done, _ = wait(pending, timeout=hedge_after if can_hedge else None, return_when=FIRST_COMPLETED)
+            if not done:
+                log.info("hedging %s after %.1fs", order[nxt].key, hedge_after)
+                hedged = True
+                launch()
+                continue
+            for f in done:
+                p = pending.pop(f)
+                try:
+                    return f.result()
+                except Exception as e:
+                    log.warning("LLM provider %s failed: %r", p.key, e)
+                    errors.append((p, e))
+            if not pending and nxt < len(order):
+                launch()
+        raise AllProvidersFailed(errors)
+
+    # ---------- async ----------
+
+    async def _atimed(self, p: Provider, fn, neutral=()):
+        t0 = time.perf_counter()
+        try:
+            out = await fn(p)
+        except asyncio.CancelledError:
+            raise                          # hedge loser: says nothing about the provider
+        except neutral:
+            raise
+        except Exception:
+            self.record(p, time.perf_counter() - t0, False)
+            raise
+        self.record(p, time.perf_counter() - t0, True)
+        return out
+
+    async def acall(self, fn, hedge: bool = False, neutral: tuple = ()):
+        """asyncio flavour of call(); fn(provider) must return an awaitable. Hedge losers are cancelled."""
+        order = self.ranked()
+        hedge_after = self.hedge_after_s if hedge else None
+        pending, errors, nxt = {}, [], 0
+
+        def launch():
+            nonlocal nxt
+            p = order[nxt]
+            nxt += 1
+            pending[asyncio.ensure_future(self._atimed(p, fn, neutral))] = p
+
+        if order:
+            launch()
+        hedged = False
+        try:
+            while pending:
+                can_hedge = hedge_after and not hedged and nxt < len(order)
+                done, _ = await asyncio.wait(pending, timeout=hedge_after if can_hedge else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    launch()
+                    continue
+                for t in done:
+                    p = pending.pop(t)
+                    if t.exception() is None:
+                        return t.result()
+                    log.warning("LLM provider %s failed: %r", p.key, t.exception())
+                    errors.append((p, t.exception()))
+                if not pending and nxt < len(order):
+                    launch()
+        finally:
+            for t in pending:
+                t.cancel()
+        raise AllProvidersFailed(errors)
+
+# ---------- local stubs ----------
+
+class StubClient:
+    """Fake provider for tests/simulations: fixed latency (+jitter) and a failure probability."""
+    def __init__(self, latency_s: float, fail_rate: float = 0.0, jitter_s: float = 0.0, reply: str = "{}"):
+        self.latency_s, self.fail_rate, self.jitter_s, self.reply = latency_s, fail_rate, jitter_s, reply
+
+    def _delay(self) -> float:
+        return max(0.0, self.latency_s + random.uniform(-self.jitter_s, self.jitter_s))
+
+    def complete(self, *_args, **_kwargs) -> str:
+        time.sleep(self._delay())
+        if random.random() < self.fail_rate:
+            raise RuntimeError("stub provider error")
+        return self.reply
+
+    async def ainvoke(self, *_args, **_kwargs) -> str:
+        await asyncio.sleep(self._delay())
+        if random.random() < self.fail_rate:
+            raise RuntimeError("stub provider error")
+        return self.reply
+
+def stub(name: str, model: str = "stub", **kwargs) -> Provider:
+    return Provider(name, model, StubClient(**kwargs))
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    r = Router([
+        stub("slow", latency_s=0.30, jitter_s=0.05),
+        stub("fast", latency_s=0.05, jitter_s=0.01),
+        stub("flaky", latency_s=0.02, fail_rate=0.6),
+    ], hedge_after_s=0.15, cooldown_s=1.0)
+    picks = {}
+    t0 = time.perf_counter()
+    for _ in range(60):
+        winner = r.ranked()[0].key
+        picks[winner] = picks.get(winner, 0) + 1
+        r.call(lambda p: p.client.complete(), hedge=True)
+    print(f"60 calls in {time.perf_counter() - t0:.2f}s; first choice counts: {picks}")
+    for k, v in r.snapshot().items():
+        print(k, v)
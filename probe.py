@@ -1,25 +1,31 @@
-import time, requests, asyncio
-from db import record_telemetry, latest_token
+import time, httpx, asyncio
+from db import record_telemetry
+from rate_limit import limit_url
+from session_adapter import get_session
+from probe_timing import TimedTransport, timed_request
+
+# one pooled client per worker process: back-to-back probes reuse connections,
+# and the phase breakdown shows when they don't
+_client = httpx.Client(transport=TimedTransport(), follow_redirects=True)
 
 def call_authed(site_id, url, auth_kind="bearer"):
-    t = asyncio.run(latest_token(site_id))
-    if not t:
+    # bearer / cookie / storage_state rows all come back as a cached, pre-parsed Session
+    s = asyncio.run(get_session(site_id))
+    if not s:
         raise RuntimeError(f"No token for {site_id}")
 
-    headers, jar = {}, None
-    if auth_kind == "bearer" and t.get("token"):
-        headers["Authorization"] = f"Bearer {t['token']}"
-    if auth_kind == "cookie":
-        jar = requests.cookies.RequestsCookieJar()
-        for k, v in (t.get("cookies") or {}).items():
-            jar.set(k, v)
+    headers, cookies = s.auth_for(url, auth_kind)
+    if cookies:
+        headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in cookies.items())
 
+    limit_url(url)
     t0 = time.perf_counter()
-    r = requests.get(url, headers=headers, cookies=jar, timeout=25)
+    r, phases = timed_request(_client, "GET", url, headers=headers, timeout=25)
     ms = (time.perf_counter() - t0) * 1000.0
     r.raise_for_status()
     try:
-        asyncio.run(record_telemetry(site_id, url, r.status_code, ms))
+        asyncio.run(record_telemetry(site_id, url, r.status_code, ms, phases))
     except Exception:
         pass
-    return {"status": r.status_code, "latency_ms": round(ms, 2)}
+    return {"status": r.status_code, "latency_ms": round(ms, 2),
+            **{k: round(v, 2) if isinstance(v, float) else v for k, v in phases.items()}}
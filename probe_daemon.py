@@ -0,0 +1,277 @@
+# probe_daemon.py
+"""
+Continuous synthetic monitoring: one asyncio process probes every
+probe_endpoints entry of every site config on its own interval.
+
+    python probe_daemon.py
+
+Per-endpoint options (all optional) next to "url"/"auth":
+    "interval_s": 60, "jitter": 0.1, "method": "GET", "timeout_s": 25
+
+Endpoints sit on a hashed timing wheel (O(1) schedule, one bucket scan per
+tick) instead of one Celery task per probe; requests share keep-alive
+connections through a single httpx.AsyncClient, and results (with the
+probe_timing phase breakdown) are batched into auth.telemetry. Site configs
+and tokens are reloaded periodically, so new endpoints and fresh logins are
+picked up without a restart.
+
+Per-domain rate limits are applied at dispatch, before a probe takes one of
+the MAX_INFLIGHT slots: a DomainPacer (GCRA, the same rate/burst as
+rate_limit's shared buckets, no Redis round-trip) tells each probe when it may
+start, so a throttled domain waits outside the slots instead of holding them
+while every other domain queues behind it. `python bench_probe_daemon.py`
+measures throughput against a local server. One process is CPU-bound at a few
+hundred probes/s per core (see the readme); it is not a thousands-per-second
+prober on its own.
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+
+import httpx
+
+from sites import all_sites
+from db import record_telemetry_many
+from session_adapter import get_session
+from rate_limit import domain_key, limits_for
+from probe_timing import TimedAsyncTransport, atimed_request, PHASE_COLUMNS
+
+log = logging.getLogger("probe_daemon")
+
+TICK_S = float(os.getenv("PROBE_TICK_S", "0.01"))
+WHEEL_SLOTS = int(os.getenv("PROBE_WHEEL_SLOTS", "4096"))
+DEFAULT_INTERVAL_S = float(os.getenv("PROBE_INTERVAL_S", "60"))
+DEFAULT_JITTER = float(os.getenv("PROBE_JITTER", "0.1"))
+MAX_INFLIGHT = int(os.getenv("PROBE_MAX_INFLIGHT", "2000"))
+MAX_CONNECTIONS = int(os.getenv("PROBE_MAX_CONNECTIONS", "1000"))
+FLUSH_S = float(os.getenv("PROBE_FLUSH_S", "1"))
+FLUSH_ROWS = int(os.getenv("PROBE_FLUSH_ROWS", "2000"))
+TOKEN_REFRESH_S = float(os.getenv("PROBE_TOKEN_REFRESH_S", "30"))
+CONFIG_RELOAD_S = float(os.getenv("PROBE_CONFIG_RELOAD_S", "60"))
+RESPECT_RATE_LIMITS = os.getenv("PROBE_RATE_LIMIT", "1") == "1"
+
+class TimingWheel:
+    """
+    Hashed timing wheel: slot = due tick % slots. Items further out than one
+    revolution share a slot and are simply re-kept until their tick comes up.
+    """
+    def __init__(self, tick_s: float = TICK_S, slots: int = WHEEL_SLOTS):
+        self.tick_s = tick_s
+        self.slots = [[] for _ in range(slots)]
+        self.tick = 0
+
+    def schedule(self, item, delay_s: float):
+        due = self.tick + max(1, round(delay_s / self.tick_s))
+        self.slots[due % len(self.slots)].append((due, item))
+
+    def advance(self) -> list:
+        self.tick += 1
+        bucket = self.slots[self.tick % len(self.slots)]
+        if not bucket:
+            return []
+        due = [item for t, item in bucket if t <= self.tick]
+        if len(due) == len(bucket):
+            bucket.clear()
+        else:
+            bucket[:] = [(t, item) for t, item in bucket if t > self.tick]
+        return due
+
+class DomainPacer:
+    """
+    In-process per-domain pacing (GCRA): reserve() books the next start time for the
+    URL's domain and returns how long to wait for it. A burst of `burst` requests
+    passes at once, after that one every 1/rate seconds.
+    """
+    def __init__(self):
+        self.tat = {}                         # domain key -> theoretical arrival time (monotonic)
+        self.limits = {}                      # domain key -> (interval s, tolerance s)
+
+    def reserve(self, url: str) -> float:
+        key = domain_key(url)
+        if not key:
+            return 0.0
+        lim = self.limits.get(key)
+        if lim is None:
+            rate, burst = limits_for(key)
+            lim = self.limits[key] = (1.0 / rate, max(0.0, burst - 1) / rate)
+        interval, tolerance = lim
+        now = time.monotonic()
+        tat = max(self.tat.get(key, now), now)
+        self.tat[key] = tat + interval
+        return max(0.0, tat - tolerance - now)
+
+class Endpoint:
+    __slots__ = ("site_id", "url", "auth", "method", "interval_s", "jitter", "timeout_s", "active", "running")
+
+    def __init__(self, site_id: str, ep: dict):
+        self.site_id = site_id
+        self.url = ep["url"]
+        self.auth = ep.get("auth", "bearer")
+        self.method = ep.get("method", "GET").upper()
+        self.interval_s = float(ep.get("interval_s", DEFAULT_INTERVAL_S))
+        self.jitter = float(ep.get("jitter", DEFAULT_JITTER))
+        self.timeout_s = float(ep.get("timeout_s", 25))
+        self.active = True
+        self.running = False
+
+    @property
+    def key(self):
+        return (self.site_id, self.url)
+
+    def next_delay(self) -> float:
+        return max(TICK_S, self.interval_s * (1 + random.uniform(-self.jitter, self.jitter)))
+
+class ProbeDaemon:
+    def __init__(self):
+        self.wheel = TimingWheel()
+        self.endpoints = {}
+        self.sessions = {}                    # site_id -> session_adapter.Session (or None)
+        self.results = []
+        self.inflight = asyncio.Semaphore(MAX_INFLIGHT)
+        self.pacer = DomainPacer()
+        self.tasks = set()                    # strong refs so running probes aren't GC'd
+        self.counts = {"ok": 0, "failed": 0, "errors": 0, "no_token": 0, "skipped_overlap": 0, "paced": 0}
+        self.client = None
+
+    # ---------- config + tokens ----------
+
+    def reload_endpoints(self):
+        seen = set()
+        for site_id, conf in all_sites().items():
+            for raw in conf.get("probe_endpoints", []):
+                ep = Endpoint(site_id, raw)
+                seen.add(ep.key)
+                old = self.endpoints.get(ep.key)
+                if old and (old.interval_s, old.auth, old.method) == (ep.interval_s, ep.auth, ep.method):
+                    continue
+                if old:
+                    old.active = False
+                self.endpoints[ep.key] = ep
+                # first run at a random offset so N endpoints with one interval don't fire together
+                self.wheel.schedule(ep, random.uniform(0, ep.interval_s))
+        for key in [k for k in self.endpoints if k not in seen]:
+            self.endpoints.pop(key).active = False
+        log.info("probing %d endpoints", len(self.endpoints))
+
+    async def refresh_tokens(self):
+        # get_session only re-fetches/parses when a site has a newer token row
+        for site_id in {ep.site_id for ep in self.endpoints.values()}:
+            try:
+                self.sessions[site_id] = await get_session(site_id)
+            except Exception as e:
+                log.warning("token refresh failed for %s: %s", site_id, e)
+
+    # ---------- probing ----------
+
+    async def probe(self, ep: Endpoint):
+        s = self.sessions.get(ep.site_id)
+        if not s:
+            self.counts["no_token"] += 1
+            return
+        headers, cookies = s.auth_for(ep.url, ep.auth)
+        if cookies:
+            headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in cookies.items())
+        async with self.inflight:
+            t0 = time.perf_counter()
+            phases = {}
+            try:
+                r, phases = await atimed_request(self.client, ep.method, ep.url, headers=headers,
+                                                 timeout=ep.timeout_s)
+                status = r.status_code
+            except httpx.HTTPError:
+                status = 0                     # connection/timeout error
+            ms = (time.perf_counter() - t0) * 1000.0
+        self.counts["ok" if 200 <= status < 400 else "failed" if status else "errors"] += 1
+        self.results.append((ep.site_id, ep.url, status, ms, *(phases.get(k) for k in PHASE_COLUMNS)))
+
+    async def _run_probe(self, ep: Endpoint, delay_s: float = 0.0):
+        try:
+            if delay_s:                        # rate-limit wait, outside the inflight slots
+                self.counts["paced"] += 1
+                await asyncio.sleep(delay_s)
+            await self.probe(ep)
+        except Exception:
+            log.exception("probe crashed for %s", ep.url)
+        finally:
+            ep.running = False
+
+    def dispatch(self, ep: Endpoint):
+        if not ep.active:
+            return
+        # fixed-rate schedule: the next run doesn't wait for this one to finish
+        self.wheel.schedule(ep, ep.next_delay())
+        if ep.running:                          # still waiting on the previous probe
+            self.counts["skipped_overlap"] += 1
+            return
+        ep.running = True
+        delay = self.pacer.reserve(ep.url) if RESPECT_RATE_LIMITS else 0.0
+        task = asyncio.create_task(self._run_probe(ep, delay))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    # ---------- background loops ----------
+
+    async def ticker(self):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        while True:
+            # catch up without sleeping if the loop fell behind
+            delay = start + (self.wheel.tick + 1) * self.wheel.tick_s - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            for ep in self.wheel.advance():
+                self.dispatch(ep)
+
+    async def flusher(self):
+        last = time.monotonic()
+        while True:
+            await asyncio.sleep(min(FLUSH_S, 0.1))
+            if len(self.results) < FLUSH_ROWS and time.monotonic() - last < FLUSH_S:
+                continue
+            rows, self.results = self.results, []
+            last = time.monotonic()
+            try:
+                await record_telemetry_many(rows)
+            except Exception as e:
+                log.warning("dropped %d telemetry rows: %s", len(rows), e)
+
+    async def refresher(self):
+        last_reload = time.monotonic()
+        while True:
+            await asyncio.sleep(TOKEN_REFRESH_S)
+            if time.monotonic() - last_reload >= CONFIG_RELOAD_S:
+                self.reload_endpoints()
+                last_reload = time.monotonic()
+            await self.refresh_tokens()
+
+    async def reporter(self, every_s: float = 10.0):
+        prev = dict(self.counts)
+        while True:
+            await asyncio.sleep(every_s)
+            cur = dict(self.counts)
+            done = sum(cur[k] - prev[k] for k in ("ok", "failed", "errors"))
+            log.info("%.1f probes/s %s", done / every_s, {k: cur[k] - prev[k] for k in cur})
+            prev = cur
+
+    async def run(self):
+        limits = httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS,
+                              keepalive_expiry=max(DEFAULT_INTERVAL_S * 2, 30))
+        async with httpx.AsyncClient(transport=TimedAsyncTransport(limits=limits), follow_redirects=False) as client:
+            self.client = client
+            self.reload_endpoints()
+            await self.refresh_tokens()
+            await asyncio.gather(self.ticker(), self.flusher(), self.refresher(), self.reporter())
+
+def main():
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(name)s %(message)s")
+    try:
+        import uvloop                          # optional, noticeably faster event loop
+        uvloop.install()
+    except ImportError:
+        pass
+    asyncio.run(ProbeDaemon().run())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+# probe_timing.py
+"""
+Per-phase timing for probe requests: DNS, TCP connect, TLS handshake, server
+time-to-first-byte, body transfer, plus connection reuse and bytes on the wire.
+
+httpx's "trace" extension reports connect/TLS/request/response events; DNS is
+hidden inside connect_tcp, so the transports below use a network backend that
+resolves the host itself (timed) and connects to the address. TLS still uses
+the original hostname for SNI/verification.
+
+    client = httpx.Client(transport=TimedTransport())
+    r, phases = timed_request(client, "GET", url, headers=headers)
+    # phases: {"dns_ms", "connect_ms", "tls_ms", "ttfb_ms", "transfer_ms", "reused", "bytes"}
+
+For a pooled (reused) connection dns/connect/tls are None. Lookup failures and
+timeouts raise httpcore.ConnectError / ConnectTimeout like a normal connect,
+so callers see httpx.ConnectError / httpx.ConnectTimeout; the connect timeout
+covers the lookup plus the connect attempts.
+"""
+import time
+import socket
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import anyio
+import httpcore
+import httpx
+
+PHASE_COLUMNS = ("dns_ms", "connect_ms", "tls_ms", "ttfb_ms", "transfer_ms", "reused", "bytes")
+
+_current = contextvars.ContextVar("probe_phases", default=None)
+
+class PhaseRecorder:
+    def __init__(self):
+        self.t = {}
+        self.dns_ms = None
+
+    def _mark(self, name: str):
+        # "http11.receive_response_headers.complete" / "http2...." -> "receive_response_headers.complete"
+        if name.startswith(("http11.", "http2.")):
+            name = name.split(".", 1)[1]
+        self.t.setdefault(name, time.perf_counter())
+
+    def trace(self, name, info):
+        self._mark(name)
+
+    async def atrace(self, name, info):
+        self._mark(name)
+
+    def _span(self, start: str, end: str):
+        if start in self.t and end in self.t:
+            return (self.t[end] - self.t[start]) * 1000.0
+        return None
+
+    def result(self, response=None) -> dict:
+        connect = self._span("connection.connect_tcp.started", "connection.connect_tcp.complete")
+        reused = connect is None
+        dns = None if reused else (self.dns_ms or 0.0)
+        return {
+            "dns_ms": dns,
+            "connect_ms": None if reused else max(0.0, connect - dns),
+            "tls_ms": self._span("connection.start_tls.started", "connection.start_tls.complete"),
+            "ttfb_ms": self._span("send_request_headers.started", "receive_response_headers.complete"),
+            "transfer_ms": self._span("receive_response_body.started", "receive_response_body.complete"),
+            "reused": reused,
+            "bytes": response.num_bytes_downloaded if response is not None else None,
+        }
+
+def _note_dns(t0: float):
+    rec = _current.get()
+    if rec is not None:
+        rec.dns_ms = (time.perf_counter() - t0) * 1000.0
+
+# ---------- network backends ----------
+
+# getaddrinfo can't be interrupted, so sync lookups run here and are waited on with a timeout
+_resolver = ThreadPoolExecutor(max_workers=8, thread_name_prefix="probe-dns")
+
+def _remaining(host, deadline):
+    if deadline is None:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise httpcore.ConnectTimeout(f"connect to {host} timed out")
+    return left
+
+class _TimedSyncBackend(httpcore.SyncBackend):
+    def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        t0 = time.perf_counter()
+        fut = _resolver.submit(socket.getaddrinfo, host, port, type=socket.SOCK_STREAM)
+        try:
+            infos = fut.result(timeout=timeout)
+        except FutureTimeout:
+            raise httpcore.ConnectTimeout(f"DNS lookup for {host} timed out after {timeout}s") from None
+        except OSError as e:
+            raise httpcore.ConnectError(f"DNS lookup for {host} failed: {e}") from e
+        _note_dns(t0)
+        last = None
+        for *_, addr in infos:                   # like socket.create_connection: try each address
+            try:
+                return super().connect_tcp(addr[0], port, timeout=_remaining(host, deadline),
+                                           local_address=local_address, socket_options=socket_options)
+            except httpcore.ConnectError as e:
+                last = e
+        raise last or httpcore.ConnectError(f"no addresses for {host}")
+
+class _TimedAsyncBackend(httpcore.AnyIOBackend):
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        t0 = time.perf_counter()
+        try:
+            with anyio.fail_after(timeout):
+                infos = await anyio.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except TimeoutError:
+            raise httpcore.ConnectTimeout(f"DNS lookup for {host} timed out after {timeout}s") from None
+        except OSError as e:
+            raise httpcore.ConnectError(f"DNS lookup for {host} failed: {e}") from e
+        _note_dns(t0)
+        last = None
+        for *_, addr in infos:
+            try:
+                return await super().connect_tcp(addr[0], port, timeout=_remaining(host, deadline),
+                                                 local_address=local_address, socket_options=socket_options)
+            except httpcore.ConnectError as e:
+                last = e
+        raise last or httpcore.ConnectError(f"no addresses for {host}")
+
+# ---------- transports ----------
+# httpx doesn't take a network backend directly, so swap the transport's
+# connection pool for one built with ours (same limits and TLS context).
+
+_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60)
+
+class TimedTransport(httpx.HTTPTransport):
+    def __init__(self, limits: httpx.Limits = _LIMITS, verify=True):
+        super().__init__(limits=limits, verify=verify)
+        self._pool = httpcore.ConnectionPool(
+            ssl_context=httpx.create_ssl_context(verify=verify),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            network_backend=_TimedSyncBackend(),
+        )
+
+class TimedAsyncTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, limits: httpx.Limits = _LIMITS, verify=True):
+        super().__init__(limits=limits, verify=verify)
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(verify=verify),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            network_backend=_TimedAsyncBackend(),
+        )
+
+# ---------- request helpers ----------
+
+def timed_request(client: httpx.Client, method: str, url: str, **kwargs):
+    """(response, phases) -- the body is read inside, so transfer time is included."""
+    rec = PhaseRecorder()
+    token = _current.set(rec)
+    try:
+        r = client.request(method, url, extensions={"trace": rec.trace}, **kwargs)
+    finally:
+        _current.reset(token)
+    return r, rec.result(r)
+
+async def atimed_request(client: httpx.AsyncClient, method: str, url: str, **kwargs):
+    rec = PhaseRecorder()
+    token = _current.set(rec)
+    try:
+        r = await client.request(method, url, extensions={"trace": rec.atrace}, **kwargs)
+    finally:
+        _current.reset(token)
+    return r, rec.result(r)
@@ -0,0 +1,254 @@
+# rate_limit.py
+"""
+Distributed token-bucket limiter shared by every worker through Redis.
+
+Buckets are keyed by target domain ("domain:www.saucedemo.com") and by LLM
+provider/model ("llm:openai:gpt-4.1"). Callers reserve a token and sleep for
+the returned wait, so bursts queue up instead of turning into 429s:
+
+    from rate_limit import limit_url, limit_llm
+    limit_url("https://dummyjson.com/auth/me")     # blocks until allowed
+    limit_llm("openai", "gpt-4o-mini")
+
+Limits (tokens/second + burst) come from, in order of precedence:
+  - RATE_LIMITS env JSON: {"dummyjson.com": {"rate": 10, "burst": 20}, "llm:openai": {...}}
+  - a site config's "rate_limit" block, applied to the hosts of its start_url,
+    probe_endpoints and auth.login url
+  - RL_DOMAIN_RATE/RL_DOMAIN_BURST and RL_LLM_RATE/RL_LLM_BURST defaults
+
+Every wait is added to the rl:stats hash so limits can be tuned (see stats()).
+If Redis is unreachable the limiter fails open.
+"""
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+from functools import lru_cache
+from urllib.parse import urlparse
+
+from redis_conn import get_redis
+from sites import all_sites
+
+log = logging.getLogger(__name__)
+
+DOMAIN_RATE = float(os.getenv("RL_DOMAIN_RATE", "5"))
+DOMAIN_BURST = float(os.getenv("RL_DOMAIN_BURST", "10"))
+LLM_RATE = float(os.getenv("RL_LLM_RATE", "2"))
+LLM_BURST = float(os.getenv("RL_LLM_BURST", "5"))
+MAX_WAIT_S = float(os.getenv("RL_MAX_WAIT_S", "120"))
+
+# Reservation-style bucket: the token is always taken (tokens may go negative,
+# down to -burst) and the script returns how long the caller must wait before
+# using it. One round-trip per call, FIFO-ish under contention, and Redis TIME
+# keeps every worker on the same clock.
+_LUA = """
+local key = KEYS[1]
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1e6
+local b = redis.call('HMGET', key, 'tokens', 'ts')
+local tokens = tonumber(b[1]) or burst
+local ts = tonumber(b[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+if tokens - cost < -burst then
+  return tostring((cost - tokens - burst) / rate * -1)
+end
+tokens = tokens - cost
+redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', key, math.ceil(2 * burst / rate) + 60)
+if tokens >= 0 then return '0' end
+return tostring(-tokens / rate)
+"""
+# A negative return means "queue is full, nothing reserved; retry after |value| seconds".
+
+@lru_cache(maxsize=None)
+def _script():
+    return get_redis().register_script(_LUA)
+
+def site_hosts(conf: dict) -> list:
+    """Hostnames a site config talks to: start/signup/login URLs, the http_api login and probe endpoints."""
+    urls = [conf.get("start_url"), ((conf.get("auth") or {}).get("login") or {}).get("url"),
+            (conf.get("signup") or {}).get("url"), (conf.get("login") or {}).get("url")]
+    urls += [ep.get("url") for ep in conf.get("probe_endpoints", [])]
+    hosts = (urlparse(u).hostname for u in urls if isinstance(u, str))
+    return sorted({h for h in hosts if h})
+
+@lru_cache(maxsize=None)
+def _overrides() -> dict:
+    out = {}
+    for conf in all_sites().values():
+        rl = conf.get("rate_limit")
+        if not rl:
+            continue
+        for host in site_hosts(conf):
+            out[f"domain:{host}"] = rl
+    for k, v in json.loads(os.getenv("RATE_LIMITS", "{}")).items():
+        out[k if k.startswith(("domain:", "llm:")) else f"domain:{k}"] = v
+    return out
+
+def limits_for(key: str) -> tuple:
+    """(rate, burst) for a bucket key; "llm:openai:gpt-4.1" also matches an "llm:openai" override."""
+    ov = _overrides()
+    conf = ov.get(key)
+    if conf is None and key.startswith("llm:"):
+        conf = ov.get(":".join(key.split(":")[:2]))
+    if key.startswith("llm:"):
+        rate, burst = LLM_RATE, LLM_BURST
+    else:
+        rate, burst = DOMAIN_RATE, DOMAIN_BURST
+    conf = conf or {}
+    return float(conf.get("rate", rate)), float(conf.get("burst", burst))
+
+def domain_key(url: str) -> str | None:
+    host = urlparse(url).hostname
+    return f"domain:{host}" if host else None
+
+def llm_key(provider: str, model: str) -> str:
+    return f"llm:{provider}:{model}"
+
+# ---------- core ----------
+
+def reserve(key: str, cost: float = 1.0) -> float:
+    """Take `cost` tokens from the bucket; returns seconds to wait (negative = bucket saturated, retry)."""
+    rate, burst = limits_for(key)
+    try:
+        return float(_script()(keys=[f"rl:{key}"], args=[rate, burst, cost]))
+    except Exception as e:  # fail open: a Redis blip must not stop logins/probes
+        log.warning("rate limiter unavailable for %s: %s", key, e)
+        return 0.0
+
+def _record(key: str, waited_s: float):
+    try:
+        r = get_redis()
+        p = r.pipeline(transaction=False)
+        p.hincrby("rl:stats", f"{key}|calls", 1)
+        if waited_s > 0:
+            p.hincrby("rl:stats", f"{key}|waited", 1)
+            p.hincrbyfloat("rl:stats", f"{key}|wait_ms", waited_s * 1000.0)
+        p.execute()
+    except Exception:
+        pass
+
+def acquire(key: str, cost: float = 1.0, max_wait_s: float = MAX_WAIT_S, sleep=time.sleep) -> float:
+    """Block until `key` allows the call; returns the total seconds waited. `sleep(seconds)` does the waiting."""
+    waited = 0.0
+    while True:
+        w = reserve(key, cost)
+        if w >= 0:
+            w = min(w, max(0.0, max_wait_s - waited))
+            if w:
+                sleep(w)
+            waited += w
+            break
+        if waited >= max_wait_s:
+            break
+        sleep(min(-w, max_wait_s - waited))
+        waited += min(-w, max_wait_s - waited)
+    _record(key, waited)
+    return waited
+
+async def aacquire(key: str, cost: float = 1.0, max_wait_s: float = MAX_WAIT_S) -> float:
+    """asyncio flavour of acquire(); the Redis round-trip runs in a thread so the loop never blocks."""
+    waited = 0.0
+    while True:
+        w = await asyncio.to_thread(reserve, key, cost)
+        if w >= 0:
+            w = min(w, max(0.0, max_wait_s - waited))
+            if w:
+                await asyncio.sleep(w)
+            waited += w
+            break
+        if waited >= max_wait_s:
+            break
+        await asyncio.sleep(min(-w, max_wait_s - waited))
+        waited += min(-w, max_wait_s - waited)
+    await asyncio.to_thread(_record, key, waited)
+    return waited
+
+# ---------- call-path helpers ----------
+
+def limit_url(url: str) -> float:
+    key = domain_key(url)
+    return acquire(key) if key else 0.0
+
+async def alimit_url(url: str) -> float:
+    key = domain_key(url)
+    return await aacquire(key) if key else 0.0
+
+def limit_llm(provider: str, model: str) -> float:
+    return acquire(llm_key(provider, model))
+
+async def alimit_llm(provider: str, model: str) -> float:
+    return await aacquire(llm_key(provider, model))
+
+# Only requests that hit the application server count; static assets are left alone.
+_LIMITED_TYPES = {"document", "xhr", "fetch"}
+
+def _host_pattern(hosts):
+    """
+    Route matcher for `hosts` (default: hosts with a configured rate_limit), or None when
+    there is nothing to limit. A regex is matched by the Playwright driver, so requests to
+    other hosts never make the round-trip to a Python handler.
+    """
+    if not hosts:
+        hosts = [k.split(":", 1)[1] for k in _overrides() if k.startswith("domain:")]
+    hosts = sorted({h for h in hosts if h})
+    if not hosts:
+        return None
+    return re.compile(r"^[a-z][a-z0-9+.-]*://(?:%s)(?::\d+)?(?:[/?#]|$)" % "|".join(re.escape(h) for h in hosts), re.I)
+
+async def guard_context(context, hosts=None):
+    """
+    Throttle a Playwright (async) context's navigations and XHR/fetch calls to `hosts`
+    (default: the hosts that have a configured rate_limit). Only those hosts are routed,
+    and other resource types fall straight through. Uses route.fallback() so other route
+    handlers (e.g. asset caching) still run.
+    """
+    pattern = _host_pattern(hosts)
+    if pattern is None:
+        return
+
+    async def _handler(route, request):
+        if request.resource_type in _LIMITED_TYPES:
+            await alimit_url(request.url)
+        await route.fallback()
+
+    await context.route(pattern, _handler)
+
+def guard_context_sync(context, hosts=None):
+    """
+    guard_context() for the sync Playwright API. The wait goes through page.wait_for_timeout
+    so the dispatcher keeps processing the context's other events; time.sleep here would
+    freeze them.
+    """
+    pattern = _host_pattern(hosts)
+    if pattern is None:
+        return
+
+    def _handler(route, request):
+        if request.resource_type in _LIMITED_TYPES:
+            key = domain_key(request.url)
+            try:
+                page = request.frame.page
+                sleep = lambda s: page.wait_for_timeout(s * 1000.0)
+            except Exception:                    # service worker request: no page to wait on
+                sleep = lambda s: None
+            if key:
+                acquire(key, sleep=sleep)
+        route.fallback()
+
+    context.route(pattern, _handler)
+
+def stats() -> dict:
+    """{key: {"calls", "waited", "wait_ms", "avg_wait_ms"}} accumulated across all workers."""
+    out = {}
+    for field, val in get_redis().hgetall("rl:stats").items():
+        key, metric = field.rsplit("|", 1)
+        out.setdefault(key, {"calls": 0, "waited": 0, "wait_ms": 0.0})[metric] = float(val)
+    for v in out.values():
+        v["avg_wait_ms"] = round(v["wait_ms"] / v["calls"], 2) if v["calls"] else 0.0
+    return out
@@ -0,0 +1,12 @@
+import os
+from functools import lru_cache
+
+import redis
+
+# Shared coordination store (locks, limiter buckets, counters). Defaults to the Celery broker.
+REDIS_URL = os.getenv("REDIS_URL", os.getenv("CELERY_BROKER_URL", "redis://redis:6379/0"))
+
+@lru_cache(maxsize=None)
+def get_redis() -> redis.Redis:
+    """Process-wide client; redis-py pools connections and is thread-safe."""
+    return redis.Redis.from_url(REDIS_URL, decode_responses=True)
@@ -0,0 +1,251 @@
+# routing.py
+"""
+Site-affinity routing: site-scoped tasks for the same site go to the same worker
+node, so that node's warm state (browser, asset cache, plans, sessions) gets reused.
+
+  - every worker heartbeats into the routing:nodes hash and consumes its own
+    queue auth.node.<NODE_ID> besides the shared "auth" queue
+  - route_task (a Celery task_routes router) places the site_id on a consistent-hash
+    ring of live nodes (VNODES virtual nodes each), so a node joining or leaving
+    moves only ~1/N of the sites
+  - a node whose queue backlog exceeds its spill threshold is skipped for the next
+    node on the ring; if every candidate is busy (or Redis is down) the task
+    goes to the shared "auth" queue, which is how everything was routed before
+  - a node that misses heartbeats for NODE_TTL_S stops getting new tasks but keeps
+    its queue; only after ROUTING_DEAD_AFTER_S does rebalance() declare it dead and
+    move its queued messages, oldest first, to the consuming end of "auth"
+
+    NODE_ID=worker-a celery -A tasks worker -Q auth,auth.node.worker-a
+    python bench_routing.py                     # simulation vs the single auth queue
+"""
+import os
+import json
+import time
+import socket
+import bisect
+import hashlib
+import logging
+import threading
+
+from celery.signals import worker_ready, worker_shutdown
+from redis_conn import get_redis
+
+log = logging.getLogger(__name__)
+
+NODE_ID = os.getenv("NODE_ID") or socket.gethostname()
+SHARED_QUEUE = "auth"
+NODE_QUEUE_PREFIX = "auth.node."
+NODES_KEY = "routing:nodes"
+VNODES = int(os.getenv("ROUTING_VNODES", "64"))
+HEARTBEAT_S = float(os.getenv("ROUTING_HEARTBEAT_S", "10"))
+NODE_TTL_S = float(os.getenv("ROUTING_NODE_TTL_S", "30"))                   # off the ring (no new tasks)
+DEAD_AFTER_S = float(os.getenv("ROUTING_DEAD_AFTER_S", str(max(2 * NODE_TTL_S, 6 * HEARTBEAT_S))))  # queue drained
+RING_REFRESH_S = float(os.getenv("ROUTING_RING_REFRESH_S", "5"))
+SPILL_PER_SLOT = int(os.getenv("ROUTING_SPILL_PER_SLOT", "4"))    # backlog per worker slot before spilling
+SPILL_CANDIDATES = int(os.getenv("ROUTING_SPILL_CANDIDATES", "2"))
+
+# tasks whose first argument (or site_id kwarg) is a site id
+SITE_TASKS = {
+    "tasks.ensure_access",
+    "tasks.ensure_access_browser_use",
+    "tasks.call_all_probes",
+    "tasks.signup_only",
+    "tasks.ensure_account_then_login",
+    "tasks.refill_account_pool",
+}
+
+# kombu's redis transport keeps priority levels in extra lists next to the queue's own
+_PRIORITY_SUFFIXES = ("", "\x06\x163", "\x06\x166", "\x06\x169")
+
+def node_queue(node_id: str) -> str:
+    return NODE_QUEUE_PREFIX + node_id
+
+# ---------- ring ----------
+
+def _h(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+class HashRing:
+    def __init__(self, nodes=(), vnodes: int = VNODES):
+        self.nodes = frozenset(nodes)
+        points = sorted((_h(f"{n}#{i}"), n) for n in self.nodes for i in range(vnodes))
+        self._keys = [p[0] for p in points]
+        self._owners = [p[1] for p in points]
+
+    def candidates(self, key: str, n: int = 1) -> list:
+        """Up to n distinct nodes, walking clockwise from the key's position."""
+        out = []
+        if not self._keys:
+            return out
+        i = bisect.bisect(self._keys, _h(key))
+        for j in range(len(self._keys)):
+            node = self._owners[(i + j) % len(self._keys)]
+            if node not in out:
+                out.append(node)
+                if len(out) >= n:
+                    break
+        return out
+
+    def node_for(self, key: str):
+        c = self.candidates(key)
+        return c[0] if c else None
+
+# ---------- membership ----------
+
+def _age(raw, now) -> float:
+    try:
+        return now - json.loads(raw).get("ts", 0)
+    except (TypeError, ValueError, AttributeError):
+        return float("inf")
+
+def live_nodes(r=None, within_s: float = NODE_TTL_S) -> dict:
+    """node_id -> heartbeat info for nodes seen within `within_s`."""
+    r = r or get_redis()
+    now = time.time()
+    out = {}
+    for node, raw in r.hgetall(NODES_KEY).items():
+        if _age(raw, now) <= within_s:
+            out[node] = json.loads(raw)
+    return out
+
+_ring_lock = threading.Lock()
+_ring = HashRing()
+_ring_info = {}
+_ring_at = 0.0
+
+def _current_ring():
+    global _ring, _ring_info, _ring_at
+    if time.monotonic() - _ring_at < RING_REFRESH_S:
+        return _ring, _ring_info
+    with _ring_lock:
+        if time.monotonic() - _ring_at >= RING_REFRESH_S:
+            info = live_nodes()
+            if set(info) != _ring.nodes:
+                log.info("routing ring: %s", sorted(info))
+                _ring = HashRing(info)
+            _ring_info, _ring_at = info, time.monotonic()
+    return _ring, _ring_info
+
+# ---------- router ----------
+
+def _site_of(args, kwargs):
+    if kwargs and kwargs.get("site_id"):
+        return kwargs["site_id"]
+    if args and isinstance(args[0], str):
+        return args[0]
+    return None
+
+def pick_queue(site_id: str) -> str:
+    """Queue for a site: its ring owner, the next node(s) if that one is backed up, else the shared queue."""
+    ring, info = _current_ring()
+    r = get_redis()
+    for node in ring.candidates(site_id, 1 + SPILL_CANDIDATES):
+        q = node_queue(node)
+        limit = SPILL_PER_SLOT * max(1, int(info.get(node, {}).get("slots", 1)))
+        if r.llen(q) < limit:
+            return q
+    return SHARED_QUEUE
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    """Celery router: site-scoped tasks by site affinity; everything else falls through."""
+    if name not in SITE_TASKS or options.get("queue"):
+        return None
+    site_id = _site_of(args, kwargs)
+    if not site_id:
+        return None
+    try:
+        return {"queue": pick_queue(site_id)}
+    except Exception as e:                    # Redis down: behave like the single shared queue
+        log.warning("routing fallback for %s: %r", site_id, e)
+        return {"queue": SHARED_QUEUE}
+
+# ---------- rebalancing ----------
+
+def _drain(r, queue: str) -> int:
+    # kombu LPUSHes and consumers pop from the right, so the oldest message is rightmost.
+    # Taking the newest first and appending each on the right leaves the block in its
+    # original order at the consuming end of the shared queue: these tasks are older
+    # than anything queued there since, and run next instead of behind it.
+    moved = 0
+    for suffix in _PRIORITY_SUFFIXES:
+        src, dst = queue + suffix, SHARED_QUEUE + suffix
+        while r.lmove(src, dst, "LEFT", "RIGHT") is not None:
+            moved += 1
+    return moved
+
+def rebalance() -> dict:
+    """
+    Hand the queued tasks of nodes silent for DEAD_AFTER_S back to the shared queue, then
+    forget them. Nodes that only missed a few heartbeats keep their queue: they are already
+    off the ring (no new tasks) and pick up where they left off if they come back.
+    """
+    r = get_redis()
+    lock = r.lock("routing:rebalance", timeout=60)
+    if not lock.acquire(blocking=False):
+        return {"skipped": "rebalance already running"}
+    try:
+        now = time.time()
+        beats = r.hgetall(NODES_KEY)
+        live = sorted(n for n, raw in beats.items() if _age(raw, now) <= NODE_TTL_S)
+        dead = {n for n, raw in beats.items() if _age(raw, now) > DEAD_AFTER_S}
+        # queues with no heartbeat at all: their node shut down or was removed already
+        dead |= {k[len(NODE_QUEUE_PREFIX):] for k in r.scan_iter(match=NODE_QUEUE_PREFIX + "*")
+                 if "\x06" not in k and k[len(NODE_QUEUE_PREFIX):] not in beats}
+        moved = {}
+        for node in dead:
+            raw = r.hget(NODES_KEY, node)
+            if raw is not None and _age(raw, time.time()) <= DEAD_AFTER_S:
+                continue                      # heartbeat came back while we were deciding
+            # drain before forgetting the node, so its tasks go ahead of anything routed since
+            n = _drain(r, node_queue(node))
+            r.hdel(NODES_KEY, node)
+            if n:
+                moved[node] = n
+                log.info("routing: moved %d task(s) from dead node %s to %s", n, node, SHARED_QUEUE)
+        suspect = sorted(set(beats) - set(live) - dead)
+        return {"live": live, "suspect": suspect, "moved": moved}
+    finally:
+        try:
+            lock.release()
+        except Exception:
+            pass
+
+# ---------- worker heartbeat ----------
+
+_stop = threading.Event()
+
+def _heartbeat(slots: int):
+    r = get_redis()
+    while not _stop.is_set():
+        try:
+            r.hset(NODES_KEY, NODE_ID, json.dumps({"ts": time.time(), "slots": slots,
+                                                   "backlog": r.llen(node_queue(NODE_ID))}))
+        except Exception as e:
+            log.warning("routing heartbeat failed: %r", e)
+        _stop.wait(HEARTBEAT_S)
+
+@worker_ready.connect
+def _on_worker_ready(sender=None, **kw):
+    q = node_queue(NODE_ID)
+    # consume our node queue even if the worker was started with -Q auth only;
+    # announcing a node nobody consumes would strand its sites' tasks
+    try:
+        if q not in {x.name for x in sender.task_consumer.queues}:
+            sender.add_task_queue(q)
+    except Exception as e:
+        log.warning("routing: not consuming %s (%r); node not announced", q, e)
+        return
+    slots = getattr(getattr(sender, "controller", None), "concurrency", None) or 1
+    threading.Thread(target=_heartbeat, args=(int(slots),), name="routing-heartbeat", daemon=True).start()
+    log.info("routing: node %s consuming %s with %s slot(s)", NODE_ID, q, slots)
+
+@worker_shutdown.connect
+def _on_worker_shutdown(**kw):
+    # leave the ring at once and give queued work back rather than waiting for the grace period
+    _stop.set()
+    try:
+        r = get_redis()
+        r.hdel(NODES_KEY, NODE_ID)
+        _drain(r, node_queue(NODE_ID))
+    except Exception as e:
+        log.warning("routing: shutdown cleanup failed: %r", e)
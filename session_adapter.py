@@ -0,0 +1,162 @@
+# session_adapter.py
+"""
+Turn a stored auth.tokens row into request credentials, parsing it only once.
+
+storage_state rows hold the whole Playwright state (cookies + localStorage per
+origin). Session parses that once into a cookie jar indexed by domain (with
+path/secure/expiry matching done per request) plus bearer tokens pulled from
+localStorage keys such as jwt/token/access_token. Sessions are cached per
+site and token-row id, so a probe only pays for a cheap "latest id" lookup:
+
+    s = await get_session("realworld")
+    headers, cookies = s.auth_for("https://api.realworld.io/api/user", "bearer")
+
+bearer/cookie rows are wrapped in the same interface.
+"""
+import json
+import time
+from urllib.parse import urlparse
+
+from db import latest_token_version, token_by_id
+
+# localStorage keys that usually hold an API token, in preference order
+TOKEN_KEYS = ("access_token", "accessToken", "id_token", "idToken", "jwt", "token", "authToken", "auth_token")
+
+def extract_token(value):
+    """A raw token string, or one nested in a JSON blob like {"token": "..."} / {"user": {"token": ...}}."""
+    if not value:
+        return None
+    if value[:1] not in "{[\"":
+        return value
+    try:
+        doc = json.loads(value)
+    except ValueError:
+        return value
+    if isinstance(doc, str):
+        return doc
+    stack = [doc]
+    while stack:
+        cur = stack.pop()
+        if isinstance(cur, dict):
+            for k in TOKEN_KEYS:
+                if isinstance(cur.get(k), str) and cur[k]:
+                    return cur[k]
+            stack.extend(v for v in cur.values() if isinstance(v, (dict, list)))
+        elif isinstance(cur, list):
+            stack.extend(cur)
+    return None
+
+class Session:
+    def __init__(self, kind: str, version=None):
+        self.kind = kind
+        self.version = version
+        self.bearer = None                   # token not tied to an origin (bearer rows, or the only one found)
+        self.bearer_by_origin = {}           # "https://host[:port]" -> token
+        self.flat_cookies = {}               # cookie rows: name -> value, sent everywhere
+        self._jar = {}                       # domain without leading dot -> [(path, host_only, secure, expires, name, value)]
+        self._memo = {}                      # (scheme, host, path) -> (cookies dict, valid until epoch s)
+
+    # ---------- building ----------
+
+    @classmethod
+    def from_row(cls, row: dict) -> "Session":
+        s = cls(row["kind"], row.get("id"))
+        if row["kind"] == "storage_state":
+            s._load_state(json.loads(row["token"] or "{}"))
+        else:
+            s.bearer = row.get("token")
+            s.flat_cookies = dict(row.get("cookies") or {})
+        return s
+
+    def _load_state(self, state: dict):
+        for c in state.get("cookies", []):
+            domain = c.get("domain", "")
+            entry = (c.get("path") or "/", not domain.startswith("."), bool(c.get("secure")),
+                     float(c.get("expires", -1)), c["name"], c.get("value", ""))
+            self._jar.setdefault(domain.lstrip(".").lower(), []).append(entry)
+        for entries in self._jar.values():
+            entries.sort(key=lambda e: len(e[0]), reverse=True)   # longest path first, like browsers
+
+        for o in state.get("origins", []):
+            items = {i.get("name"): i.get("value") for i in o.get("localStorage", [])}
+            for k in TOKEN_KEYS:
+                tok = extract_token(items.get(k))
+                if tok:
+                    self.bearer_by_origin[o.get("origin", "").rstrip("/")] = tok
+                    break
+        if len(set(self.bearer_by_origin.values())) == 1:
+            self.bearer = next(iter(self.bearer_by_origin.values()))
+
+    # ---------- lookups ----------
+
+    def cookies_for(self, url: str) -> dict:
+        if self.flat_cookies:
+            return self.flat_cookies
+        u = urlparse(url)
+        host, path = (u.hostname or "").lower(), u.path or "/"
+        key = (u.scheme, host, path)
+        now = time.time()
+        hit = self._memo.get(key)
+        if hit and now < hit[1]:
+            return hit[0]
+        out = {}
+        # the match stays valid until the first matching cookie expires
+        valid_until = float("inf")
+        labels = host.split(".")
+        # walk host, then parent domains: a.b.example.com, b.example.com, example.com
+        for i in range(max(1, len(labels) - 1)):
+            domain = ".".join(labels[i:])
+            for cpath, host_only, secure, expires, name, value in self._jar.get(domain, ()):
+                if host_only and domain != host:
+                    continue
+                if secure and u.scheme != "https":
+                    continue
+                if 0 < expires < now:
+                    continue
+                if not (path == cpath or path.startswith(cpath if cpath.endswith("/") else cpath + "/")):
+                    continue
+                out.setdefault(name, value)
+                if expires > 0:
+                    valid_until = min(valid_until, expires)
+        if key in self._memo or len(self._memo) < 1024:
+            self._memo[key] = (out, valid_until)
+        return out
+
+    def bearer_for(self, url: str):
+        u = urlparse(url)
+        origin = f"{u.scheme}://{u.netloc}"
+        if origin in self.bearer_by_origin:
+            return self.bearer_by_origin[origin]
+        # API on another host than the SPA (api.realworld.io vs demo.realworld.io): fall back to the site token
+        return self.bearer or next(iter(self.bearer_by_origin.values()), None)
+
+    def auth_for(self, url: str, auth_kind: str = "bearer"):
+        """(headers, cookies) for a request; auth_kind is bearer | cookie | session (both)."""
+        headers, cookies = {}, {}
+        if auth_kind in ("bearer", "session"):
+            tok = self.bearer_for(url)
+            if tok:
+                headers["Authorization"] = f"Bearer {tok}"
+        if auth_kind in ("cookie", "session"):
+            cookies = self.cookies_for(url)
+        return headers, cookies
+
+# ---------- cache ----------
+
+_cache = {}                                  # site_id -> Session
+
+async def get_session(site_id: str):
+    """Newest session for a site, re-parsed only when a new token row appears. None if the site has no token."""
+    version = await latest_token_version(site_id)
+    if version is None:
+        _cache.pop(site_id, None)
+        return None
+    cached = _cache.get(site_id)
+    if cached and cached.version == version:
+        return cached
+    row = await token_by_id(version)
+    if not row:
+        return None
+    s = Session.from_row(row)
+    _cache[site_id] = s
+    return s
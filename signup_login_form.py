@@ -3,6 +3,10 @@ import time, secrets, string
 from pathlib import Path
 from typing import Dict, Tuple
 from playwright.sync_api import sync_playwright, TimeoutError as PWTimeout
+from rate_limit import guard_context_sync, site_hosts
+from token_harvester import TokenHarvester
+import asset_cache
+from captcha_pipeline import CaptchaPipeline
 
 STORAGE_DIR = Path("/app/storage")
 STORAGE_DIR.mkdir(parents=True, exist_ok=True)
@@ -28,13 +32,18 @@ def signup_with_form(conf: Dict, email: str, username: str, password: str) -> Di
     with sync_playwright() as p:
         b = p.chromium.launch(headless=True)
         ctx = b.new_context()
+        guard_context_sync(ctx, site_hosts(conf))
+        asset_cache.attach_sync(ctx)
+        captchas = CaptchaPipeline(conf["site_id"], conf).attach_sync(ctx)
         page = ctx.new_page()
 
         page.goto(s["url"], wait_until="networkidle", timeout=60_000)
+        captchas.scan_sync(page)
 
         page.get_by_placeholder(s["fields"]["username_placeholder"]).fill(username)
         page.get_by_placeholder(s["fields"]["email_placeholder"]).fill(email)
         page.get_by_placeholder(s["fields"]["password_placeholder"]).fill(password)
+        captchas.before_submit_sync(page)
         page.get_by_role("button", name=s.get("submit_text", "Sign up")).click()
 
         # SPA can take a second to route
@@ -49,6 +58,7 @@ def signup_with_form(conf: Dict, email: str, username: str, password: str) -> Di
         debug_path = STORAGE_DIR / f"{conf['site_id']}_post_signup.storage.json"
         ctx.storage_state(path=str(debug_path))
         cookies = len(ctx.cookies())
+        captchas.close()
         b.close()
         return {"ok": True, "cookies": cookies, "storage_state_path": str(debug_path)}
 
@@ -62,44 +72,36 @@ def login_with_form(conf: Dict, email: str, password: str, site_id: str) -> Dict
     with sync_playwright() as p:
         browser = p.chromium.launch(headless=True)
         ctx = browser.new_context()
+        guard_context_sync(ctx, site_hosts(conf))
+        asset_cache.attach_sync(ctx)
+        # RealWorld returns the JWT in the users/login response and keeps it in localStorage["jwt"]
+        harvester = TokenHarvester(l.get("token_capture") or {
+            "response_urls": [r"users/login$"], "json_pointers": ["/user/token"], "local_storage": ["jwt"]})
+        harvester.attach_sync(ctx)
+        captchas = CaptchaPipeline(site_id, conf).attach_sync(ctx)
         page = ctx.new_page()
 
         # Open login page and fill form
         page.goto(l["url"], wait_until="networkidle", timeout=60_000)
+        captchas.scan_sync(page)
         page.get_by_placeholder(l["fields"]["email_placeholder"]).fill(email)
         page.get_by_placeholder(l["fields"]["password_placeholder"]).fill(password)
 
         # Click Sign in
+        captchas.before_submit_sync(page)
+        harvester.mark()
         page.get_by_role("button", name=l.get("submit_text", "Sign in")).click()
 
-        # Grab JWT from the /users/login network response
-        token = None
-        try:
-            resp = page.wait_for_response(
-                lambda r: "users/login" in r.url and r.request.method == "POST" and r.status == 200,
-                timeout=30_000,
-            )
-            try:
-                data = resp.json()
-                token = (data.get("user") or {}).get("token")
-            except Exception:
-                token = None
-        except Exception:
-            token = None
-
-        # Fallback: ask the page if it already put the jwt in localStorage
-        if not token:
-            try:
-                token = page.evaluate("() => window.localStorage.getItem('jwt')")
-            except Exception:
-                token = None
+        # JWT from the login response or the app's localStorage write, whichever lands first
+        hit = harvester.wait_sync(page, 30)
+        token = hit["token"] if hit else None
 
         # If we got a token, persist it in localStorage for this origin
         if token:
             page.evaluate("(t) => window.localStorage.setItem('jwt', t)", token)
-
-        # Let SPA settle
-        page.wait_for_load_state("networkidle", timeout=30_000)
+        else:
+            # nothing captured: let the SPA settle before snapshotting whatever it has
+            page.wait_for_load_state("networkidle", timeout=30_000)
 
         # Get storage state
         state = ctx.storage_state()
@@ -127,6 +129,7 @@ def login_with_form(conf: Dict, email: str, password: str, site_id: str) -> Dict
         cookie_count = len(state.get("cookies", []))
         origin_count = len(state.get("origins", []))
 
+        captchas.close()
         browser.close()
 
     return {
@@ -0,0 +1,15 @@
+import json
+from pathlib import Path
+
+CONFIG_DIR = Path("site_configs")
+
+def load(site_id: str) -> dict:
+    """Load site config from site_configs/<site_id>.json"""
+    p = CONFIG_DIR / f"{site_id}.json"
+    if not p.exists():
+        raise FileNotFoundError(f"Site config not found: {p}")
+    return json.loads(p.read_text())
+
+def all_sites() -> dict:
+    """{site_id: config} for every site config; the file stem is the site id."""
+    return {p.stem: json.loads(p.read_text()) for p in sorted(CONFIG_DIR.glob("*.json"))}
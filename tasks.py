@@ -6,8 +6,15 @@ from pathlib import Path
 
 from celery_app import app
 from db import upsert_credentials, insert_token
+import db
 from probe import call_authed
 from browser_auth_browser_use import login_with_browser_use
+from http_auth import login_and_get_token, login_many
+from sites import all_sites
+import rate_limit
+import asset_cache
+import agent_analytics
+import routing
 
 # ---------- helpers ----------
 
@@ -26,6 +33,18 @@ def arun(coro):
         loop = asyncio.get_event_loop()
         return loop.run_until_complete(coro)
 
+def _store_http_token(site_id: str, out: dict) -> dict:
+    # a cached token may not be the site's newest row (another flow stored one since,
+    # or the row was never written), so cache hits go through the same check as new logins
+    saved = arun(db.insert_token_if_changed(site_id, "bearer", out["token"], None, out["expires_at"]))
+    return {
+        "saved": saved,
+        "kind": "bearer",
+        "strategy": "http_api",
+        "cached": out["cached"],
+        "expires_at": out["expires_at"].isoformat(),
+    }
+
 # ---------- tasks ----------
 
 @app.task(name="tasks.ensure_access")
@@ -33,6 +52,7 @@ def ensure_access(site_id: str):
     """
     Ensure we can access a site by logging in with browser-use.
     Strategy:
+      - 'http_api' sites log in over HTTP (pooled, token cached until expiry); no browser.
       - If config has 'strategy' of 'browser_use' or 'llm_browser', we use browser-use.
       - If config has a 'start_url' (and no explicit strategy), default to browser-use.
     """
@@ -41,10 +61,12 @@ def ensure_access(site_id: str):
     if not strat:
         strat = "browser_use" if conf.get("start_url") else None
 
+    if strat == "http_api":
+        return _store_http_token(site_id, login_and_get_token(conf))
+
     if strat not in ("browser_use", "llm_browser"):
         raise ValueError(
-            f"Site '{site_id}' must use browser_use/llm_browser (got: {strat!r}). "
-            "Remove http_api paths – this worker only supports browser-use."
+            f"Site '{site_id}' must use http_api, browser_use or llm_browser (got: {strat!r})."
         )
 
     if "start_url" not in conf:
@@ -71,6 +93,7 @@ def ensure_access(site_id: str):
         "strategy": "browser_use",
         "cookies": out.get("cookies"),
         "path": storage_path,
+        "agent": {k: out.get(k) for k in ("outcome", "steps", "max_steps", "llm_calls")},
     }
 
 @app.task(name="tasks.call_all_probes")
@@ -82,8 +105,54 @@ def call_all_probes(site_id: str):
         for ep in conf.get("probe_endpoints", [])
     ]
 
+@app.task(name="tasks.refresh_http_api_tokens")
+def refresh_http_api_tokens():
+    """Log in to every http_api site concurrently; sites with a still-valid cached token cost nothing."""
+    confs = {sid: c for sid, c in all_sites().items() if c.get("strategy") == "http_api"}
+    out = {}
+    for site_id, res in login_many(confs).items():
+        out[site_id] = res if "error" in res else _store_http_token(site_id, res)
+    return out
+
 # Optional: keep a dedicated name if you were queueing specifically on "auth"
-@app.task(name="tasks.ensure_access_browser_use", queue="auth")
+@app.task(name="tasks.ensure_access_browser_use")
 def ensure_access_browser_use(site_id: str):
     """Alias task that just calls ensure_access with browser-use flow."""
     return ensure_access(site_id)
+
+@app.task(name="tasks.telemetry_rollup")
+def telemetry_rollup(site_id: str | None = None, hours: int = 24):
+    """Hourly probe rollup: target-site time (ttfb) vs our connection overhead (dns/connect/tls, reuse)."""
+    rows = arun(db.telemetry_rollup(site_id, hours))
+    return [{k: (v.isoformat() if hasattr(v, "isoformat") else v) for k, v in r.items()} for r in rows]
+
+@app.task(name="tasks.agent_report")
+def agent_report(site_id: str | None = None, days: int = 7):
+    """browser-use runs per site: success rate, p50/p95 steps and time, LLM share, costly/looping actions, next budget."""
+    return json.loads(json.dumps(arun(agent_analytics.report(site_id, days)), default=float))
+
+@app.task(name="tasks.captcha_stats")
+def captcha_stats(site_id: str | None = None, days: int = 7):
+    """Captchas per site/kind: occurrences, solve rate, p50/p95 solve time, time still blocked at submit."""
+    return json.loads(json.dumps(arun(db.captcha_stats(site_id, days)), default=float))
+
+@app.task(name="tasks.rebalance_routing")
+def rebalance_routing():
+    """Drop workers whose heartbeat expired and move their queued site tasks back to the shared queue."""
+    return routing.rebalance()
+
+@app.task(name="tasks.rate_limit_stats")
+def rate_limit_stats():
+    """Per-bucket call counts and wait times across all workers (for tuning RATE_LIMITS)."""
+    return rate_limit.stats()
+
+@app.task(name="tasks.asset_cache_stats")
+def asset_cache_stats():
+    """Hit rate and bytes saved by the shared static-asset cache on this worker's host."""
+    return asset_cache.stats()
+
+@app.task(name="tasks.llm_plan_stats")
+def llm_plan_stats():
+    """Planning calls, parse-failure/retry rates and time-to-selectors per provider/model."""
+    from llm_agent import plan_stats
+    return plan_stats()
@@ -0,0 +1,16 @@
+# tasks_pool.py
+from celery_app import app
+from account_pool import refill, pooled_sites
+
+@app.task(name="tasks.refill_account_pool")
+def refill_account_pool(site_id: str):
+    """Provision accounts in the background until the site's pool reaches target_size."""
+    return refill(site_id)
+
+@app.task(name="tasks.refill_all_account_pools")
+def refill_all_account_pools():
+    """Fan out a refill for every site config that has an account_pool block."""
+    sites = pooled_sites()
+    for site_id in sites:
+        refill_account_pool.delay(site_id)
+    return {"queued": sites}
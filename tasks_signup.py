@@ -8,16 +8,19 @@ Usage inside the container:
 """
 
 import json
-import time
-import string
-import random
 import asyncio
+from urllib.parse import urlparse
 from pathlib import Path
 
 import requests
 from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
 from celery_app import app
 from db import upsert_credentials, insert_token
+from account_pool import lease, release, unique_creds
+from sites import load
+from rate_limit import limit_url, guard_context_sync
+from token_harvester import TokenHarvester
+import asset_cache
 
 STORAGE_DIR = Path("/app/storage")
 STORAGE_DIR.mkdir(parents=True, exist_ok=True)
@@ -35,10 +38,6 @@ API_CANDIDATES = [
 
 # ---------- helpers ----------
 
-def _rand(n: int = 14) -> str:
-    chars = string.ascii_letters + string.digits
-    return "".join(random.choice(chars) for _ in range(n))
-
 def _arun(coro):
     try:
         return asyncio.run(coro)
@@ -46,18 +45,12 @@ def _arun(coro):
         loop = asyncio.get_event_loop()
         return loop.run_until_complete(coro)
 
-def _poll_local_storage(page, key: str, timeout_ms: int = 15_000) -> str | None:
-    deadline = time.time() + timeout_ms / 1000.0
-    last_err = None
-    while time.time() < deadline:
-        try:
-            val = page.evaluate(f"() => window.localStorage.getItem('{key}')")
-            if val:
-                return val
-        except Exception as e:
-            last_err = e
-        time.sleep(0.25)
-    return None
+# The API answers POST /users and /users/login with {"user": {"token": ...}}; the SPA stores it as jwt
+TOKEN_CAPTURE = {"response_urls": [r"/users(/login)?$"], "json_pointers": ["/user/token"], "local_storage": ["jwt", "token"]}
+
+def _harvested(harvester: TokenHarvester, page, timeout_s: float) -> str | None:
+    hit = harvester.wait_sync(page, timeout_s)
+    return hit["token"] if hit else None
 
 def _ensure_kv_in_state(state: dict, origin: str, pairs: dict) -> None:
     """Insert/replace key/values in localStorage for given origin inside storage_state dict."""
@@ -75,9 +68,9 @@ def _ensure_kv_in_state(state: dict, origin: str, pairs: dict) -> None:
              "localStorage": [{"name": k, "value": v} for k, v in pairs.items()]}
         )
 
-def _api_signup_and_login(email: str, username: str, password: str):
+def _api_signup_and_login(email: str, username: str, password: str, signup: bool = True):
     """
-    Try API sign-up then login on multiple bases.
+    Try API sign-up (unless the account already exists) then login on multiple bases.
     Returns dict: {"token": str|None, "api_base": str|None, "status": [(base, step, code, ok)]}
     """
     results = []
@@ -87,14 +80,17 @@ def _api_signup_and_login(email: str, username: str, password: str):
 
     for base in API_CANDIDATES:
         # sign up (ignore 4xx if user exists)
-        try:
-            r = requests.post(f"{base}/users", json=payload_signup, headers=headers, timeout=20)
-            results.append((base, "signup", getattr(r, "status_code", None), bool(getattr(r, "ok", False))))
-        except requests.RequestException:
-            results.append((base, "signup", None, False))
+        if signup:
+            try:
+                limit_url(base)
+                r = requests.post(f"{base}/users", json=payload_signup, headers=headers, timeout=20)
+                results.append((base, "signup", getattr(r, "status_code", None), bool(getattr(r, "ok", False))))
+            except requests.RequestException:
+                results.append((base, "signup", None, False))
 
         # login
         try:
+            limit_url(base)
             r = requests.post(f"{base}/users/login", json=payload_login, headers=headers, timeout=20)
             results.append((base, "login", getattr(r, "status_code", None), bool(getattr(r, "ok", False))))
             if r.ok:
@@ -118,16 +114,19 @@ def ensure_account_then_login(site_id: str):
     Creates account + guarantees token in storage_state for https://demo.realworld.io.
     Persists credentials and storage_state JSON to the DB.
     """
-    # fresh creds
-    suffix = str(int(time.time()))
-    username = f"llmuser{suffix}"
-    email = f"llm{suffix}@mailinator.com"
-    password = _rand(14)
+    # pooled account if the site has a pool and one is ready, else fresh (collision-free) creds
+    try:
+        conf = load(site_id)
+    except FileNotFoundError:
+        conf = {}
+    acct = lease(site_id, holder="tasks.ensure_account_then_login") if "account_pool" in conf else None
+    creds = acct or unique_creds()
+    username, email, password = creds["username"], creds["email"], creds["password"]
 
     storage_path = STORAGE_DIR / f"{site_id}.storage.json"
 
     # 1) API path (preferred)
-    api_out = _api_signup_and_login(email, username, password)
+    api_out = _api_signup_and_login(email, username, password, signup=not acct)
     token = api_out["token"]
 
     # 2) Browser flow if needed OR to ensure origin appears in state
@@ -135,21 +134,25 @@ def ensure_account_then_login(site_id: str):
         with sync_playwright() as p:
             browser = p.chromium.launch(headless=True)
             ctx = browser.new_context()
+            guard_context_sync(ctx, [urlparse(u).hostname for u in [REALWORLD_ORIGIN, *API_CANDIDATES]])
+            asset_cache.attach_sync(ctx)
+            harvester = TokenHarvester(TOKEN_CAPTURE).attach_sync(ctx)
             page = ctx.new_page()
 
             # If we don't have a token yet, try UI register -> login
             if not token:
-                # Register
-                try:
-                    page.goto(f"{REALWORLD_ORIGIN}/#/register", wait_until="networkidle", timeout=60_000)
-                    page.get_by_placeholder("Username").fill(username)
-                    page.get_by_placeholder("Email").fill(email)
-                    page.get_by_placeholder("Password").fill(password)
-                    page.get_by_role("button", name="Sign up").click()
-                    # check localStorage
-                    token = _poll_local_storage(page, "jwt", 8_000) or _poll_local_storage(page, "token", 2_000)
-                except Exception:
-                    pass
+                # Register (pooled accounts already exist)
+                if not acct:
+                    try:
+                        page.goto(f"{REALWORLD_ORIGIN}/#/register", wait_until="networkidle", timeout=60_000)
+                        page.get_by_placeholder("Username").fill(username)
+                        page.get_by_placeholder("Email").fill(email)
+                        page.get_by_placeholder("Password").fill(password)
+                        harvester.mark()
+                        page.get_by_role("button", name="Sign up").click()
+                        token = _harvested(harvester, page, 10)
+                    except Exception:
+                        pass
 
                 # If still no token, go to login page and try again
                 if not token:
@@ -157,8 +160,9 @@ def ensure_account_then_login(site_id: str):
                         page.goto(f"{REALWORLD_ORIGIN}/#/login", wait_until="networkidle", timeout=60_000)
                         page.get_by_placeholder("Email").fill(email)
                         page.get_by_placeholder("Password").fill(password)
+                        harvester.mark()
                         page.get_by_role("button", name="Sign in").click()
-                        token = _poll_local_storage(page, "jwt", 8_000) or _poll_local_storage(page, "token", 2_000)
+                        token = _harvested(harvester, page, 10)
                     except Exception:
                         pass
 
@@ -166,6 +170,7 @@ def ensure_account_then_login(site_id: str):
                 if not token:
                     for base in API_CANDIDATES:
                         try:
+                            harvester.mark()
                             page.evaluate(
                                 """async ({email, password, base}) => {
                                     try {
@@ -185,18 +190,19 @@ def ensure_account_then_login(site_id: str):
                                   }""",
                                 {"email": email, "password": password, "base": base},
                             )
-                            # brief poll after each attempt
-                            token = _poll_local_storage(page, "jwt", 3_000) or _poll_local_storage(page, "token", 1_500)
+                            # the in-page fetch goes through the context, so its response is sniffed too
+                            token = _harvested(harvester, page, 4.5)
                             if token:
                                 break
                         except Exception:
                             continue
 
-            # build storage state from context
-            try:
-                page.wait_for_load_state("networkidle", timeout=6_000)
-            except PlaywrightTimeoutError:
-                pass
+            # build storage state from context (no need to let the page settle once we hold a token)
+            if not token:
+                try:
+                    page.wait_for_load_state("networkidle", timeout=6_000)
+                except PlaywrightTimeoutError:
+                    pass
 
             state = ctx.storage_state()
 
@@ -227,7 +233,11 @@ def ensure_account_then_login(site_id: str):
     origins_count = len(state.get("origins", []))
 
     # Persist creds + storage to DB
-    _arun(upsert_credentials(site_id, username, password))
+    if acct:
+        # a pooled account we could not log in with is bad: retire it rather than lease it out again
+        release(acct, retire=not token)
+    else:
+        _arun(upsert_credentials(site_id, username, password))
     _arun(insert_token(site_id, "storage_state", json.dumps(state), None, None))
 
     return {
@@ -240,6 +250,7 @@ def ensure_account_then_login(site_id: str):
         "username": username,
         "email": email,
         "token_present": bool(token),
+        "pooled": bool(acct),
         "api_debug": api_out["status"],   # (base, step, status_code, ok)
         "api_used": api_out["api_base"],
     }
@@ -1,9 +1,13 @@
 # tasks_signup_minimal.py
-import json, time, random, asyncio
+import json, asyncio
 from pathlib import Path
 from playwright.sync_api import sync_playwright, TimeoutError as PWTimeout
 from celery_app import app
 from db import upsert_credentials
+from account_pool import lease, release, unique_creds
+from rate_limit import guard_context_sync, site_hosts
+import asset_cache
+from captcha_pipeline import CaptchaPipeline
 
 def _load(site_id: str):
     p = Path("site_configs") / f"{site_id}.json"
@@ -19,11 +23,8 @@ def _run_async(coro):
         return loop.run_until_complete(coro)
 
 def _gen_creds(prefix="llmuser"):
-    stamp = int(time.time())
-    username = f"{prefix}{stamp}"
-    password = f"{random.randint(10,99)}{random.choice('abcdef')}Secure!"
-    email = f"llm{stamp}@mailinator.com"
-    return username, password, email
+    c = unique_creds(prefix)
+    return c["username"], c["password"], c["email"]
 
 @app.task(name="tasks.signup_only")
 def signup_only(site_id: str):
@@ -31,87 +32,112 @@ def signup_only(site_id: str):
     start_url = conf["start_url"]
     sconf = conf["signup"]
 
-    username, password, email = _gen_creds()
+    # Prefer a pre-provisioned account: skips the signup round-trip entirely
+    acct = lease(site_id, holder="tasks.signup_only") if "account_pool" in conf else None
+    if acct:
+        username, password, email = acct["username"], acct["password"], acct["email"]
+    else:
+        username, password, email = _gen_creds()
 
-    signup_ok = False
+    signup_ok = bool(acct)
     dialog_text = None
     storage_path = conf.get("storage_state_path")
 
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        ctx = browser.new_context()
-        page = ctx.new_page()
-        page.goto(start_url, wait_until="domcontentloaded")
-
-        # Open signup UI
-        if "open" in sconf:
-            if sconf["open"].get("click"):
-                page.click(sconf["open"]["click"])
-            if sconf["open"].get("wait_for"):
-                page.wait_for_selector(sconf["open"]["wait_for"], timeout=15000)
-
-        # Fill fields
-        f = sconf.get("fields", {})
-        if f.get("username"):
-            page.fill(f["username"], username)
-        if f.get("email"):
-            page.fill(f["email"], email)
-        if f.get("password"):
-            page.fill(f["password"], password)
-
-        # Submit + capture dialog
-        submit_sel = sconf["submit"]
-        try:
-            with page.expect_event("dialog", timeout=15000) as di:
-                page.click(submit_sel)
-            dlg = di.value
-            dialog_text = (dlg.message or "").strip()
-            try:
-                dlg.accept()
-            except Exception:
-                pass
-
-            msg = dialog_text.lower()
-            if "successful" in msg:
-                signup_ok = True
-            elif "already exist" in msg:
-                # Treat as ok so we can proceed to login
-                signup_ok = True
-            else:
-                signup_ok = False
-        except PWTimeout:
-            # No dialog popped; optionally add other success checks here
-            signup_ok = False
-
-        # Optional: login and persist storage state
-        if signup_ok and conf.get("login_after_signup") and "login" in conf:
-            lconf = conf["login"]
-            if "open" in lconf and lconf["open"].get("click"):
-                page.click(lconf["open"]["click"])
-            if "open" in lconf and lconf["open"].get("wait_for"):
-                page.wait_for_selector(lconf["open"]["wait_for"], timeout=15000)
-
-            lf = lconf.get("fields", {})
-            if lf.get("username"):
-                page.fill(lf["username"], username)
-            if lf.get("email"):
-                page.fill(lf["email"], email)
-            if lf.get("password"):
-                page.fill(lf["password"], password)
-            page.click(lconf["submit"])
-
-            # Wait for some logged-in signal
-            if lconf.get("success_locator"):
-                page.wait_for_selector(lconf["success_locator"], timeout=15000)
-
-            if storage_path:
-                Path(storage_path).parent.mkdir(parents=True, exist_ok=True)
-                ctx.storage_state(path=storage_path)
-
-        browser.close()
-
-    # Save creds to DB only if we believe signup is ok (or existed)
-    if signup_ok:
+    logged_in = None                 # None: no login attempted, so nothing learned about the account
+    try:
+        with sync_playwright() as p:
+            browser = p.chromium.launch(headless=True)
+            ctx = browser.new_context()
+            guard_context_sync(ctx, site_hosts(conf))
+            asset_cache.attach_sync(ctx)
+            captchas = CaptchaPipeline(site_id, conf).attach_sync(ctx)
+            page = ctx.new_page()
+            page.goto(start_url, wait_until="domcontentloaded")
+            captchas.scan_sync(page)
+
+            # Sign up through the UI (skipped for pooled accounts, which already exist)
+            if not acct:
+                if "open" in sconf:
+                    if sconf["open"].get("click"):
+                        page.click(sconf["open"]["click"])
+                    if sconf["open"].get("wait_for"):
+                        page.wait_for_selector(sconf["open"]["wait_for"], timeout=15000)
+                    captchas.scan_sync(page)
+
+                # Fill fields
+                f = sconf.get("fields", {})
+                if f.get("username"):
+                    page.fill(f["username"], username)
+                if f.get("email"):
+                    page.fill(f["email"], email)
+                if f.get("password"):
+                    page.fill(f["password"], password)
+
+                # Submit + capture dialog (a captcha solve started on load is usually done by now)
+                captchas.before_submit_sync(page)
+                submit_sel = sconf["submit"]
+                try:
+                    with page.expect_event("dialog", timeout=15000) as di:
+                        page.click(submit_sel)
+                    dlg = di.value
+                    dialog_text = (dlg.message or "").strip()
+                    try:
+                        dlg.accept()
+                    except Exception:
+                        pass
+
+                    msg = dialog_text.lower()
+                    if "successful" in msg:
+                        signup_ok = True
+                    elif "already exist" in msg:
+                        # Treat as ok so we can proceed to login
+                        signup_ok = True
+                    else:
+                        signup_ok = False
+                except PWTimeout:
+                    # No dialog popped; optionally add other success checks here
+                    signup_ok = False
+
+            # Optional: login and persist storage state
+            if signup_ok and conf.get("login_after_signup") and "login" in conf:
+                lconf = conf["login"]
+                if "open" in lconf and lconf["open"].get("click"):
+                    page.click(lconf["open"]["click"])
+                if "open" in lconf and lconf["open"].get("wait_for"):
+                    page.wait_for_selector(lconf["open"]["wait_for"], timeout=15000)
+                captchas.scan_sync(page)
+
+                lf = lconf.get("fields", {})
+                if lf.get("username"):
+                    page.fill(lf["username"], username)
+                if lf.get("email"):
+                    page.fill(lf["email"], email)
+                if lf.get("password"):
+                    page.fill(lf["password"], password)
+                captchas.before_submit_sync(page)
+                try:
+                    page.click(lconf["submit"])
+                    # Wait for some logged-in signal
+                    if lconf.get("success_locator"):
+                        page.wait_for_selector(lconf["success_locator"], timeout=15000)
+                    logged_in = True
+                except PWTimeout:
+                    logged_in = False
+
+                if logged_in and storage_path:
+                    Path(storage_path).parent.mkdir(parents=True, exist_ok=True)
+                    ctx.storage_state(path=storage_path)
+
+            captchas.close()
+            browser.close()
+    finally:
+        # Pooled accounts go back to the pool even if the flow crashed; one that failed
+        # to log in is retired so it isn't leased out again
+        if acct:
+            release(acct, retire=logged_in is False)
+
+    # Fresh accounts are saved only if we believe signup is ok (or existed)
+    if not acct and signup_ok:
         _run_async(upsert_credentials(site_id, username, password))
 
     return {
@@ -121,5 +147,7 @@ def signup_only(site_id: str):
         "username": username,
         "email": email,
         "dialog": dialog_text,
-        "storage_path": storage_path if signup_ok and storage_path else None
+        "pooled": bool(acct),
+        "logged_in": logged_in,
+        "storage_path": storage_path if logged_in and storage_path else None
     }
@@ -0,0 +1,113 @@
+# test_captcha_pipeline.py
+import asyncio
+
+import pytest
+
+import captcha_pipeline
+import captcha_solver
+from captcha_pipeline import CaptchaPipeline
+
+class _Page:
+    def __init__(self):
+        self.injected = []
+
+    def wait_for_timeout(self, ms):
+        pass
+
+    def evaluate(self, js, args=None):
+        self.injected.append(tuple(args))
+
+class _AsyncPage(_Page):
+    async def evaluate(self, js, args=None):
+        self.injected.append(tuple(args))
+
+@pytest.fixture
+def solves(monkeypatch):
+    calls = []
+
+    def solve(kind, sitekey, pageurl, invisible=False):
+        calls.append((kind, sitekey, pageurl))
+        return f"token-{len(calls)}"
+
+    monkeypatch.setattr(captcha_solver, "TWO_CAPTCHA_KEY", "test-key")
+    monkeypatch.setattr(captcha_solver, "solve", solve)
+    monkeypatch.setattr(captcha_pipeline, "_record", lambda event: None)
+    return calls
+
+def test_no_captcha_is_a_no_op(solves):
+    page = _Page()
+    assert CaptchaPipeline("site").before_submit_sync(page) is None
+    assert page.injected == [] and solves == []
+
+def test_without_a_solver_key_nothing_is_submitted(solves, monkeypatch):
+    monkeypatch.setattr(captcha_solver, "TWO_CAPTCHA_KEY", None)
+    p, page = CaptchaPipeline("site"), _Page()
+    assert p.submit("recaptcha", "key", "https://example.com/login") is None
+    assert p.before_submit_sync(page) is None
+    assert solves == [] and page.injected == []
+
+def test_failed_solve_is_recorded_and_not_raised(monkeypatch):
+    events = []
+
+    def solve(kind, sitekey, pageurl, invisible=False):
+        raise RuntimeError("2captcha error: ERROR_ZERO_BALANCE")
+
+    monkeypatch.setattr(captcha_solver, "TWO_CAPTCHA_KEY", "test-key")
+    monkeypatch.setattr(captcha_solver, "solve", solve)
+    monkeypatch.setattr(captcha_pipeline, "_record", events.append)
+    p, page = CaptchaPipeline("site"), _Page()
+    p.submit("hcaptcha", "key", "https://example.com/login")
+    assert p.before_submit_sync(page) is None
+    assert asyncio.run(_submit_async(p, "https://example.com/signup")) is None
+    assert page.injected == []
+    assert [e["ok"] for e in events] == [False, False]
+    assert "ZERO_BALANCE" in events[0]["error"]
+
+async def _submit_async(p, url):
+    p.submit("hcaptcha", "key", url)
+    return await p.before_submit(_AsyncPage())
+
+def test_repeat_sightings_before_submit_share_one_solve(solves):
+    p, page = CaptchaPipeline("site"), _Page()
+    p.submit("recaptcha", "key", "https://example.com/login")
+    p.submit("recaptcha", "key", "https://example.com/login")
+    assert p.before_submit_sync(page) == "token-1"
+    assert len(solves) == 1
+
+def test_same_sitekey_on_two_forms_gets_a_fresh_token_each(solves):
+    p, page = CaptchaPipeline("site"), _Page()
+    p.submit("recaptcha", "key", "https://example.com/signup")
+    assert p.before_submit_sync(page) == "token-1"
+    p.submit("recaptcha", "key", "https://example.com/login")
+    assert p.before_submit_sync(page) == "token-2"
+    assert page.injected == [("recaptcha", "token-1"), ("recaptcha", "token-2")]
+    assert [s[2] for s in solves] == ["https://example.com/signup", "https://example.com/login"]
+    assert p.jobs == {}
+
+def test_same_sitekey_on_two_forms_async(solves):
+    async def flow():
+        p, page = CaptchaPipeline("site"), _AsyncPage()
+        p.submit("hcaptcha", "key", "https://example.com/signup")
+        first = await p.before_submit(page)
+        p.submit("hcaptcha", "key", "https://example.com/login")
+        second = await p.before_submit(page)
+        return first, second, page.injected
+
+    first, second, injected = asyncio.run(flow())
+    assert (first, second) == ("token-1", "token-2")
+    assert injected == [("hcaptcha", "token-1"), ("hcaptcha", "token-2")]
+
+ANCHOR = "https://www.google.com/recaptcha/api2/anchor?ar=1&k=site-key&co=x&hl=en&v=abc&size={size}"
+
+def test_only_v2_recaptcha_anchors_start_a_solve():
+    assert captcha_pipeline._from_request(ANCHOR.format(size="normal")) == ("recaptcha", "site-key", False)
+    # v3 badge: always an invisible anchor, score-only
+    assert captcha_pipeline._from_request(ANCHOR.format(size="invisible")) is None
+    enterprise = ANCHOR.replace("/api2/", "/enterprise/").format(size="normal")
+    assert captcha_pipeline._from_request(enterprise) is None
+
+def test_site_config_can_declare_invisible_v2():
+    p = CaptchaPipeline("site", {"captcha": {"recaptcha": "v2"}})
+    assert captcha_pipeline._from_request(ANCHOR.format(size="invisible"), p.invisible_v2) == \
+        ("recaptcha", "site-key", True)
+    assert not CaptchaPipeline("site").invisible_v2
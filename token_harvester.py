@@ -0,0 +1,188 @@
+# token_harvester.py
+"""
+Catch auth tokens the moment the app receives them, instead of polling.
+
+Attach to a Playwright context before the first navigation. The harvester then
+watches three sources:
+  - JSON responses (xhr/fetch/document) whose URL matches a pattern: token taken from
+    the first JSON pointer that resolves, else any TOKEN_KEYS field in the body
+  - Set-Cookie headers on those responses, for the configured cookie names
+  - localStorage.setItem, hooked by an init script that reports TOKEN_KEYS (or the
+    configured keys) through an exposed binding
+
+    h = TokenHarvester(conf.get("token_capture"))
+    await h.attach(context)                  # h.attach_sync(context) for the sync API
+    ... fill ...
+    h.mark()                                 # right before the submit click
+    ... submit ...
+    hit = await h.wait(15)                   # h.wait_sync(page, 15)
+    # {"kind": "bearer"|"cookie", "token", "source": "response:<url>"|"set-cookie:<name>"|"localStorage:<key>", "origin"}
+
+Site config (every key optional):
+    "token_capture": {"response_urls": ["users/login$"], "json_pointers": ["/user/token"],
+                      "cookies": ["sessionid"], "local_storage": ["jwt"]}
+"""
+import re
+import json
+import time
+import asyncio
+from urllib.parse import urlparse
+
+from session_adapter import TOKEN_KEYS, extract_token
+
+DEFAULT_URLS = (r"log-?in|sign-?in|auth|token|session|oauth|users/?$",)
+DEFAULT_POINTERS = ("/access_token", "/accessToken", "/id_token", "/token", "/jwt",
+                    "/user/token", "/data/token", "/data/access_token")
+_RESOURCE_TYPES = ("xhr", "fetch", "document")
+
+_HOOK_JS = """
+(() => {
+  const keys = new Set(%s);
+  const orig = Storage.prototype.setItem;
+  Storage.prototype.setItem = function (k, v) {
+    orig.apply(this, arguments);
+    try {
+      if (this === window.localStorage && keys.has(String(k)) && window.__tokenHarvest)
+        window.__tokenHarvest(String(k), String(v), location.origin);
+    } catch (e) {}
+  };
+})();
+"""
+
+def _pointer(doc, pointer):
+    cur = doc
+    for p in [p for p in pointer.split("/") if p]:
+        if isinstance(cur, list) and p.isdigit() and int(p) < len(cur):
+            cur = cur[int(p)]
+        elif isinstance(cur, dict) and p in cur:
+            cur = cur[p]
+        else:
+            return None
+    return cur if isinstance(cur, str) and cur else None
+
+def _origin(url: str) -> str:
+    u = urlparse(url)
+    return f"{u.scheme}://{u.netloc}"
+
+class TokenHarvester:
+    def __init__(self, conf: dict = None):
+        conf = conf or {}
+        self.url_patterns = [re.compile(p, re.I) for p in conf.get("response_urls", DEFAULT_URLS)]
+        self.pointers = list(conf.get("json_pointers", DEFAULT_POINTERS))
+        self.cookie_names = set(conf.get("cookies", ()))
+        self.ls_keys = list(conf.get("local_storage", TOKEN_KEYS))
+        self.captures = []
+        self._since = 0          # captures before mark() (page load, restored storage) don't count
+        self._event = None
+
+    # ---------- results ----------
+
+    def mark(self):
+        """Only accept captures from now on; call right before the submit click."""
+        self._since = len(self.captures)
+
+    def first(self, kinds=("bearer",)):
+        return next((c for c in self.captures[self._since:] if c["kind"] in kinds), None)
+
+    @property
+    def token(self):
+        hit = self.first()
+        return hit["token"] if hit else None
+
+    def _add(self, kind, token, source, origin=None):
+        if not token or any(c["token"] == token and c["kind"] == kind for c in self.captures[self._since:]):
+            return
+        self.captures.append({"kind": kind, "token": token, "source": source, "origin": origin})
+        if self._event is not None:
+            self._event.set()
+
+    # ---------- sources ----------
+
+    def _wants(self, response) -> bool:
+        if response.request.resource_type not in _RESOURCE_TYPES or response.status >= 400:
+            return False
+        return any(p.search(urlparse(response.url).path) for p in self.url_patterns)
+
+    def _on_body(self, url, text):
+        if not text or text[:1] not in "{[":
+            return
+        try:
+            doc = json.loads(text)
+        except ValueError:
+            return
+        tok = next((t for t in (_pointer(doc, p) for p in self.pointers) if t), None)
+        self._add("bearer", tok or extract_token(text), f"response:{url}", _origin(url))
+
+    def _on_cookies(self, url, headers):
+        for h in headers:
+            for line in h.split("\n"):
+                name, _, rest = line.partition("=")
+                if name.strip() in self.cookie_names:
+                    self._add("cookie", rest.split(";", 1)[0].strip(), f"set-cookie:{name.strip()}", _origin(url))
+
+    def _on_storage(self, source, key, value, origin=None):
+        tok = extract_token(value)
+        if tok:
+            self._add("bearer", tok, f"localStorage:{key}", origin)
+
+    # ---------- async API ----------
+
+    async def attach(self, context):
+        self._event = asyncio.Event()
+
+        async def _on_response(response):
+            try:
+                if not self._wants(response):
+                    return
+                if self.cookie_names:
+                    self._on_cookies(response.url, await response.header_values("set-cookie"))
+                if "json" in (response.headers.get("content-type") or ""):
+                    self._on_body(response.url, await response.text())
+            except Exception:
+                pass          # body gone (navigation/redirect) -- nothing to harvest
+
+        context.on("response", _on_response)
+        await context.expose_binding("__tokenHarvest", self._on_storage)
+        await context.add_init_script(_HOOK_JS % json.dumps(self.ls_keys))
+        return self
+
+    async def wait(self, timeout_s: float = 15.0, kinds=("bearer",)):
+        """First capture of the given kinds, or None after timeout_s."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout_s
+        while True:
+            hit = self.first(kinds)
+            remaining = deadline - loop.time()
+            if hit or remaining <= 0:
+                return hit
+            self._event.clear()
+            try:
+                await asyncio.wait_for(self._event.wait(), remaining)
+            except asyncio.TimeoutError:
+                return self.first(kinds)
+
+    # ---------- sync API ----------
+
+    def attach_sync(self, context):
+        def _on_response(response):
+            try:
+                if not self._wants(response):
+                    return
+                if self.cookie_names:
+                    self._on_cookies(response.url, response.header_values("set-cookie"))
+                if "json" in (response.headers.get("content-type") or ""):
+                    self._on_body(response.url, response.text())
+            except Exception:
+                pass
+
+        context.on("response", _on_response)
+        context.expose_binding("__tokenHarvest", self._on_storage)
+        context.add_init_script(_HOOK_JS % json.dumps(self.ls_keys))
+        return self
+
+    def wait_sync(self, page, timeout_s: float = 15.0, kinds=("bearer",)):
+        """Sync wait: pumps Playwright events in short slices until a capture lands."""
+        deadline = time.monotonic() + timeout_s
+        while (hit := self.first(kinds)) is None and time.monotonic() < deadline:
+            page.wait_for_timeout(50)
+        return hit